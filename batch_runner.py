@@ -0,0 +1,192 @@
+#author @t_sanf
+
+import os
+import json
+import errno
+import time
+import threading
+import multiprocessing
+import traceback
+from instrumentation import run_report
+
+# errors worth retrying, reads from a network share fail with these when the share hiccups
+TRANSIENT_ERRORS=(OSError,)
+# an OSError only counts as transient with one of these errno values, a missing file or a denied permission
+# fails the same way on every attempt
+TRANSIENT_ERRNOS={getattr(errno,name) for name in ('EIO','EAGAIN','EINTR','EBUSY','ESTALE','ETIMEDOUT','ENOLCK','ECONNRESET',
+                                                   'ECONNABORTED','ECONNREFUSED','ENETDOWN','ENETUNREACH','ENETRESET',
+                                                   'EHOSTDOWN','EHOSTUNREACH','EREMOTEIO') if hasattr(errno,name)}
+
+
+def is_transient(error,retry_on=TRANSIENT_ERRORS):
+    '''
+    check if an error is worth retrying
+    -- an error of one of the retry_on types is transient, except that a plain OSError entry only matches the
+       TRANSIENT_ERRNOS values (subclasses listed explicitly, e.g. FileNotFoundError, match whatever their errno)
+    '''
+    explicit=tuple(kind for kind in retry_on if kind is not OSError)
+    if explicit and isinstance(error,explicit):
+        return True
+    return OSError in retry_on and isinstance(error,OSError) and error.errno in TRANSIENT_ERRNOS
+
+
+def _call_task(args):
+    '''
+    run a single task inside a worker, errors are returned instead of raised so one bad patient does not stop the pool
+    -- transient errors (see is_transient) are retried up to `retries` times, waiting delay, 2*delay, 4*delay ... in between
+    '''
+    func,task,retries,retry_on,delay=args
+    for attempt in range(retries+1):
+        try:
+            return(task,func(*task),None)
+        except Exception as e:
+            if attempt==retries or not is_transient(e,retry_on):
+                return(task,None,traceback.format_exc())
+            time.sleep(delay*2**attempt)
+
+
+def _call_task_reported(args):
+    '''_call_task in a worker process, the run_report records of the task are sent back with the result'''
+    return _call_task(args)+(run_report.drain(),)
+
+
+def _exit_with_parent(parent):
+    '''end this process as soon as its parent is gone, a task must not keep writing once nobody waits for it'''
+    while os.getppid()==parent:
+        time.sleep(1.)
+    os._exit(1)
+
+
+def _call_task_in_child(conn,args):
+    '''entry point of the process running one task with a timeout, the output is sent back through a pipe'''
+    threading.Thread(target=_exit_with_parent,args=(os.getppid(),),daemon=True).start()
+    conn.send(_call_task_reported(args))
+    conn.close()
+
+
+def _run_with_timeout(jobs,workers,timeout,retries):
+    '''
+    run every job in its own spawned process, at most `workers` at a time, a process still running after timeout
+    seconds is terminated and the task is started again while it has retries left
+    :return: generator of _call_task_reported outputs in submission order
+    '''
+
+    context=multiprocessing.get_context('spawn')
+    pending=list(range(len(jobs)))
+    running={}; outputs={}
+    attempts=[0]*len(jobs)
+    next_output=0
+    try:
+        while next_output<len(jobs):
+            while pending and len(running)<workers:
+                i=pending.pop(0)
+                conn,child_conn=context.Pipe(duplex=False)
+                process=context.Process(target=_call_task_in_child,args=(child_conn,jobs[i]),daemon=True)
+                process.start()
+                child_conn.close()
+                running[i]=(process,conn,time.monotonic())
+
+            for i,(process,conn,start) in list(running.items()):
+                task=jobs[i][1]
+                if conn.poll() or not process.is_alive():
+                    try:
+                        outputs[i]=conn.recv()
+                    except EOFError:
+                        outputs[i]=(task,None,'worker process exited with code {}'.format(process.exitcode),[])
+                    process.join()
+                    del running[i]
+                elif time.monotonic()-start>timeout:
+                    process.terminate()
+                    process.join()
+                    del running[i]
+                    attempts[i]+=1
+                    if attempts[i]<=retries:
+                        pending.insert(0,i)
+                    else:
+                        outputs[i]=(task,None,'timed out after {} s, {} attempts'.format(timeout,attempts[i]),[])
+
+            while next_output in outputs:
+                yield outputs.pop(next_output)
+                next_output+=1
+            time.sleep(0.05)
+    finally:
+        for process,conn,start in running.values():
+            process.terminate()
+            process.join()
+
+
+def log_failure(ledger,name,label,error):
+    '''append one failed task with its traceback to the failure ledger, a json lines file'''
+
+    directory=os.path.dirname(os.path.abspath(ledger))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(ledger,'a') as f:
+        f.write(json.dumps({'time':time.strftime('%Y-%m-%dT%H:%M:%S'),'stage':name,'task':label,'error':error})+'\n')
+
+
+def read_ledger(ledger):
+    '''all entries of a failure ledger, empty list if there is none'''
+    if not os.path.exists(ledger):
+        return []
+    with open(ledger) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def run_tasks(func,tasks,workers=1,name='task',retries=0,retry_on=TRANSIENT_ERRORS,retry_delay=1.,timeout=None,
+              on_done=None,ledger=None):
+    '''
+    run func(*task) for every task, either serially or in a process pool
+    -- results are collected in submission order, so progress output is identical for any number of workers
+    -- the pool uses the 'spawn' start method, forking a process that already holds SimpleITK/ITK threads can hang
+    -- with a timeout every task runs in its own process (also when workers is 1), so a hung task can be killed
+    -- on_done is called in this process as soon as a task succeeds, use it to checkpoint (e.g. record the task in
+       the build manifest) so a run that crashes resumes after the last finished task
+    :param func: picklable callable (module level function or method of a picklable object)
+    :param tasks (list): list of argument tuples, one per task
+    :param workers (int): number of worker processes, 1 runs everything in the current process
+    :param name (str): label used in progress messages
+    :param retries (int): extra attempts for a task failing with a transient error or timing out
+    :param retry_on (tuple): exception types retried, transient i/o errors by default, see is_transient
+    :param retry_delay (float): seconds before the first retry, doubled for every further retry
+    :param timeout (float): seconds a task may run before it is killed, None for no limit
+    :param on_done: callable(task, result) called after every successful task
+    :param ledger (str): json lines file every failure is appended to, with its traceback
+    :return: (list of (task, result) for tasks that finished, list of (task, traceback) for tasks that failed)
+    '''
+
+    tasks=[tuple(task) for task in tasks]
+    labels=['/'.join(str(t) for t in task if isinstance(t,(str,int))) for task in tasks]
+    jobs=[(func,task,retries,retry_on,retry_delay) for task in tasks]
+    done=[]; failed=[]
+    if workers is None or workers<1:
+        workers=1
+
+    pool=None
+    if timeout is not None:
+        outputs=_run_with_timeout(jobs,min(workers,len(tasks)),timeout,retries)
+    elif workers<=1 or len(tasks)<=1:
+        outputs=(output+([],) for output in map(_call_task,jobs))
+    else:
+        pool=multiprocessing.get_context('spawn').Pool(min(workers,len(tasks)))
+        outputs=pool.imap(_call_task_reported,jobs,chunksize=1)
+
+    try:
+        for i,(task,result,error,records) in enumerate(outputs):
+            run_report.extend(records)
+            if error is None:
+                done+=[(task,result)]
+                if on_done is not None:
+                    on_done(task,result)
+                print('[{}/{}] {} {} done'.format(i+1,len(tasks),name,labels[i]))
+            else:
+                failed+=[(task,error)]
+                if ledger is not None:
+                    log_failure(ledger,name,labels[i],error)
+                print('[{}/{}] {} {} failed'.format(i+1,len(tasks),name,labels[i]))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return(done,failed)
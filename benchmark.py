@@ -0,0 +1,281 @@
+#author @t_sanf
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+import numpy as np
+import SimpleITK as sitk
+from parsing_VOI import ParseVOI
+from nifti_mask_withResample import VOI_to_nifti_mask
+from dicom2nifti_withAlign_withResample import Dicom2Nifti
+from resample_nifti import ResampleNifti4Clara
+from dicom_io import reference_cache
+from instrumentation import peak_rss_mb, current_peak_rss_mb, reset_peak_rss
+
+
+########## synthetic data, no patient data is needed ##########
+
+def write_dicom_series(out,size=(384,384,30),spacing=(0.5,0.5,3.0),seed=0):
+    '''
+    write a synthetic MR series, one dicom file per slice with the tags the readers in this repo rely on
+    :param size: (columns, rows, slices)
+    :param spacing: pixel spacing and slice thickness in mm
+    '''
+
+    if not os.path.exists(out):
+        os.makedirs(out)
+    arr=(np.random.default_rng(seed).random(size[::-1])*1000).astype(np.int16)
+    image=sitk.GetImageFromArray(arr)
+    image.SetSpacing(spacing)
+    writer=sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    series_uid='1.2.826.0.1.3680043.2.1125.{}'.format(seed+1000)
+    for i in range(image.GetDepth()):
+        position=image.TransformIndexToPhysicalPoint((0,0,i))
+        dicom_slice=image[:,:,i]
+        for tag,value in (('0020|000e',series_uid),('0020|0032','\\'.join(map(str,position))),
+                          ('0020|0037','1\\0\\0\\0\\1\\0'),('0020|1041',str(position[2])),('0020|0013',str(i)),
+                          ('0008|0060','MR'),('0028|0030','{}\\{}'.format(*spacing[:2])),('0018|0050',str(spacing[2]))):
+            dicom_slice.SetMetaData(tag,value)
+        writer.SetFileName(os.path.join(out,'IM{:04d}.dcm'.format(i)))
+        writer.Execute(dicom_slice)
+
+
+def write_voi(path,slices=range(5,25),contours=1,vertices=100,center=(192,192),radius=80,seed=0):
+    '''
+    write a synthetic MIPAV .voi file, every slice holds `contours` ellipses side by side
+    :param slices: slice numbers that have contours
+    :param vertices (int): number of points per contour
+    '''
+
+    rng=np.random.default_rng(seed)
+    angle=np.linspace(0,2*np.pi,vertices,endpoint=False)
+    lines=['MIPAV VOI FILE','255\t\t# curvetype of the VOI <Contour>','0\t\t# presentation colour',
+           '{}\t\t# number of slices for the VOI'.format(len(slices))]
+    for slice in slices:
+        lines+=['{}\t\t# slice number'.format(slice),'{}\t\t# number of contours in slice'.format(contours)]
+        for c in range(contours):
+            r=radius/contours*(0.8+0.2*rng.random())
+            x0=center[0]-radius+r*(2*c+1)
+            lines+=['{}\t\t# number of pts in contour <Chain-element-type>'.format(vertices)]
+            lines+=['{:.4f} {:.4f}'.format(x0+r*np.cos(a),center[1]+0.7*r*np.sin(a)) for a in angle]
+    lines+=['1234\t\t# unique ID of the VOI']
+    with open(path,'w') as f:
+        f.write('\n'.join(lines)+'\n')
+
+
+def write_nifti(path,size=(384,384,30),spacing=(0.5,0.5,3.0),seed=0,mask=False):
+    '''write a synthetic image (int16 noise) or mask (uint8 ellipsoid) as nifti'''
+
+    shape=size[::-1]
+    if mask:
+        z,y,x=np.ogrid[:shape[0],:shape[1],:shape[2]]
+        arr=((((z-shape[0]/2)/(shape[0]/3))**2+((y-shape[1]/2)/(shape[1]/4))**2+((x-shape[2]/2)/(shape[2]/4))**2)<=1).astype(np.uint8)
+    else:
+        arr=(np.random.default_rng(seed).random(shape)*1000).astype(np.int16)
+    image=sitk.GetImageFromArray(arr)
+    image.SetSpacing(spacing)
+    sitk.WriteImage(image,path)
+
+
+########## benchmarks ##########
+
+class Benchmark:
+    '''
+    time the conversion, masking and resampling hot paths on synthetic data
+    -- every benchmark is run `repeats` times after a setup step that is not timed, best and mean wall time,
+       throughput, peak traced memory (python + numpy allocations) and peak rss are recorded
+    -- peak rss is reset before the traced run on linux so it is the peak of that benchmark, elsewhere it is the
+       process peak so far
+    -- memory is traced in one extra run so tracing does not slow down the timed runs
+    -- results are saved as json named after the git commit, compare() prints the change between two runs
+    '''
+
+    def __init__(self):
+        self.workdir=None  #directory the temporary synthetic data is written in, the system temp directory when None
+        self.outdir='bench_results'  #where results are saved, one json per commit
+        self.repeats=5
+        self.dicom_size=(384,384,30)  #columns, rows, slices of the synthetic t2
+        self.dicom_spacing=(0.5,0.5,3.0)
+        self.voi_slices=20  #slices with contours
+        self.voi_contours=1  #contours per slice
+        self.voi_vertices=200  #points per contour
+        self.nifti_size=(384,384,30)
+        self.nifti_files=4  #files compressed by the compress_nii benchmark
+
+    def make_data(self,root):
+        '''synthetic database at root/db/pt0 (dicoms/t2, voi/wp_bt.voi) and nifti files at root/nifti'''
+
+        patient=os.path.join(root,'db','pt0')
+        write_dicom_series(os.path.join(patient,'dicoms','t2'),size=self.dicom_size,spacing=self.dicom_spacing)
+        os.makedirs(os.path.join(patient,'voi'))
+        first=max(0,(self.dicom_size[2]-self.voi_slices)//2)
+        write_voi(os.path.join(patient,'voi','wp_bt.voi'),slices=range(first,min(first+self.voi_slices,self.dicom_size[2])),
+                  contours=self.voi_contours,vertices=self.voi_vertices,
+                  center=(self.dicom_size[0]//2,self.dicom_size[1]//2),radius=min(self.dicom_size[:2])//4)
+        os.makedirs(os.path.join(root,'nifti'))
+        write_nifti(os.path.join(root,'nifti','img_0.nii.gz'),size=self.nifti_size,spacing=self.dicom_spacing)
+        write_nifti(os.path.join(root,'nifti','seg_0.nii.gz'),size=self.nifti_size,spacing=self.dicom_spacing,mask=True)
+        os.makedirs(os.path.join(root,'nii'))
+        for i in range(self.nifti_files):
+            write_nifti(os.path.join(root,'nii','img_{}.nii'.format(i)),size=self.nifti_size,spacing=self.dicom_spacing,seed=i)
+        os.makedirs(os.path.join(root,'compress'))
+        os.makedirs(os.path.join(root,'out'))
+
+    def measure(self,func,setup=None,items=1,nbytes=0):
+        '''
+        time func() self.repeats times
+        :param setup: called before every repeat, not timed
+        :param items (int): items processed per call (slices, files ...) for the throughput
+        :param nbytes (int): bytes processed per call for the throughput in MB/s
+        '''
+
+        times=[]
+        for i in range(self.repeats):
+            if setup is not None:
+                setup()
+            start=time.perf_counter()
+            func()
+            times+=[time.perf_counter()-start]
+
+        if setup is not None:
+            setup()
+        reset_peak_rss()
+        tracemalloc.start()
+        func()
+        traced_peak=tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        peak_rss=current_peak_rss_mb() or peak_rss_mb()
+        best=min(times)
+        return {'best_s':best,'mean_s':sum(times)/len(times),'items_per_s':items/best,
+                'mb_per_s':nbytes/1024.**2/best if nbytes else None,
+                'peak_traced_mb':traced_peak/1024.**2,'peak_rss_mb':peak_rss}
+
+    def run(self,names=None):
+        '''
+        run all benchmarks (or the ones in names) and save the results
+        :return: results dict
+        '''
+
+        root=tempfile.mkdtemp(prefix='clara_bench_',dir=self.workdir)
+        try:
+            print('writing synthetic data to {}'.format(root))
+            self.make_data(root)
+            results={}
+            for name,bench in self.benchmarks(root).items():
+                if names and name not in names:
+                    continue
+                results[name]=self.measure(**bench)
+                print('{:<22} best {:8.4f} s  mean {:8.4f} s  peak traced {:8.1f} MB'.format(
+                    name,results[name]['best_s'],results[name]['mean_s'],results[name]['peak_traced_mb']))
+        finally:
+            shutil.rmtree(root,ignore_errors=True)
+        return self.save(results)
+
+    def benchmarks(self,root):
+        '''{name: keyword arguments of measure()} for every benchmarked function'''
+
+        voi_path=os.path.join(root,'db','pt0','voi','wp_bt.voi')
+        t2_dir=os.path.join(root,'db','pt0','dicoms','t2')
+        slice_bytes=self.dicom_size[0]*self.dicom_size[1]
+        volume_bytes=slice_bytes*self.dicom_size[2]
+
+        masker=VOI_to_nifti_mask()
+        masker.anonymize_database=root; masker.resample=True; masker.incremental=False
+        converter=Dicom2Nifti()
+        converter.resample=True
+        resampler=ResampleNifti4Clara()
+        resampler.imgpath=os.path.join(root,'nifti'); resampler.savepath=os.path.join(root,'out')
+        compressor=ResampleNifti4Clara()
+        compressor.savepath=os.path.join(root,'compress')
+
+        # one polygon with many vertices covering a quarter of the slice
+        angle=np.linspace(0,2*np.pi,self.voi_vertices*10,endpoint=False)
+        rows=(self.dicom_size[1]/2+self.dicom_size[1]/4*np.sin(angle)).astype(int)
+        cols=(self.dicom_size[0]/2+self.dicom_size[0]/4*np.cos(angle)).astype(int)
+
+        def restore_nii():
+            # compress_nii replaces every .nii by a .nii.gz, start each repeat from the uncompressed files
+            for file in os.listdir(compressor.savepath):
+                os.remove(os.path.join(compressor.savepath,file))
+            for file in os.listdir(os.path.join(root,'nii')):
+                shutil.copyfile(os.path.join(root,'nii',file),os.path.join(compressor.savepath,file))
+
+        nii_bytes=self.nifti_files*self.nifti_size[0]*self.nifti_size[1]*self.nifti_size[2]*2
+        return {
+            'get_ROI_slice_loc':{'func':lambda: ParseVOI().get_ROI_slice_loc(voi_path),'items':self.voi_slices},
+            'mask_coord_dict':{'func':lambda: masker.mask_coord_dict(database='db',patient_dir='pt0',type='wp_bt.voi'),
+                               'items':self.voi_slices},
+            'poly2mask':{'func':lambda: masker.poly2mask(rows,cols,self.dicom_size[1::-1]),'nbytes':slice_bytes},
+            'create_nifti_mask':{'func':lambda: masker.create_nifti_mask(database='db',patient_dir='pt0',type='wp_bt.voi'),
+                                 'setup':reference_cache.clear,'nbytes':volume_bytes},
+            'Dicom_series_Reader':{'func':lambda: converter.Dicom_series_Reader(t2_dir,os.path.join(root,'out'),'t2.nii.gz'),
+                                   'setup':reference_cache.clear,'items':self.dicom_size[2],'nbytes':volume_bytes*2},
+            'resample_img':{'func':lambda: resampler.resample_img(os.path.join(root,'nifti','img_0.nii.gz'),'img_0.nii.gz'),
+                            'nbytes':self.nifti_size[0]*self.nifti_size[1]*self.nifti_size[2]*2},
+            'compress_nii':{'func':compressor.compress_nii,'setup':restore_nii,
+                            'items':self.nifti_files,'nbytes':nii_bytes},
+        }
+
+    def save(self,results):
+        '''save results with the commit, machine and benchmark settings to outdir/<commit>.json'''
+
+        commit=git_commit()
+        out={'commit':commit,'created':time.strftime('%Y-%m-%dT%H:%M:%S'),'machine':platform.platform(),
+             'python':platform.python_version(),'cpus':os.cpu_count(),
+             'params':{'repeats':self.repeats,'dicom_size':self.dicom_size,'voi_slices':self.voi_slices,
+                       'voi_contours':self.voi_contours,'voi_vertices':self.voi_vertices,'nifti_size':self.nifti_size,
+                       'nifti_files':self.nifti_files},
+             'results':results}
+        if not os.path.exists(self.outdir):
+            os.makedirs(self.outdir)
+        path=os.path.join(self.outdir,'{}.json'.format(commit or time.strftime('%Y%m%d-%H%M%S')))
+        with open(path,'w') as outfile:
+            json.dump(out,outfile,indent=2)
+        print('results saved to {}'.format(path))
+        return out
+
+
+def git_commit():
+    '''short hash of the checked out commit, None outside a git repository'''
+    try:
+        return subprocess.check_output(['git','rev-parse','--short','HEAD'],cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path,new_path):
+    '''print the change in best time between two saved runs, ratio < 1 is faster'''
+
+    with open(old_path) as f:
+        old=json.load(f)
+    with open(new_path) as f:
+        new=json.load(f)
+    print('{:<22}{:>12}{:>12}{:>8}'.format('benchmark',old['commit'] or 'old',new['commit'] or 'new','ratio'))
+    for name in new['results']:
+        if name not in old['results']:
+            continue
+        a=old['results'][name]['best_s']; b=new['results'][name]['best_s']
+        print('{:<22}{:>12.4f}{:>12.4f}{:>8.2f}'.format(name,a,b,b/a))
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='benchmark the pipeline on synthetic data')
+    parser.add_argument('names',nargs='*',help='benchmarks to run, all by default')
+    parser.add_argument('--repeats',type=int,default=5)
+    parser.add_argument('--compare',nargs=2,metavar=('OLD','NEW'),help='compare two saved result files and exit')
+    args=parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+    c=Benchmark()
+    c.repeats=args.repeats
+    c.run(names=args.names)
@@ -0,0 +1,117 @@
+#author @t_sanf
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+
+
+class BuildManifest:
+    '''
+    persistent record of what each pipeline stage has already built, stored in a small sqlite file
+    -- one row per (stage, key), e.g. ('dicom2nifti', 'batch4/patient_1'), with the input files, the parameters and
+       the outputs of the last successful run
+    -- a task is up to date when its parameters are unchanged, its outputs exist and every input file matches
+    -- input files are compared on size and mtime, a missing input makes the task out of date
+    -- with content_hash, a file that was touched but has the same content (same sha1) still counts as unchanged,
+       off by default since record hashes every input (every dicom of a series) in the calling process
+    '''
+
+    def __init__(self,path,content_hash=False):
+        '''
+        :param path (str): path to the sqlite file, created if needed
+        :param content_hash (bool): store sha1 of every input file so touched-but-identical files are not rebuilt
+        '''
+        self.path=path
+        self.content_hash=content_hash
+        self._hashes={}
+        self._query('''create table if not exists builds (
+                        stage text, key text, inputs text, params text, outputs text, updated real,
+                        primary key (stage, key))''')
+
+    def _query(self,sql,args=()):
+        '''run one statement in its own transaction, the connection is not kept open between calls'''
+        db=sqlite3.connect(self.path,timeout=60)
+        try:
+            with db:
+                return db.execute(sql,args).fetchall()
+        finally:
+            db.close()
+
+    def file_hash(self,path):
+        '''sha1 of a file, remembered per (path, size, mtime) so series shared by several tasks are hashed once'''
+        stat=os.stat(path)
+        key=(path,stat.st_size,stat.st_mtime_ns)
+        if key not in self._hashes:
+            sha=hashlib.sha1()
+            with open(path,'rb') as f:
+                for block in iter(lambda: f.read(1024*1024),b''):
+                    sha.update(block)
+            self._hashes[key]=sha.hexdigest()
+        return self._hashes[key]
+
+    def fingerprint(self,paths):
+        '''{path: [size, mtime_ns, sha1 or None]} for every input file'''
+        fingerprint={}
+        for path in sorted(paths):
+            stat=os.stat(path)
+            sha=self.file_hash(path) if self.content_hash else None
+            fingerprint[path]=[stat.st_size,stat.st_mtime_ns,sha]
+        return fingerprint
+
+    def is_current(self,stage,key,inputs,params,outputs=None):
+        '''
+        check if a task has to be rebuilt
+        :param stage (str): name of the pipeline stage
+        :param key (str): task id within the stage, e.g. database/patient
+        :param inputs (list): paths of every file the task reads
+        :param params (dict): settings that change the output (spacing, interpolator ...), must be json serializable
+        :param outputs (list): paths the task writes, defaults to the outputs stored at the last run
+                               (a .nii output that was compressed to .nii.gz afterwards still counts)
+        :return: True if the stored build is still valid
+        '''
+
+        rows=self._query('select inputs, params, outputs from builds where stage=? and key=?',(stage,key))
+        if not rows:
+            return False
+        stored_inputs=json.loads(rows[0][0]); stored_params=rows[0][1]; stored_outputs=json.loads(rows[0][2])
+
+        if stored_params!=json.dumps(params,sort_keys=True):
+            return False
+        if outputs is None:
+            outputs=stored_outputs
+        if not all(os.path.exists(path) or os.path.exists(path+'.gz') for path in outputs):
+            return False
+        if sorted(stored_inputs)!=sorted(inputs):
+            return False
+
+        for path in inputs:
+            size,mtime,sha=stored_inputs[path]
+            if not os.path.isfile(path):
+                return False
+            stat=os.stat(path)
+            if stat.st_size!=size:
+                return False
+            if stat.st_mtime_ns!=mtime and (sha is None or self.file_hash(path)!=sha):
+                return False
+        return True
+
+    def record(self,stage,key,inputs,params,outputs):
+        '''store a successful build, replaces the previous record of the same task'''
+        row=(stage,key,json.dumps(self.fingerprint(inputs)),json.dumps(params,sort_keys=True),json.dumps(sorted(outputs)),time.time())
+        self._query('insert or replace into builds values (?,?,?,?,?,?)',row)
+
+    def forget(self,stage,key=None):
+        '''drop the record of one task, or of a whole stage if key is None, so it is rebuilt on the next run'''
+        if key is None:
+            self._query('delete from builds where stage=?',(stage,))
+        else:
+            self._query('delete from builds where stage=? and key=?',(stage,key))
+
+
+def list_files(directory):
+    '''all files directly inside a directory, empty list if it does not exist'''
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory,file) for file in sorted(os.listdir(directory)) if os.path.isfile(os.path.join(directory,file))]
@@ -1,8 +1,22 @@
 import os
-import nibabel as nib
 import random
 import shutil
 import json
+from nifti_io import compress_nii_files, find_nii_files
+from dataset_index import DatasetIndex
+from instrumentation import run_report
+
+# header of every datalist.json written by clara_filestructure
+CLARA_HEADER = {
+
+    "description": "Awesome",
+    "modality": {"0": "T2"},
+    "labels": {"0": "background", "1": "WP"},
+    "reference": "SUNY",
+    "tensorImageSize": "3D",
+    "name": "Prostate",
+
+}
 
 
 class ToClaraFormat:
@@ -22,17 +36,28 @@ class ToClaraFormat:
         self.basepath='/home/tom/clara_experiments/data_prostate'            #path to directory that contains files 'all_files'
         self.clarapath='/workspace/data/data_prostate/'
         self.center='SUNY_wp_for_clara'
+        self.materialize='copy'     #how dataset files are placed: 'copy', 'hardlink', 'reflink', 'symlink' or 'manifest' (datalist.json only)
+        self.report=run_report      #per patient, per stage timings, see instrumentation.RunReport
+        self.mask_file=None         #mask file taken by sort_data, e.g. 'labels_resampled.nii.gz' for fused label volumes, None searches for the wp mask
+        self.labels=None            #"labels" section of datalist.json, e.g. VOI_to_nifti_mask().label_names(), None keeps CLARA_HEADER
 
-    def clara_filestructure(self, i_name='img', s_name='seg', val_p=0.2, train_val_n=['training', 'validation'],resample=False):
+    def clara_filestructure(self, i_name='img', s_name='seg', val_p=0.2, train_val_n=['training', 'validation'],resample=False,materialize=None,folds=0,seed=0):
         '''
         takes images and labels and splits them into train, val_test and creates .json
         note - basepath is the path with the directory 'all_files' within it
         :param i_name: (str) name of image files
         :param s_name: (str) name of segmentation files
         :param val_p (float) percent in validation dataset
+        :param materialize (str) how split files are created, see materialize_file, defaults to self.materialize
+            -- 'manifest' creates no files at all, datalist.json points at the files in the center directory
+        :param folds (int) also write datalist_fold<i>.json for k-fold cross validation (pointing at the center directory)
+        :param seed (int) random seed of the split
         :return:
         '''
 
+        if materialize is None:
+            materialize=self.materialize
+
         # set up file structure
         path = os.path.join(self.basepath, self.center)  # replace if you have a different file name
 
@@ -41,85 +66,106 @@ class ToClaraFormat:
             os.mkdir(os.path.join(self.basepath, self.center + '_split'))
         s_path=os.path.join(self.basepath, self.center + '_split')
 
-        # find all image files and all segmentation files
-        img_dir = []; seg_dir = []
-        for file in os.listdir(path):
-            if file.split("_")[0] == i_name: img_dir += [file]
-            if file.split("_")[0] == s_name: seg_dir += [file]
-
-        # check all images have a counterpart
-        for img in sorted(img_dir):
-            if not s_name+'_' + img.split('_')[1].split('.')[0] + '.nii.gz' in seg_dir:
-                print('img {} does not have a segmentation!').format(img)
-                raise ValueError
+        # index all image and segmentation files in one scan, check all images have a counterpart
+        index = DatasetIndex(i_name=i_name, s_name=s_name).scan(path)
+        index.validate()
 
         # split data into training and validation datasets
-        val_sample = random.sample(img_dir, int(len(img_dir) * val_p))
-        train_sample = set(img_dir) - set(val_sample)
-        sample_dict = {train_val_n[0]: train_sample, train_val_n[1]: val_sample}
-        for key in sample_dict.keys():
-            if not os.path.exists(os.path.join(s_path, key)):
-                os.mkdir(os.path.join(s_path, key))
-            [shutil.copy2(os.path.join(path, file), os.path.join(s_path, key, file)) for file in
-             sample_dict[key]]
-            [shutil.copy2(os.path.join(path, s_name + '_' + file.split('_')[1]),
-                          os.path.join(s_path, key, s_name + '_' + file.split('_')[1])) for file in
-             sample_dict[key]]
-
-        # building data structure to save as json file
-        json_d = {
-
-            "description": "Awesome",
-            "modality": {"0": "T2"},
-            "labels": {"0": "background", "1": "WP"},
-            "reference": "SUNY",
-            "tensorImageSize": "3D",
-            "name": "Prostate",
-
-        }
-        for db in train_val_n:
-            db_l = []
-            for file in os.listdir(os.path.join(s_path, db)):
-                if file.split('_')[0] == i_name:
-                    db_l += [{'image': os.path.join(self.clarapath,self.center+'_split', db, file),
-                              'label': os.path.join(self.clarapath,self.center+'_split', db,
-                                                    s_name + '_' + file.split('_')[1])}]
-            json_d[db] = db_l
-
-        # saving as json file
-        with open(os.path.join(s_path, 'datalist.json'), 'w') as outfile:
-            json.dump(json_d, outfile,indent=2)
+        sample_dict = index.split_random(val_p=val_p, seed=seed, names=train_val_n)
+        if materialize != 'manifest':
+            for key in sample_dict.keys():
+                if not os.path.exists(os.path.join(s_path, key)):
+                    os.mkdir(os.path.join(s_path, key))
+                for id in sample_dict[key]:
+                    with self.report.patient(id), self.report.stage('place'):
+                        for file in index.entries[id].values():
+                            materialize_file(os.path.join(path, file), os.path.join(s_path, key, file), mode=materialize)
+
+        # datalists are built from the index, no directory is listed again
+        if materialize == 'manifest':
+            prefix = os.path.join(self.clarapath, self.center)
+        else:
+            prefix = {db: os.path.join(self.clarapath, self.center+'_split', db) for db in train_val_n}
+        # saving as json file, k-fold variants are written in the same pass and point at the center directory
+        index.write_datalists({'datalist.json': sample_dict}, s_path, self.datalist_header(), prefix=prefix)
+        if folds:
+            folds = index.split_kfold(k=folds, seed=seed, names=train_val_n)
+            index.write_datalists({'datalist_fold{}.json'.format(i): fold for i,fold in enumerate(folds)}, s_path,
+                                  self.datalist_header(), prefix=os.path.join(self.clarapath, self.center))
+
+    def clara_datalists_by_center(self, center_sizes=None, i_name='img', s_name='seg', val_p=0.2, seed=0):
+        '''
+        federated learning datalists without moving or copying any file
+        -- ids are assigned to centers at random (same idea as random_split_by_center), then split into
+           training/validation inside each center
+        -- writes datalist_<center>.json for every center and datalist_central.json with the union of all centers,
+           all from one scan of the center directory, paths point at the files in the center directory
+        :param center_sizes (dict) number of patients per center, defaults to 100 each for UCLA, NCI and SUNY
+        '''
+
+        if center_sizes is None:
+            center_sizes = {'UCLA': 100, 'NCI': 100, 'SUNY': 100}
+        path = os.path.join(self.basepath, self.center)
+        s_path = os.path.join(self.basepath, self.center + '_split')
+        if not os.path.exists(s_path):
+            os.mkdir(s_path)
+
+        index = DatasetIndex(i_name=i_name, s_name=s_name).scan(path)
+        index.validate()
+        centers = index.split_federated(index.split_by_center(center_sizes, seed=seed, leftover=None), val_p=val_p, seed=seed)
+
+        variants = {'datalist_{}.json'.format(center): split for center,split in centers.items()}
+        variants['datalist_central.json'] = {section: sorted(id for split in centers.values() for id in split[section])
+                                             for section in ('training', 'validation')}
+        return index.write_datalists(variants, s_path, self.datalist_header(), prefix=os.path.join(self.clarapath, self.center))
+
+    def datalist_header(self):
+        '''CLARA_HEADER with the labels of this dataset'''
+        header = dict(CLARA_HEADER)
+        if self.labels is not None:
+            header['labels'] = self.labels
+        return header
 
 
     def sort_data(self,anon=True):
-        '''make savedir and sort img and seg files into the savedirectory properly labeled'''
+        '''make savedir and sort img and seg files into the savedirectory properly labeled
+        -- files are placed with self.materialize, 'manifest' falls back to symlinks here since the renamed
+           img_/seg_ files have to exist for clara_filestructure
+        '''
 
         basepath=self.rootdir
+        mode='symlink' if self.materialize=='manifest' else self.materialize
         prostateX_n='SUNY_prostates'
         savedir='SUNY_prostates_for_clara'
 
         print("copying files")
         for pt in sorted(os.listdir(os.path.join(basepath,prostateX_n))):
-            mask_name=find_file_by_annotator(os.path.join(basepath, prostateX_n,pt,'nifti','mask'))
-            if mask_name==None:
-                print("mask not found for patient {}".format(pt))
-                continue
-            if anon==True:
-                anon_pt=str(random.randint(1000000000,9999999999))
-                mask_path=os.path.join(basepath,prostateX_n,pt,'nifti','mask',mask_name)
-                shutil.copy2(mask_path,os.path.join(basepath,savedir,'seg_'+anon_pt+'.nii'))
-                img_file_path=os.path.join(basepath, prostateX_n,pt,'nifti','t2','t2_resampled.nii.gz')
-                shutil.copy2(img_file_path,os.path.join(basepath,savedir,'img_'+anon_pt+'.nii.gz'))
-
-            else:
-                mask_path=os.path.join(basepath,prostateX_n,pt,'nifti','mask',mask_name)
-                shutil.copy2(mask_path,os.path.join(basepath,savedir,'seg_'+pt.split('_')[0]+'.nii'))
-                img_file_path=os.path.join(basepath, prostateX_n,pt,'nifti','t2','t2_resampled.nii.gz')
-                shutil.copy2(img_file_path,os.path.join(basepath,savedir,'img_'+pt.split('_')[0]+'.nii.gz'))
-
-        #compress all the uncompressed nifti files
+            with self.report.patient(pt), self.report.stage('place'):
+                if self.mask_file is not None:
+                    mask_name=self.mask_file if os.path.exists(os.path.join(basepath, prostateX_n,pt,'nifti','mask',self.mask_file)) else None
+                else:
+                    mask_name=find_file_by_annotator(os.path.join(basepath, prostateX_n,pt,'nifti','mask'))
+                if mask_name==None:
+                    print("mask not found for patient {}".format(pt))
+                    continue
+                mask_ext='.nii.gz' if mask_name.endswith('.nii.gz') else '.nii'
+                if anon==True:
+                    anon_pt=str(random.randint(1000000000,9999999999))
+                    mask_path=os.path.join(basepath,prostateX_n,pt,'nifti','mask',mask_name)
+                    materialize_file(mask_path,os.path.join(basepath,savedir,'seg_'+anon_pt+mask_ext),mode=mode)
+                    img_file_path=os.path.join(basepath, prostateX_n,pt,'nifti','t2','t2_resampled.nii.gz')
+                    materialize_file(img_file_path,os.path.join(basepath,savedir,'img_'+anon_pt+'.nii.gz'),mode=mode)
+
+                else:
+                    mask_path=os.path.join(basepath,prostateX_n,pt,'nifti','mask',mask_name)
+                    materialize_file(mask_path,os.path.join(basepath,savedir,'seg_'+pt.split('_')[0]+mask_ext),mode=mode)
+                    img_file_path=os.path.join(basepath, prostateX_n,pt,'nifti','t2','t2_resampled.nii.gz')
+                    materialize_file(img_file_path,os.path.join(basepath,savedir,'img_'+pt.split('_')[0]+'.nii.gz'),mode=mode)
+
+        #compress any uncompressed nifti files left (masks made before they were written as .nii.gz)
         print('compressing files')
-        compress_nii(os.path.join(basepath,savedir))
+        with self.report.stage('compress'):
+            compress_nii(os.path.join(basepath,savedir))
 
     def random_split_by_center(self):
         '''randomply split data into three datasets'''
@@ -155,28 +201,61 @@ class ToClaraFormat:
                 shutil.move(os.path.join(basepath,file),os.path.join(basepath,'leftover',file))
 
 ##########helper functions##########3
-def compress_nii(path):
+FICLONE=0x40049409  # linux ioctl that makes a copy-on-write clone of a file (btrfs, xfs)
+
+def materialize_file(src,dst,mode='copy'):
+    '''place src at dst without duplicating the data where the filesystem allows it
+    :param mode - 'copy' (full copy), 'hardlink', 'reflink' (copy-on-write clone) or 'symlink'
+        -- hardlink/reflink/symlink fall back to a full copy when the filesystem refuses (e.g. across filesystems)
+        -- symlinks are absolute, the source data has to be visible at the same path wherever the dataset is read
+    :return mode that was actually used
+    '''
+    if mode not in ('copy','hardlink','reflink','symlink'):
+        raise ValueError('unknown materialize mode {}'.format(mode))
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    try:
+        if mode=='hardlink':
+            os.link(src,dst)
+            return mode
+        if mode=='symlink':
+            os.symlink(os.path.abspath(src),dst)
+            return mode
+        if mode=='reflink':
+            import fcntl
+            with open(src,'rb') as s_f, open(dst,'wb') as d_f:
+                fcntl.ioctl(d_f.fileno(),FICLONE,s_f.fileno())
+            shutil.copystat(src,dst)
+            return mode
+    except (OSError,ImportError):
+        if os.path.lexists(dst):
+            os.remove(dst)
+
+    shutil.copy2(src,dst)
+    return 'copy'
+
+def compress_nii(path,workers=None,compresslevel=6):
     '''recursively converts .nii files to .nii.gz and removes original .nii file
+    -- raw bytes are streamed through gzip (no nibabel decode/re-encode), files are compressed in parallel and
+       each .nii.gz appears atomically
     :param path - path to directory that contains all files
+    :param workers - number of files compressed at the same time, defaults to the number of cpus
+    :param compresslevel - gzip level 1 (fast) to 9 (small)
 
     '''
-    for file in os.listdir(path):
-        if file.endswith('.nii'):
-            n_f=nib.load(os.path.join(path,file))
-            nib.save(n_f,os.path.join(path,file+'.gz'))
-            os.remove(os.path.join(path, file))
-        if os.path.isdir(os.path.join(path,file)):
-            compress_nii(os.path.join(path,file))
+    compress_nii_files(find_nii_files(path),workers=workers,compresslevel=compresslevel)
 
 def find_file_by_annotator(path='/home/tom/Desktop/prostateX/PEx0000_00000000/nifti/mask',type='wp'):
     for file in sorted(os.listdir(path)):
         #print(file)
-        if len(file.split('_')) < 5:
-            if file== type+'_bt_resampled.nii': return file
-            elif file == type+'_mm_resampled.nii': return file
-            elif file == type+'_ts_resampled.nii': return file
-            elif file == type+'_pseg_resampled.nii':return file
-            elif file == type+'_dk_resampled.nii': return file
+        if len(file.split('_')) < 5 and (file.endswith('.nii') or file.endswith('.nii.gz')):
+            name=file.split('.')[0]
+            if name== type+'_bt_resampled': return file
+            elif name == type+'_mm_resampled': return file
+            elif name == type+'_ts_resampled': return file
+            elif name == type+'_pseg_resampled':return file
+            elif name == type+'_dk_resampled': return file
 
 def build_json_FL(val_p=0.2,center='SUNY',i_name='img',s_name='seg'):
 
@@ -190,18 +269,10 @@ def build_json_FL(val_p=0.2,center='SUNY',i_name='img',s_name='seg'):
         "tensorImageSize": "3D",
 }
 
-    #split data into training and validation datasets
-    files=os.listdir(os.path.join(path,'Image'))
-    val_ids = [file.split('_')[1] for file in random.sample(files, int(len(files) * val_p))]
-    train_ids = [file.split('_')[1] for file in list(set(files) - set(val_ids))]
-    ID_dict={'validation':val_ids,"training":train_ids}
-
-    for sample in ID_dict.keys():
-        db_l = []
-        for id in ID_dict[sample]:
-            db_l += [{'image': os.path.join(center, 'Image', i_name+'_'+id),
-                      'label': os.path.join(center, 'Mask', s_name+'_'+id)}]
-        json_d[sample] = db_l
+    #index Image and Mask in one scan, pair by id and split data into training and validation datasets
+    index=DatasetIndex(i_name=i_name,s_name=s_name).scan(os.path.join(path,'Image'),label_path=os.path.join(path,'Mask'),root=path)
+    index.validate()
+    json_d=index.datalist(index.split_random(val_p=val_p,names=('training','validation')),json_d,prefix=center)
 
     #saving as json file
     with open(os.path.join(os.path.dirname(path),'Json', 'datalist.json'), 'w') as outfile:
@@ -0,0 +1,175 @@
+#author @t_sanf
+
+import os
+import json
+import random
+from concurrent.futures import ThreadPoolExecutor
+import nibabel as nib
+
+
+def split_name(file,prefixes):
+    '''
+    split a clara style file name into (prefix, id), e.g. 'img_0012.nii.gz' -> ('img', '0012')
+    :return: None if the file is not a nifti file starting with one of the prefixes
+    '''
+    if file.endswith('.nii.gz'):
+        stem=file[:-len('.nii.gz')]
+    elif file.endswith('.nii'):
+        stem=file[:-len('.nii')]
+    else:
+        return None
+    prefix=stem.split('_')[0]
+    if prefix not in prefixes or '_' not in stem:
+        return None
+    return prefix,stem[len(prefix)+1:]
+
+
+class DatasetIndex:
+    '''
+    in-memory index of a clara dataset, id -> {'image': path, 'label': path}
+    -- built from a single directory scan, pairing images with labels is a dict lookup (O(n) overall)
+    -- every split (random, stratified, per center, k-fold, federated) is computed from the index,
+       datalist.json files for all of them are written without listing any directory again
+    -- paths are stored relative to root, so datalists can point into another mount (e.g. /workspace/data in clara)
+    '''
+
+    def __init__(self,i_name='img',s_name='seg'):
+        self.i_name=i_name
+        self.s_name=s_name
+        self.entries={}
+        self.root=None
+
+    def scan(self,path,label_path=None,root=None):
+        '''
+        index one directory of img_/seg_ files, or an image directory and a label directory
+        :param path (str): directory with the images (and the labels if label_path is None)
+        :param label_path (str): separate directory with the labels
+        :param root (str): paths are stored relative to this directory, defaults to path
+        :return: self
+        '''
+
+        self.root=path if root is None else root
+        directories=[path] if label_path is None else [path,label_path]
+        keys={self.i_name:'image',self.s_name:'label'}
+        for directory in directories:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    parsed=split_name(entry.name,keys)
+                    if parsed is None or not entry.is_file():
+                        continue
+                    prefix,id=parsed
+                    self.entries.setdefault(id,{})[keys[prefix]]=os.path.relpath(entry.path,self.root)
+        return self
+
+    def ids(self):
+        '''ids that have both an image and a label, sorted'''
+        return sorted(id for id,entry in self.entries.items() if 'image' in entry and 'label' in entry)
+
+    def unpaired(self):
+        '''ids missing either the image or the label'''
+        return sorted(id for id,entry in self.entries.items() if 'image' not in entry or 'label' not in entry)
+
+    def validate(self,check_headers=False,workers=None):
+        '''
+        raise ValueError if an image has no label (or the reverse)
+        :param check_headers (bool): also read the nifti headers of every pair (in a thread pool) and check
+                                     that image and label have the same shape
+        :param workers (int): number of threads for the header check
+        '''
+
+        missing=self.unpaired()
+        if missing:
+            raise ValueError('{} ids do not have both an image and a segmentation: {}'.format(len(missing),missing))
+        if not check_headers:
+            return
+
+        def shapes(id):
+            entry=self.entries[id]
+            return id,[nib.load(os.path.join(self.root,entry[key])).header.get_data_shape()[:3] for key in ('image','label')]
+
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            mismatch=[id for id,(img,seg) in pool.map(shapes,self.ids()) if img!=seg]
+        if mismatch:
+            raise ValueError('image and segmentation shapes differ for {}'.format(mismatch))
+
+    def split_random(self,val_p=0.2,seed=0,names=('training','validation')):
+        '''random train/validation split, {names[0]: ids, names[1]: ids}'''
+        ids=self.ids()
+        val=set(random.Random(seed).sample(ids,int(len(ids)*val_p)))
+        return {names[0]:[id for id in ids if id not in val],names[1]:sorted(val)}
+
+    def split_stratified(self,groups,val_p=0.2,seed=0,names=('training','validation')):
+        '''
+        train/validation split that keeps the proportion of every group, e.g. groups={id: 'PIRADS4', ...}
+        :param groups (dict): id -> group label, ids without a group are put in group None
+        '''
+        rng=random.Random(seed)
+        by_group={}
+        for id in self.ids():
+            by_group.setdefault(groups.get(id),[]).append(id)
+        split={names[0]:[],names[1]:[]}
+        for group in sorted(by_group,key=str):
+            members=by_group[group]
+            val=set(rng.sample(members,int(len(members)*val_p)))
+            split[names[0]]+=[id for id in members if id not in val]
+            split[names[1]]+=sorted(val)
+        return split
+
+    def split_by_center(self,center_sizes,seed=0,leftover='leftover'):
+        '''
+        randomly assign ids to centers without overlap, e.g. {'UCLA': 100, 'NCI': 100, 'SUNY': 100}
+        :return: {center: ids}, ids that were not assigned go to the leftover key
+        '''
+        ids=self.ids()
+        random.Random(seed).shuffle(ids)
+        split={}; start=0
+        for center,size in center_sizes.items():
+            split[center]=sorted(ids[start:start+size])
+            start+=size
+        if leftover is not None:
+            split[leftover]=sorted(ids[start:])
+        return split
+
+    def split_kfold(self,k=5,seed=0,names=('training','validation')):
+        '''k train/validation splits, every id is in exactly one validation fold'''
+        ids=self.ids()
+        random.Random(seed).shuffle(ids)
+        folds=[sorted(ids[i::k]) for i in range(k)]
+        return [{names[0]:sorted(id for j,fold in enumerate(folds) if j!=i for id in fold),names[1]:folds[i]}
+                for i in range(k)]
+
+    def split_federated(self,center_split,val_p=0.2,seed=0,names=('training','validation')):
+        '''train/validation split inside every center of a split_by_center result, {center: {name: ids}}'''
+        rng=random.Random(seed)
+        split={}
+        for center,ids in center_split.items():
+            val=set(rng.sample(ids,int(len(ids)*val_p)))
+            split[center]={names[0]:[id for id in ids if id not in val],names[1]:sorted(val)}
+        return split
+
+    def datalist(self,split,header,prefix=''):
+        '''
+        clara datalist for one split
+        :param split (dict): {section name: ids}, e.g. the output of split_random
+        :param header (dict): description, modality, labels ... copied to the top of the datalist
+        :param prefix (str or dict): path prepended to every stored relative path, or {section: path}
+        '''
+        json_d=dict(header)
+        for section,ids in split.items():
+            section_prefix=prefix[section] if isinstance(prefix,dict) else prefix
+            json_d[section]=[{'image':os.path.join(section_prefix,self.entries[id]['image']),
+                              'label':os.path.join(section_prefix,self.entries[id]['label'])} for id in ids]
+        return json_d
+
+    def write_datalists(self,variants,out_dir,header,prefix=''):
+        '''
+        write several datalist variants from the same index in one pass
+        :param variants (dict): {file name: split}, e.g. {'datalist.json': split, 'datalist_fold0.json': folds[0]}
+        :return: list of written paths
+        '''
+        written=[]
+        for name,split in variants.items():
+            with open(os.path.join(out_dir,name),'w') as outfile:
+                json.dump(self.datalist(split,header,prefix=prefix),outfile,indent=2)
+            written+=[os.path.join(out_dir,name)]
+        return written
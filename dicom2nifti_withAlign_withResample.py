@@ -1,15 +1,22 @@
 #author @t_sanf / @sharm
 from parsing_VOI import *
+from batch_runner import run_tasks, log_failure, is_transient, TRANSIENT_ERRORS
+from work_queue import WorkQueue
+from dicom_io import read_dicom_series, reference_cache, SeriesPrefetcher
+from resampling import ResampleEngine
+from roi_crop import record_path
+from build_manifest import BuildManifest, list_files
+from instrumentation import run_report, report_path
 import pydicom
 import math
 import nibabel
 import re
 #import dicom2nifti
 import shutil
+import traceback
 import SimpleITK as sitk
 import pydicom as dicom
 import os
-import numpy as np
 
 class Dicom2Nifti():
 
@@ -17,124 +24,279 @@ class Dicom2Nifti():
         self.basePATH = '/home/tom/Desktop/'
         self.databases=['prostateX']
         self.resample = True #this flag will make a directory with resampled images to 1x1x1
+        self.resampler = ResampleEngine(new_spacing=[1,1,1]) #spacing/interpolators used when resample is on
+        self.roi_crop = None #roi_crop.RoiCrop(margin=10) crops the resampled series to the gland (wp voi), None keeps the full field of view
+        self.workers = 1 #number of patients converted in parallel (process pool)
+        self.reference_cache = reference_cache #decoded t2 series shared with the masking pipeline
+        self.incremental = True #only convert patients whose dicoms or settings changed since the last run
+        self.manifest_path = None #build manifest file, defaults to basePATH/build_manifest.sqlite
+        self.manifest = None
+        self.report = run_report #per patient, per stage timings, see instrumentation.RunReport
+        self.prefetch_depth = 0 #series copied to local scratch ahead of time (for network shares), 0 reads in place, serial runs only
+        self.prefetch_bytes = 2*1024**3 #byte budget of the prefetched series waiting in scratch
+        self.prefetch_dir = None #local scratch directory, defaults to /dev/shm
+        self.prefetcher = None
+        self.retries = 2 #extra attempts for a patient failing with a transient i/o error (or timing out)
+        self.retry_on = TRANSIENT_ERRORS #exception types that count as transient, os errors only with a transient errno (batch_runner.is_transient)
+        self.task_timeout = None #seconds one patient may take before it is killed (and retried), None for no limit
+        self.ledger_path = None #failures with their tracebacks (json lines), defaults to basePATH/failures.jsonl
+        self.queue_path = None #work queue shared by the workers of a sharded run, defaults to basePATH/work_queue.sqlite
+        self.lease_seconds = 600 #a patient claimed by a worker that stops renewing it is handed to another worker after this
 
-    def dicom_to_nifti(self,t2_only=False):
+    def dicom_to_nifti(self,t2_only=False,workers=None):
         '''
         convert all dicom files in each database to .nifti format
-        :return:
+        -- every patient is recorded in the build manifest as soon as it finishes, an interrupted run resumes
+           at the first unfinished patient
+        -- failed patients and series are appended to the failure ledger with their tracebacks
+        :param t2_only (bool): only convert the t2 series
+        :param workers (int): number of patients converted in parallel, defaults to self.workers
+        :return: list of patients/series that could not be converted
         '''
 
         databases = self.databases
+        if workers is None:
+            workers=self.workers
 
         if t2_only==True:
             series_all=['t2']
         else:
             series_all=['t2','adc','highb']
 
+        tasks=self.conversion_tasks(series_all)
+
+        #copy the next patients' dicoms to local scratch while the current one is converted
+        if self.prefetch_depth>0 and self.task_timeout is None and (workers is None or workers<=1 or len(tasks)<=1):
+            self.prefetcher=SeriesPrefetcher(depth=self.prefetch_depth,max_bytes=self.prefetch_bytes,scratch_dir=self.prefetch_dir)
+            self.prefetcher.prefetch([os.path.join(self.basePATH,database,patient,'dicoms',series)
+                                      for database,patient,series_all in tasks for series in series_all])
+        try:
+            done,failed=run_tasks(self.convert_patient,tasks,workers=workers,name='nifti conversion',retries=self.retries,
+                                  retry_on=self.retry_on,timeout=self.task_timeout,on_done=self.record_patient,
+                                  ledger=self.get_ledger_path())
+        finally:
+            if self.prefetcher is not None:
+                self.prefetcher.close()
+                self.prefetcher=None
+
         exception_logger=[]
-        for database in databases:
-            ptlist = self.check_for_nifti_completion()
-            #print(ptlist)
-            for patient in sorted(self.check_for_nifti_completion()):
-                print("converting files to nifti for patient {}".format(patient))
-
-                #make nifti file if one does not already exist
-                if not os.path.exists(os.path.join(self.basePATH, database, patient,'nifti')):
-                    os.mkdir(os.path.join(self.basePATH, database, patient,'nifti'))
-
-                for series in series_all:
-                    dicom_name = series
-                    nifti_name = series
-
-                    #make folder if not already made:
-                    if not os.path.exists(os.path.join(self.basePATH,database,patient,'nifti',nifti_name)):
-                        os.mkdir(os.path.join(self.basePATH,database,patient,'nifti',nifti_name))
-
-                    dicom_directory=os.path.join(self.basePATH,database,patient,'dicoms',dicom_name)
-                    nifti_directory=os.path.join(self.basePATH, database, patient, 'nifti', nifti_name)
-                    try:
-                        if series == 't2':
-                            self.Dicom_series_Reader(dicom_directory, nifti_directory, nifti_name + '.nii.gz')
-
-                        if series == 'adc' or series == 'highb':
-                            filter = self.dicom_series_define_reference(os.path.join(self.basePATH,database,patient,'dicoms','t2'))
-                            self.Dicom_series_Reader_withReference(dicom_directory, nifti_directory,nifti_name+'.nii.gz',filter)
-                    except:
-                        print('error for ' + dicom_directory)
+        for task,errors in done:
+            exception_logger+=[dicom_directory for dicom_directory,error in errors]
+        for task,error in failed:
+            print(error)
+            exception_logger+=[os.path.join(self.basePATH,task[0],task[1])]
 
         print("the following patients still need to be processed {}".format(exception_logger))
+        return exception_logger
+
+    def run_worker(self,run,t2_only=False):
+        '''
+        one worker of a sharded conversion, start it on any number of processes/nodes that see basePATH
+        -- every worker queues the patients that are not up to date, then claims them one at a time from the shared
+           work queue (see work_queue.WorkQueue) until every patient is done, each patient is converted exactly once
+        -- a patient is queued once per run, every launch needs a new run (work_queue.new_run_id) or the patients that
+           changed since are already done in the queue and silently skipped, workers joining a run pass its name
+        -- python work_queue.py nifti <basePATH> --databases ... --processes N starts N workers on this machine
+        :param run (str): name of the run, shared by every worker of the run
+        :param t2_only (bool): only convert the t2 series
+        :return: list of patients/series that failed in this worker
+        '''
+
+        series_all=['t2'] if t2_only==True else ['t2','adc','highb']
+        queue=self.get_queue()
+        stage='dicom2nifti/'+run
+        queue.add(stage,self.conversion_tasks(series_all))
+        done,failed=queue.work(stage,self.convert_patient,name='nifti conversion',on_done=self.record_patient,
+                               ledger=self.get_ledger_path(),retries=self.retries,retry_on=self.retry_on,
+                               timeout=self.task_timeout)
+
+        exception_logger=[]
+        for task,errors in done:
+            exception_logger+=[dicom_directory for dicom_directory,error in errors]
+        for task,error in failed:
+            exception_logger+=[os.path.join(self.basePATH,task[0],task[1])]
+        print("the following patients failed in this worker {}".format(exception_logger))
+        return exception_logger
+
+    def conversion_tasks(self,series_all):
+        '''(database, patient, series_all) of every patient that still needs to be converted'''
+        tasks=[]
+        for database in self.databases:
+            for patient in sorted(self.check_for_nifti_completion(database,series_all=series_all)):
+                tasks+=[(database,patient,series_all)]
+        return tasks
+
+    def get_queue(self):
+        '''work queue of sharded runs, kept next to the build manifest'''
+        if self.queue_path is None:
+            self.queue_path=os.path.join(self.basePATH,'work_queue.sqlite')
+        return WorkQueue(self.queue_path,lease_seconds=self.lease_seconds,max_attempts=self.retries+1)
+
+    def convert_patient(self,database,patient,series_all):
+        '''
+        convert each series of a single patient to nifti, runs independently of every other patient
+        :return: list of (dicom directory, traceback) that could not be converted
+        '''
+
+        with self.report.patient(database+'/'+patient):
+            return self.convert_series(database,patient,series_all)
+
+    def record_patient(self,task,errors):
+        '''checkpoint one finished patient: record it in the build manifest, or its failed series in the ledger'''
+        if not errors:
+            self.get_manifest().record('dicom2nifti',task[0]+'/'+task[1],*self.nifti_build_info(*task))
+        for dicom_directory,error in errors:
+            log_failure(self.get_ledger_path(),'nifti conversion',dicom_directory,error)
+
+    def get_ledger_path(self):
+        '''failure ledger kept next to the build manifest'''
+        if self.ledger_path is None:
+            self.ledger_path=os.path.join(self.basePATH,'failures.jsonl')
+        return self.ledger_path
+
+    def convert_series(self,database,patient,series_all):
+        '''convert_patient without setting the patient of the run report'''
+
+        errors=[]
+
+        #make nifti file if one does not already exist
+        if not os.path.exists(os.path.join(self.basePATH, database, patient,'nifti')):
+            os.mkdir(os.path.join(self.basePATH, database, patient,'nifti'))
+
+        for series in series_all:
+            dicom_name = series
+            nifti_name = series
+
+            #make folder if not already made:
+            if not os.path.exists(os.path.join(self.basePATH,database,patient,'nifti',nifti_name)):
+                os.mkdir(os.path.join(self.basePATH,database,patient,'nifti',nifti_name))
+
+            dicom_directory=os.path.join(self.basePATH,database,patient,'dicoms',dicom_name)
+            nifti_directory=os.path.join(self.basePATH, database, patient, 'nifti', nifti_name)
+            try:
+                if series == 't2':
+                    self.Dicom_series_Reader(dicom_directory, nifti_directory, nifti_name + '.nii.gz')
+
+                if series == 'adc' or series == 'highb':
+                    filter = self.dicom_series_define_reference(os.path.join(self.basePATH,database,patient,'dicoms','t2'))
+                    self.Dicom_series_Reader_withReference(dicom_directory, nifti_directory,nifti_name+'.nii.gz',filter)
+            except Exception as e:
+                if is_transient(e,self.retry_on):
+                    raise  #transient, run_tasks retries the whole patient
+                errors+=[(dicom_directory,traceback.format_exc())]
+
+        return errors
 
     def Dicom_series_Reader(self,Input_path, Output_path, savename):
         #print("Reading Dicom directory:", Input_path)
-        reader = sitk.ImageSeriesReader()
-        dicom_names = reader.GetGDCMSeriesFileNames(Input_path)
-        reader.SetFileNames(dicom_names)
-        image = reader.Execute()
-        sitk.WriteImage(image, os.path.join(Output_path,savename))
+        with self.report.stage('dicom_read'):
+            image = self.reference_cache.get(Input_path,reader=self.read_series)
+        with self.report.stage('write'):
+            sitk.WriteImage(image, os.path.join(Output_path,savename))
         if self.resample == True:
-            new_spacing = [1, 1, 1]
-            orig_size = np.array(image.GetSize(), dtype=np.int)
-            orig_spacing = np.array(image.GetSpacing())
-            new_size = orig_size * (orig_spacing / new_spacing)
-            new_size = np.ceil(new_size).astype(np.int)  # Image dimensions are in integers
-            new_size = [int(s) for s in new_size]
-
-            resample = sitk.ResampleImageFilter()
-            resample.SetInterpolator = sitk.sitkLinear
-            resample.SetOutputSpacing(new_spacing)
-            resample.SetSize(new_size)
-            resample.SetOutputDirection(image.GetDirection())
-            resample.SetOutputOrigin(image.GetOrigin())
-            new_image = resample.Execute(image)
-            sitk.WriteImage(new_image, os.path.join(Output_path,str.replace(savename,'.nii.gz','_resampled.nii.gz')))
+            if self.roi_crop is not None:
+                image = self.crop_to_roi(image, Input_path, os.path.join(Output_path,str.replace(savename,'.nii.gz','_resampled.nii.gz')))
+            with self.report.stage('resample'):
+                new_image = self.resampler.resample(image)
+            with self.report.stage('write'):
+                sitk.WriteImage(new_image, os.path.join(Output_path,str.replace(savename,'.nii.gz','_resampled.nii.gz')))
 
 
 
     def dicom_series_define_reference(self,Input_path):
-        reader = sitk.ImageSeriesReader()
-        dicom_names = reader.GetGDCMSeriesFileNames(Input_path)
-        reader.SetFileNames(dicom_names)
-        image = reader.Execute()
+        image = self.reference_cache.get(Input_path,reader=self.read_series)
         Filter = sitk.ResampleImageFilter()
         Filter.SetReferenceImage(image)
         return Filter
 
     def Dicom_series_Reader_withReference(self,Input_path, Output_path, savename, Filter):
         #print("Reading Dicom directory:", Input_path)
-        reader = sitk.ImageSeriesReader()
-        dicom_names = reader.GetGDCMSeriesFileNames(Input_path)
-        reader.SetFileNames(dicom_names)
-        image = reader.Execute()
-        image = Filter.Execute(image)
-        sitk.WriteImage(image, os.path.join(Output_path,savename))
+        with self.report.stage('dicom_read'):
+            image = self.read_series(Input_path)
+        with self.report.stage('align'):
+            image = Filter.Execute(image)
+        with self.report.stage('write'):
+            sitk.WriteImage(image, os.path.join(Output_path,savename))
         
         if self.resample == True:
-            new_spacing = [1, 1, 1]
-            orig_size = np.array(image.GetSize(), dtype=np.int)
-            orig_spacing = np.array(image.GetSpacing())
-            new_size = orig_size * (orig_spacing / new_spacing)
-            new_size = np.ceil(new_size).astype(np.int)  # Image dimensions are in integers
-            new_size = [int(s) for s in new_size]
-
-            resample = sitk.ResampleImageFilter()
-            resample.SetInterpolator = sitk.sitkLinear
-            resample.SetOutputSpacing(new_spacing)
-            resample.SetSize(new_size)
-            resample.SetOutputDirection(image.GetDirection())
-            resample.SetOutputOrigin(image.GetOrigin())
-            new_image = resample.Execute(image)
-            sitk.WriteImage(new_image, os.path.join(Output_path,str.replace(savename,'.nii.gz','_resampled.nii.gz')))
-
-    def check_for_nifti_completion(self):
-        '''iterate over files and check if files have been converted from dicom to nifti format for all series'''
+            if self.roi_crop is not None:
+                image = self.crop_to_roi(image, Input_path, os.path.join(Output_path,str.replace(savename,'.nii.gz','_resampled.nii.gz')))
+            with self.report.stage('resample'):
+                new_image = self.resampler.resample(image)
+            with self.report.stage('write'):
+                sitk.WriteImage(new_image, os.path.join(Output_path,str.replace(savename,'.nii.gz','_resampled.nii.gz')))
+
+    def crop_to_roi(self,image,Input_path,output_path):
+        '''
+        crop a series on the t2 grid to the gland voi of its patient (see roi_crop.RoiCrop), every series and mask of
+        the patient gets the same box, the crop record is written next to output_path
+        '''
+        voi_dir=os.path.join(os.path.dirname(os.path.dirname(os.path.normpath(Input_path))),'voi')
+        with self.report.stage('crop'):
+            region=self.roi_crop.voi_region(voi_dir,image)
+            self.roi_crop.save_record(image,region,output_path)
+            return self.roi_crop.crop(image,region)
+
+    def read_series(self,Input_path):
+        '''read a dicom series, through the prefetcher while one is running'''
+        if self.prefetcher is not None:
+            return self.prefetcher.read(Input_path)
+        return read_dicom_series(Input_path)
+
+    def check_for_nifti_completion(self,database=None,series_all=['t2','adc','highb']):
+        '''iterate over files and check if files have been converted from dicom to nifti format for all series
+        -- with self.incremental a patient is skipped when the build manifest shows its dicoms, settings and outputs
+           are unchanged since the last successful conversion
+        :param database (str): only list patients of this database, defaults to all databases
+        :param series_all (list): series that have to be converted
+        '''
+
+        if database is None:
+            databases=self.databases
+        else:
+            databases=[database]
 
         need_to_process=[]
-        for database in self.databases:
+        for database in databases:
             for patient in os.listdir(os.path.join(self.basePATH,database)):
-                    need_to_process += [patient]
+                if self.incremental and self.get_manifest().is_current('dicom2nifti',database+'/'+patient,
+                                                                       *self.nifti_build_info(database,patient,series_all)):
+                    continue
+                need_to_process += [patient]
+
+        print('total of {} patients to convert to nifti masks'.format(len(set(need_to_process))))
+        return set(need_to_process)
+
+    def nifti_build_info(self,database,patient,series_all):
+        '''inputs, parameters and outputs of the dicom to nifti conversion of one patient, as stored in the build manifest'''
+
+        inputs=[]; outputs=[]
+        for series in series_all:
+            inputs+=list_files(os.path.join(self.basePATH,database,patient,'dicoms',series))
+            outputs+=[os.path.join(self.basePATH,database,patient,'nifti',series,series+'.nii.gz')]
+            if self.resample == True:
+                outputs+=[os.path.join(self.basePATH,database,patient,'nifti',series,series+'_resampled.nii.gz')]
+
+        #adc and highb are aligned to the t2
+        if 't2' not in series_all:
+            inputs+=list_files(os.path.join(self.basePATH,database,patient,'dicoms','t2'))
+
+        params={'series':series_all,'resample':self.resample,'spacing':self.resampler.new_spacing,
+                'interpolators':self.resampler.interpolators}
+        if self.roi_crop is not None and self.resample == True:
+            voi_path=self.roi_crop.find_voi(os.path.join(self.basePATH,database,patient,'voi'))
+            inputs+=[voi_path] if voi_path is not None else []
+            outputs+=[record_path(path) for path in outputs if path.endswith('_resampled.nii.gz')]
+            params['roi_crop']=self.roi_crop.params()
+        return inputs,params,outputs
 
-            print('total of {} patients to convert to nifti masks'.format(len(set(need_to_process))))
-            return set(need_to_process)
+    def get_manifest(self):
+        '''build manifest shared by every database under basePATH, opened on first use'''
+        if self.manifest_path is None:
+            self.manifest_path=os.path.join(self.basePATH,'build_manifest.sqlite')
+        if self.manifest is None or self.manifest.path!=self.manifest_path:
+            self.manifest=BuildManifest(self.manifest_path)
+        return self.manifest
 
     def remove_nifti_files(self,database):
         '''iterate over files and remove emtpy nifti files (if there is an error)'''
@@ -151,3 +313,5 @@ class Dicom2Nifti():
 if __name__=='__main__':
     c=Dicom2Nifti()
     c.dicom_to_nifti()
+    c.report.summary()
+    c.report.save(report_path(os.path.dirname(c.get_manifest().path)))
@@ -0,0 +1,281 @@
+#author @t_sanf
+
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from collections import namedtuple
+import numpy as np
+import pydicom
+import SimpleITK as sitk
+from batch_runner import is_transient
+
+# tags needed to order a series, everything else (including PixelData) is skipped
+INDEX_TAGS=['SliceLocation','ImagePositionPatient','ImageOrientationPatient','Rows','Columns']
+
+
+def read_dicom_series(Input_path):
+    '''read a dicom series directory into a SimpleITK image'''
+    reader = sitk.ImageSeriesReader()
+    dicom_names = reader.GetGDCMSeriesFileNames(Input_path)
+    reader.SetFileNames(dicom_names)
+    return reader.Execute()
+
+
+def image_nbytes(image):
+    '''number of bytes held by the voxel buffer of a SimpleITK image'''
+    return image.GetNumberOfPixels()*image.GetNumberOfComponentsPerPixel()*image.GetSizeOfPixelComponent()
+
+
+class ReferenceImageCache:
+    '''
+    in-memory LRU of decoded dicom series, shared by the nifti conversion and the masking pipelines
+    -- keyed by (series directory, directory mtime) so a series that changes on disk is decoded again
+    -- least recently used series are dropped once the cached voxel buffers exceed max_bytes
+    -- cached images are shared, callers must not modify them in place
+    '''
+
+    def __init__(self,max_bytes=2*1024**3):
+        self.max_bytes=max_bytes
+        self.images=OrderedDict()
+        self.nbytes=0
+        self.hits=0
+        self.misses=0
+
+    def get(self,series_dir,reader=read_dicom_series):
+        '''
+        return the image for a dicom series directory, decoding it only if it is not cached
+        :param series_dir (str): path to the directory containing the dicom series
+        :param reader: function reading a series directory on a cache miss, e.g. SeriesPrefetcher.read
+        :return: SimpleITK image
+        '''
+
+        series_dir=os.path.abspath(series_dir)
+        key=(series_dir,os.stat(series_dir).st_mtime_ns)
+        if key in self.images:
+            self.hits+=1
+            self.images.move_to_end(key)
+            return self.images[key]
+
+        self.misses+=1
+        image=reader(series_dir)
+        self.put(key,image)
+        return image
+
+    def put(self,key,image):
+        '''add an image and evict the least recently used entries until the memory budget is met'''
+
+        # an older version of the same directory is stale
+        for old_key in [k for k in self.images if k[0]==key[0]]:
+            self.nbytes-=image_nbytes(self.images.pop(old_key))
+
+        size=image_nbytes(image)
+        if size>self.max_bytes:
+            return
+        self.images[key]=image
+        self.nbytes+=size
+        while self.nbytes>self.max_bytes:
+            old_key,old_image=self.images.popitem(last=False)
+            self.nbytes-=image_nbytes(old_image)
+
+    def clear(self):
+        self.images.clear()
+        self.nbytes=0
+
+
+# one cache per process, shared by Dicom2Nifti and VOI_to_nifti_mask
+reference_cache=ReferenceImageCache()
+
+
+class SeriesPrefetcher:
+    '''
+    copy the dicom series that will be read next to a local scratch directory while the current one is processed
+    -- meant for archives on network shares, where reading hundreds of small slice files one after another is bound
+       by latency: the files of a series are copied by a pool of threads at the same time
+    -- at most `depth` series wait in scratch, and no new series is started while the waiting ones hold more than
+       max_bytes, a series is deleted from scratch as soon as it has been read
+    -- series that were not scheduled with prefetch() are read straight from their directory
+    '''
+
+    def __init__(self,depth=2,max_bytes=2*1024**3,copy_threads=16,scratch_dir=None):
+        '''
+        :param depth (int): number of series fetched ahead of the one being processed
+        :param max_bytes (int): byte budget of the series waiting in scratch
+        :param copy_threads (int): files copied at the same time
+        :param scratch_dir (str): local directory for the copies, defaults to /dev/shm (RAM) where it exists
+        '''
+        if scratch_dir is None:
+            scratch_dir='/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.depth=depth
+        self.max_bytes=max_bytes
+        self.copy_threads=copy_threads
+        self.scratch=tempfile.mkdtemp(prefix='dicom_prefetch_',dir=scratch_dir)
+        self.entries={}
+        self.scheduled=0
+        self.nbytes=0
+        self.waiting=0
+        self.closed=False
+        self.cond=threading.Condition()
+        self.threads=[]
+
+    def prefetch(self,series_dirs):
+        '''start copying series directories in the background, in the order they will be read'''
+
+        series_dirs=[os.path.abspath(series_dir) for series_dir in series_dirs if os.path.isdir(series_dir)]
+        with self.cond:
+            for series_dir in series_dirs:
+                if series_dir not in self.entries:
+                    self.entries[series_dir]={'order':self.scheduled,'ready':threading.Event(),'started':False,'local':None,'nbytes':0}
+                    self.scheduled+=1
+        self.threads+=[threading.Thread(target=self._fetch_all,args=(series_dirs,),daemon=True)]
+        self.threads[-1].start()
+
+    def _fetch_all(self,series_dirs):
+        with ThreadPoolExecutor(max_workers=self.copy_threads) as pool:
+            for i,series_dir in enumerate(series_dirs):
+                with self.cond:
+                    while not self.closed and self.waiting>0 and (self.waiting>=self.depth or self.nbytes>=self.max_bytes):
+                        self.cond.wait()
+                    entry=self.entries.get(series_dir)
+                    if entry is None:  # released before it was fetched
+                        continue
+                    if self.closed:
+                        entry['ready'].set()
+                        continue
+                    entry['started']=True
+                    self.waiting+=1
+                try:
+                    local=os.path.join(self.scratch,str(entry['order']))
+                    os.mkdir(local)
+                    files=[file for file in os.listdir(series_dir) if os.path.isfile(os.path.join(series_dir,file))]
+                    list(pool.map(lambda file: shutil.copyfile(os.path.join(series_dir,file),os.path.join(local,file)),files))
+                    entry['nbytes']=sum(os.path.getsize(os.path.join(local,file)) for file in files)
+                    entry['local']=local
+                except Exception as e:
+                    print('cannot prefetch {}: {}'.format(series_dir,e))
+                with self.cond:
+                    self.nbytes+=entry['nbytes']
+                    entry['ready'].set()
+
+    def read(self,series_dir):
+        '''
+        read a dicom series, from the scratch copy when it was prefetched
+        -- waits for a scheduled series that is still being copied, reads the original directory if the copy failed
+        -- series scheduled before this one that were never read (e.g. decoded from a cache instead) are released
+        :return: SimpleITK image
+        '''
+
+        series_dir=os.path.abspath(series_dir)
+        with self.cond:
+            entry=self.entries.get(series_dir)
+            skipped=[] if entry is None else [key for key,other in self.entries.items() if other['order']<entry['order']]
+        for key in skipped:
+            self.release(key)
+        if entry is None:
+            return read_dicom_series(series_dir)
+
+        entry['ready'].wait()
+        try:
+            return read_dicom_series(entry['local'] if entry['local'] is not None else series_dir)
+        finally:
+            self.release(series_dir)
+
+    def release(self,series_dir):
+        '''drop a scheduled series, its scratch copy is deleted and the next series can be fetched'''
+
+        with self.cond:
+            entry=self.entries.pop(os.path.abspath(series_dir),None)
+            if entry is None:
+                return
+        if not entry['started']:
+            return
+        entry['ready'].wait()
+        if entry['local'] is not None:
+            shutil.rmtree(entry['local'],ignore_errors=True)
+        with self.cond:
+            self.nbytes-=entry['nbytes']
+            self.waiting-=1
+            self.cond.notify_all()
+
+    def close(self):
+        '''stop fetching and remove the scratch directory'''
+        with self.cond:
+            self.closed=True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        for series_dir in list(self.entries):
+            self.release(series_dir)
+        shutil.rmtree(self.scratch,ignore_errors=True)
+
+
+SliceIndex=namedtuple('SliceIndex',['paths','locations','rows','columns'])
+
+def slice_location(ds):
+    '''
+    position of a slice along the stack, SliceLocation if present otherwise ImagePositionPatient
+    projected on the slice normal (cross product of the ImageOrientationPatient row and column cosines)
+    '''
+
+    if 'SliceLocation' in ds:
+        return float(ds.SliceLocation)
+    orientation=np.array(ds.ImageOrientationPatient,dtype=float)
+    normal=np.cross(orientation[:3],orientation[3:])
+    return float(np.dot(np.array(ds.ImagePositionPatient,dtype=float),normal))
+
+
+def order_dicom_files(dicom_file_list):
+    '''
+    order dicom files by slice location reading only the header tags in INDEX_TAGS, pixel data is never read
+    -- files without a usable location (non-image files in the directory) and files that cannot be read are left out,
+       transient i/o errors (batch_runner.is_transient) are raised so the task is retried
+    :param dicom_file_list: list of paths to dicom files
+    :return: SliceIndex(paths, locations, rows, columns) with paths sorted by location
+    '''
+
+    located=[]
+    rows=None; columns=None
+    for path in dicom_file_list:
+        try:
+            ds=pydicom.dcmread(path,force=True,stop_before_pixels=True,specific_tags=INDEX_TAGS)
+            location=slice_location(ds)
+        except Exception as e:
+            if is_transient(e):
+                raise
+            continue
+        located+=[(location,str(path))]
+        if rows is None and 'Rows' in ds:
+            rows=int(ds.Rows); columns=int(ds.Columns)
+
+    located.sort()
+    return SliceIndex(paths=[path for location,path in located],locations=[location for location,path in located],
+                      rows=rows,columns=columns)
+
+
+# slice indexes of the most recently used series, a long run over a large database touches every series once
+SERIES_INDEX_CACHE_SIZE=256
+_series_index_cache=OrderedDict()
+
+def index_dicom_series(series_dir):
+    '''
+    header-only slice index of a dicom series directory, built once per (directory, mtime) and reused
+    -- the last SERIES_INDEX_CACHE_SIZE series are kept (LRU), an older index of the same directory is dropped
+    :param series_dir (str): path to the directory containing the dicom series
+    :return: SliceIndex
+    '''
+
+    series_dir=os.path.abspath(series_dir)
+    key=(series_dir,os.stat(series_dir).st_mtime_ns)
+    if key in _series_index_cache:
+        _series_index_cache.move_to_end(key)
+        return _series_index_cache[key]
+
+    for old_key in [k for k in _series_index_cache if k[0]==series_dir]:
+        del _series_index_cache[old_key]
+    paths=[os.path.join(series_dir,file) for file in sorted(os.listdir(series_dir))]
+    _series_index_cache[key]=order_dicom_files([path for path in paths if os.path.isfile(path)])
+    while len(_series_index_cache)>SERIES_INDEX_CACHE_SIZE:
+        _series_index_cache.popitem(last=False)
+    return _series_index_cache[key]
@@ -0,0 +1,215 @@
+#author @t_sanf
+
+import os
+import csv
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # windows
+    resource=None
+
+# columns of the csv report, in order
+FIELDS=['patient','stage','wall_s','cpu_s','peak_rss_mb','read_mb','written_mb','error']
+
+
+def peak_rss_mb():
+    '''
+    peak resident memory of this process so far in MB, None where getrusage is not available
+    -- on linux RunReport stages reset the peak (see reset_peak_rss), it is then the peak since the last stage started
+    '''
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.  # linux reports kB
+
+
+def current_peak_rss_mb():
+    '''peak resident memory since the last reset_peak_rss in MB, VmHWM of /proc/self/status (linux), None elsewhere'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/1024.
+    except (OSError,ValueError,IndexError):
+        pass
+    return None
+
+
+def reset_peak_rss():
+    '''lower the peak resident memory to the current resident memory (linux), False where it cannot be reset'''
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def io_counters():
+    '''(bytes read, bytes written) by this process so far, from /proc/self/io (linux), (None, None) elsewhere'''
+    try:
+        with open('/proc/self/io') as f:
+            counters=dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']),int(counters['wchar'])
+    except (OSError,KeyError,ValueError):
+        return None,None
+
+
+class RunReport:
+    '''
+    per patient, per stage measurements of a pipeline run: wall time, cpu time, peak rss, bytes read and written
+    -- peak rss is the peak of the stage itself: the process peak is reset when a stage starts and read when it ends
+       (linux only, None where the peak cannot be reset), enclosing stages keep the largest peak of their inner stages
+    -- wrap work in `with report.patient(name):` once and `with report.stage('resample'):` wherever it happens,
+       the patient is remembered per thread so stages deep inside a pipeline do not need it passed down
+    -- cpu time, rss and io are process wide counters, when stages run concurrently (ClaraPipeline threads)
+       the deltas of overlapping stages include each other's work, wall time is always exact
+    -- records of worker processes are sent back by batch_runner.run_tasks and merged into the parent report
+    '''
+
+    def __init__(self,enabled=True):
+        self.enabled=enabled
+        self.records=[]
+        self.lock=threading.Lock()
+        self.local=threading.local()
+        self.running=[]  #peak rss of the stages currently open in this process
+
+    @contextmanager
+    def patient(self,name):
+        '''set the patient that the stages recorded by this thread belong to'''
+        previous=getattr(self.local,'patient',None)
+        self.local.patient=name
+        try:
+            yield
+        finally:
+            self.local.patient=previous
+
+    @contextmanager
+    def stage(self,name):
+        '''time one stage of the current patient, an exception is recorded and raised again'''
+
+        if not self.enabled:
+            yield
+            return
+        read,written=io_counters()
+        wall=time.perf_counter(); cpu=time.process_time()
+        record={'patient':getattr(self.local,'patient',None),'stage':name,'error':None}
+        peak=self._start_peak()
+        try:
+            yield
+        except Exception as e:
+            record['error']=repr(e)
+            raise
+        finally:
+            record['wall_s']=time.perf_counter()-wall
+            record['cpu_s']=time.process_time()-cpu
+            record['peak_rss_mb']=self._end_peak(peak)
+            end_read,end_written=io_counters()
+            record['read_mb']=None if read is None else (end_read-read)/1024.**2
+            record['written_mb']=None if written is None else (end_written-written)/1024.**2
+            with self.lock:
+                self.records+=[record]
+
+    def _update_peaks(self):
+        '''fold the process peak since the last reset into every open stage'''
+        current=current_peak_rss_mb()
+        for peak in self.running:
+            if current is not None and peak[0] is not None:
+                peak[0]=max(peak[0],current)
+
+    def _start_peak(self):
+        '''open the peak of a new stage, None where the process peak cannot be reset'''
+        with self.lock:
+            self._update_peaks()
+            peak=[current_peak_rss_mb() if reset_peak_rss() else None]
+            self.running+=[peak]
+        return peak
+
+    def _end_peak(self,peak):
+        '''close the peak of a stage and return it in MB'''
+        with self.lock:
+            self._update_peaks()
+            self.running=[other for other in self.running if other is not peak]
+        return peak[0]
+
+    def __reduce__(self):
+        '''sent to a worker process the report becomes the run_report of that process, see batch_runner.run_tasks'''
+        return (_process_report,())
+
+    def drain(self):
+        '''remove and return all records, used to ship the records of a worker process back to the parent'''
+        with self.lock:
+            records=self.records; self.records=[]
+        return records
+
+    def extend(self,records):
+        '''add records drained from another process'''
+        with self.lock:
+            self.records+=records
+
+    def clear(self):
+        self.drain()
+
+    def totals(self,key):
+        '''{patient or stage: summed wall time, cpu time, read and written MB}'''
+
+        totals={}
+        for record in self.records:
+            total=totals.setdefault(record[key],{'wall_s':0.,'cpu_s':0.,'read_mb':0.,'written_mb':0.,'count':0,'errors':0})
+            for field in ('wall_s','cpu_s','read_mb','written_mb'):
+                total[field]+=record[field] or 0.
+            total['count']+=1
+            total['errors']+=record['error'] is not None
+        return totals
+
+    def summary(self,n=5,verbose=True):
+        '''
+        total time per stage and the n slowest patients
+        :param verbose (bool): print them as a table
+        :return: dict with 'stages' and 'slowest_patients', as stored in the json report
+        '''
+
+        stages=self.totals('stage')
+        patients=self.totals('patient')
+        slowest=sorted(patients.items(),key=lambda item: -item[1]['wall_s'])[:n]
+        summary={'stages':stages,'slowest_patients':[{'patient':patient,**total} for patient,total in slowest]}
+        if not verbose:
+            return summary
+        print('{:<20}{:>8}{:>12}{:>12}{:>12}{:>12}'.format('stage','count','wall s','cpu s','read MB','written MB'))
+        for stage,total in sorted(stages.items(),key=lambda item: -item[1]['wall_s']):
+            print('{:<20}{:>8}{:>12.2f}{:>12.2f}{:>12.1f}{:>12.1f}'.format(str(stage),total['count'],total['wall_s'],
+                                                                          total['cpu_s'],total['read_mb'],total['written_mb']))
+        print('slowest patients: {}'.format(', '.join('{} ({:.2f} s)'.format(patient,total['wall_s']) for patient,total in slowest)))
+        return summary
+
+    def save(self,path,n=5):
+        '''write the records to path, .csv writes one row per record, anything else a json file with the summary'''
+
+        directory=os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if path.endswith('.csv'):
+            with open(path,'w',newline='') as outfile:
+                writer=csv.DictWriter(outfile,fieldnames=FIELDS)
+                writer.writeheader()
+                writer.writerows(self.records)
+            return path
+        with open(path,'w') as outfile:
+            json.dump({'created':time.strftime('%Y-%m-%dT%H:%M:%S'),'records':self.records,**self.summary(n=n,verbose=False)},outfile,indent=2)
+        return path
+
+
+def report_path(directory,prefix='run_report'):
+    '''path of a new report in directory, named after the current time so the reports of every run are kept'''
+    return os.path.join(directory,'{}_{}.json'.format(prefix,time.strftime('%Y%m%d-%H%M%S')))
+
+
+# one report per process, shared by every pipeline class
+run_report=RunReport()
+
+
+def _process_report():
+    return run_report
@@ -0,0 +1,102 @@
+#author @t_sanf
+
+import os
+import gzip
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import SimpleITK as sitk
+
+# size of the blocks streamed through gzip
+BLOCK_SIZE=16*1024*1024
+
+
+def compress_nii_file(path,compresslevel=6,remove=True):
+    '''
+    compress one .nii file to .nii.gz by streaming its raw bytes through gzip, the volume is never decoded
+    -- the .nii.gz is written to a .part file first and renamed when complete, so an interrupted run never leaves a
+       truncated .nii.gz behind
+    :param path (str): path to the .nii file
+    :param compresslevel (int): gzip level 1 (fast) to 9 (small)
+    :param remove (bool): delete the .nii once the .nii.gz is in place
+    :return: path of the .nii.gz file
+    '''
+
+    out_path=path+'.gz'
+    part_path=out_path+'.part'
+    with open(path,'rb') as src, open(part_path,'wb') as raw:
+        with gzip.GzipFile(filename=os.path.basename(path),mode='wb',fileobj=raw,compresslevel=compresslevel) as dst:
+            shutil.copyfileobj(src,dst,BLOCK_SIZE)
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(part_path,out_path)
+    if remove:
+        os.remove(path)
+    return out_path
+
+
+def compress_nii_files(paths,workers=None,compresslevel=6,remove=True):
+    '''
+    compress many .nii files in a thread pool, zlib releases the GIL so files are compressed in parallel
+    :param paths (list): paths to .nii files
+    :param workers (int): number of threads, defaults to the number of cpus
+    :return: list of paths of the .nii.gz files
+    '''
+
+    if workers is None:
+        workers=os.cpu_count() or 1
+    if workers<=1 or len(paths)<=1:
+        return [compress_nii_file(path,compresslevel=compresslevel,remove=remove) for path in paths]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda path: compress_nii_file(path,compresslevel=compresslevel,remove=remove),paths))
+
+
+def find_nii_files(path,recursive=True):
+    '''
+    all uncompressed .nii files in a directory, leftover .part files of an interrupted run are removed
+    :param recursive (bool): also search subdirectories
+    '''
+
+    found=[]
+    for root,dirs,files in os.walk(path):
+        for file in sorted(files):
+            if file.endswith('.nii.gz.part'):
+                os.remove(os.path.join(root,file))
+            elif file.endswith('.nii'):
+                found+=[os.path.join(root,file)]
+        if not recursive:
+            break
+    return found
+
+
+class NiftiVolume:
+    '''
+    lazy nifti volume, opening it reads the header only (size, spacing, origin, direction, pixel type)
+    -- has the SimpleITK geometry getters (GetSize, GetSpacing, GetOrigin, GetDirection), so it can stand in for an
+       image wherever only the geometry is used, e.g. as reference of ResampleEngine.resample
+    -- read() loads the full SimpleITK image when the voxels are needed after all
+    '''
+
+    def __init__(self,path):
+        self.path=path
+        self.reader=sitk.ImageFileReader()
+        self.reader.SetFileName(path)
+        self.reader.ReadImageInformation()
+
+    def GetSize(self):
+        return self.reader.GetSize()
+
+    def GetSpacing(self):
+        return self.reader.GetSpacing()
+
+    def GetOrigin(self):
+        return self.reader.GetOrigin()
+
+    def GetDirection(self):
+        return self.reader.GetDirection()
+
+    def GetPixelIDValue(self):
+        return self.reader.GetPixelIDValue()
+
+    def read(self):
+        '''the full SimpleITK image'''
+        return self.reader.Execute()
@@ -1,11 +1,19 @@
 #author @t_sanf/@sharm
 
-import pandas as pd
 from skimage import draw
 import numpy as np
 np.set_printoptions(threshold=np.inf)
 
 from parsing_VOI import *
+from dicom_io import reference_cache, index_dicom_series, order_dicom_files, read_dicom_series, SeriesPrefetcher
+from rasterize import rasterize_contours, rasterize_label_map, label_names, LABEL_MAP
+from resampling import ResampleEngine
+from roi_crop import record_path
+from build_manifest import BuildManifest, list_files
+from batch_runner import run_tasks, log_failure, is_transient, TRANSIENT_ERRORS
+from work_queue import WorkQueue
+from instrumentation import run_report, report_path
+import traceback
 import pydicom
 import math
 import nibabel
@@ -20,64 +28,273 @@ class VOI_to_nifti_mask(ParseVOI):
         self.anonymize_database = r'M:/Stephanie_Harmon/Projects_MRI/test_new_anon_pipeline'
         self.databases=['batch4']
         self.resample = True  # this flag will make a directory with resampled images to 1x1x1
-
-
-    def create_masks_all_patients(self):
+        self.resampler = ResampleEngine(new_spacing=[1,1,1])  # spacing/interpolators used when resample is on
+        self.roi_crop = None  # roi_crop.RoiCrop(margin=10) crops the resampled masks to the gland (wp voi), same box as Dicom2Nifti
+        self.reference_cache = reference_cache  # decoded t2 series shared with the nifti conversion
+        self.contour_mode = 'union'  # how contours on the same slice combine, 'union' or 'xor' (inner contours are holes)
+        self.voi_cache = None  # parsing_VOI.VOICache(cache_dir) keeps parsed .voi files as binary, None re-reads the text every time
+        self.segmentation_types = ['wp','tz','PIRADS']  # voi files turned into masks, matched case-insensitively in the file name
+        self.fuse_labels = False  # write one label volume per patient (labels.nii.gz) instead of one mask per voi file
+        self.label_map = LABEL_MAP  # (name, label) painted in order when fuse_labels is on, later entries win overlaps
+        self.prefetch_depth = 0  # t2 series copied to local scratch ahead of time (for network shares), 0 reads in place
+        self.prefetch_bytes = 2*1024**3  # byte budget of the prefetched series waiting in scratch
+        self.prefetch_dir = None  # local scratch directory, defaults to /dev/shm
+        self.prefetcher = None
+        self.output_ext = '.nii.gz'  # format of the written masks, any extension SimpleITK can write ('.nii', '.nrrd', ...)
+        self.incremental = True  # only rebuild masks whose voi, t2 series or settings changed since the last run
+        self.manifest_path = None  # build manifest file, defaults to anonymize_database/build_manifest.sqlite
+        self.manifest = None
+        self.report = run_report  # per patient, per stage timings, see instrumentation.RunReport
+        self.workers = 1  # number of patients masked in parallel (process pool)
+        self.retries = 2  # extra attempts for a patient failing with a transient i/o error (or timing out)
+        self.retry_on = TRANSIENT_ERRORS  # exception types that count as transient, os errors only with a transient errno (batch_runner.is_transient)
+        self.task_timeout = None  # seconds one patient may take before it is killed (and retried), None for no limit
+        self.ledger_path = None  # failures with their tracebacks (json lines), defaults to anonymize_database/failures.jsonl
+        self.queue_path = None  # work queue shared by the workers of a sharded run, defaults to anonymize_database/work_queue.sqlite
+        self.lease_seconds = 600  # a patient claimed by a worker that stops renewing it is handed to another worker after this
+
+
+    def create_masks_all_patients(self,workers=None):
         '''
-        create masks for all filestypes for all patients, saves as .nii files
+        create masks for all filestypes for all patients, saves as self.output_ext (.nii.gz) files
+        -- every patient is one task of batch_runner.run_tasks, its masks are recorded in the build manifest as soon
+           as it finishes, so a run that is interrupted picks up at the first unfinished patient
+        -- failed patients and voi files are appended to the failure ledger with their tracebacks
+        :param workers (int): number of patients masked in parallel, defaults to self.workers
+        :return: list of patients/voi files that could not be converted
         '''
 
         databases=self.databases
-        segmentation_types=['wp','tz','PIRADS']
+        if workers is None:
+            workers=self.workers
         exception_logger=[]
 
         for database in databases:
-            #filelist = sorted(self.check_complete_mask(database))
-            filelist = os.listdir(os.path.join(self.anonymize_database, database))
+            filelist = sorted(self.check_complete_mask(database))
             print('total of {} files left to convert'.format(len(filelist)))
-            for patient_dir in filelist:
-                print("converting files to mask for patient {}".format(patient_dir))
-                voi_files = os.listdir(os.path.join(self.anonymize_database, database, patient_dir, 'voi'))
-                for filetype in segmentation_types:
-                    print(filetype)
-
-                    #use regular expressions to account for differences in capitalization, search entire string
-                    if filetype=='PIRADS':
-                        pat=re.compile('([Pp][Ii][Rr][Aa][Dd][Ss]){1}')
-                    if filetype=='wp':
-                        pat = re.compile('([Ww][Pp]){1}')
-                    if filetype=='tz':
-                        pat = re.compile('([Tt][Zz]){1}')
-                    if filetype=='cz':
-                        pat = re.compile('([Cc][Zz]){1}')
-                    if filetype=='urethra':
-                        pat=re.compile('([Uu][Rr][Ee][Tt][Hh][Rr][Aa]){1}')
-
-                    for file in voi_files:
-                        if file.endswith('.voi') and pat.search(file) !=None:
-                            self.create_nifti_mask(database=database, patient_dir=patient_dir, type=file)
-                            try:
-                                self.create_nifti_mask(database=database, patient_dir=patient_dir, type=file)
-
-                            except:
-                                print("cannot convert file {} for patient {}".format(file,patient_dir))
-                                exception_logger+=[patient_dir+'_'+file]
-
-            print("all files cannot be converted: {}".format(exception_logger))
-            return exception_logger
+            tasks=[(database,patient_dir) for patient_dir in filelist]
+
+            #copy the next patients' t2 series to local scratch while the current one is masked (serial runs only)
+            if self.prefetch_depth>0 and self.task_timeout is None and (workers<=1 or len(tasks)<=1):
+                self.prefetcher=SeriesPrefetcher(depth=self.prefetch_depth,max_bytes=self.prefetch_bytes,scratch_dir=self.prefetch_dir)
+                self.prefetcher.prefetch([os.path.join(self.anonymize_database,database,patient_dir,'dicoms','t2')
+                                          for patient_dir in filelist])
+            try:
+                done,failed=run_tasks(self.mask_patient,tasks,workers=workers,name='voi to mask',retries=self.retries,
+                                      retry_on=self.retry_on,timeout=self.task_timeout,on_done=self.record_patient,
+                                      ledger=self.get_ledger_path())
+            finally:
+                if self.prefetcher is not None:
+                    self.prefetcher.close()
+                    self.prefetcher=None
+
+            for (database,patient_dir),(built,errors) in done:
+                exception_logger+=[patient_dir+'_'+file for file,error in errors]
+            for (database,patient_dir),error in failed:
+                print(error)
+                exception_logger+=[patient_dir]
+
+        print("all files cannot be converted: {}".format(exception_logger))
+        return exception_logger
+
+
+    def run_worker(self,run):
+        '''
+        one worker of a sharded masking run, start it on any number of processes/nodes that see anonymize_database
+        -- every worker queues the patients that are not up to date, then claims them one at a time from the shared
+           work queue (see work_queue.WorkQueue) until every patient is done, each patient is masked exactly once
+        -- a patient is queued once per run, every launch needs a new run (work_queue.new_run_id) or the patients that
+           changed since are already done in the queue and silently skipped, workers joining a run pass its name
+        -- python work_queue.py mask <anonymize_database> --databases ... --processes N starts N workers on this machine
+        :param run (str): name of the run, shared by every worker of the run
+        :return: list of patients/voi files that failed in this worker
+        '''
+
+        stage=('voi2labels/' if self.fuse_labels else 'voi2mask/')+run
+        queue=self.get_queue()
+        queue.add(stage,[(database,patient_dir) for database in self.databases
+                         for patient_dir in sorted(self.check_complete_mask(database))])
+        done,failed=queue.work(stage,self.mask_patient,name='voi to mask',on_done=self.record_patient,
+                               ledger=self.get_ledger_path(),retries=self.retries,retry_on=self.retry_on,
+                               timeout=self.task_timeout)
+
+        exception_logger=[]
+        for (database,patient_dir),(built,errors) in done:
+            exception_logger+=[patient_dir+'_'+file for file,error in errors]
+        for (database,patient_dir),error in failed:
+            exception_logger+=[patient_dir]
+        print("all files that failed in this worker: {}".format(exception_logger))
+        return exception_logger
+
+
+    def get_queue(self):
+        '''work queue of sharded runs, kept next to the build manifest'''
+        if self.queue_path is None:
+            self.queue_path=os.path.join(self.anonymize_database,'work_queue.sqlite')
+        return WorkQueue(self.queue_path,lease_seconds=self.lease_seconds,max_attempts=self.retries+1)
+
+
+    def mask_patient(self,database,patient_dir):
+        '''
+        create the masks (or the label volume) of one patient, runs independently of every other patient
+        -- a transient i/o error is raised so run_tasks retries the patient, any other error only fails that voi file
+        -- nothing is printed here, with workers>1 it would interleave with the progress lines, failed files are
+           reported by record_patient in the parent
+        :return: (voi files that were converted, list of (voi file, traceback) that failed)
+        '''
+
+        built=[]; errors=[]
+
+        with self.report.patient(database+'/'+patient_dir):
+            if self.fuse_labels:
+                try:
+                    self.create_label_volume(database=database, patient_dir=patient_dir)
+                    built+=['labels']
+                except Exception as e:
+                    if is_transient(e,self.retry_on):
+                        raise
+                    errors+=[('labels',traceback.format_exc())]
+                return built,errors
+
+            for file in self.mask_voi_files(database,patient_dir):
+                if self.incremental and self.mask_is_current(database,patient_dir,file):
+                    continue
+                try:
+                    self.create_nifti_mask(database=database, patient_dir=patient_dir, type=file)
+                    built+=[file]
+                except Exception as e:
+                    if is_transient(e,self.retry_on):
+                        raise
+                    errors+=[(file,traceback.format_exc())]
+
+        return built,errors
+
+
+    def record_patient(self,task,result):
+        '''checkpoint one finished patient: record its masks in the build manifest and its failed files in the ledger'''
+
+        database,patient_dir=task
+        built,errors=result
+        for file in built:
+            if file=='labels':
+                self.get_manifest().record('voi2labels',database+'/'+patient_dir,*self.labels_build_info(database,patient_dir))
+            else:
+                self.get_manifest().record('voi2mask',database+'/'+patient_dir+'/'+file,
+                                           *self.mask_build_info(database,patient_dir,file))
+        for file,error in errors:
+            print("cannot convert file {} for patient {}".format(file,patient_dir))
+            log_failure(self.get_ledger_path(),'voi to mask',database+'/'+patient_dir+'/'+file,error)
+
+
+    def get_ledger_path(self):
+        '''failure ledger kept next to the build manifest'''
+        if self.ledger_path is None:
+            self.ledger_path=os.path.join(self.anonymize_database,'failures.jsonl')
+        return self.ledger_path
 
 
     def check_complete_mask(self,database):
-        '''check for patient than need nifti masks created'''
+        '''check for patient than need nifti masks created
+        -- with self.incremental a patient is skipped when the build manifest shows every voi file is up to date
+        '''
 
         need_mask=[]
         for patient in os.listdir(os.path.join(self.anonymize_database,database)):
+            if self.incremental and self.fuse_labels:
+                if self.get_manifest().is_current('voi2labels',database+'/'+patient,*self.labels_build_info(database,patient)):
+                    continue
+            elif self.incremental:
+                if all(self.mask_is_current(database,patient,file) for file in self.mask_voi_files(database,patient)):
+                    continue
             need_mask += [patient]
-            #if not os.path.exists(os.path.join(self.anonymize_database, database, patient, 'nifti','mask')):
-                #need_mask+=[patient]
         return need_mask
 
 
+    def mask_build_info(self,database,patient_dir,file):
+        '''inputs, parameters and outputs of one voi -> mask conversion, as stored in the build manifest'''
+
+        mask_dir=os.path.join(self.anonymize_database,database,patient_dir,'nifti','mask')
+        inputs=[os.path.join(self.anonymize_database,database,patient_dir,'voi',file)]
+        inputs+=list_files(os.path.join(self.anonymize_database,database,patient_dir,'dicoms','t2'))
+        outputs=[os.path.join(mask_dir,file.split('.')[0]+self.output_ext)]
+        if self.resample == True:
+            outputs+=[os.path.join(mask_dir,file.split('.')[0]+'_resampled'+self.output_ext)]
+        params={'resample':self.resample,'spacing':self.resampler.new_spacing,
+                'interpolators':self.resampler.interpolators,'contour_mode':self.contour_mode}
+        self.add_crop_info(database,patient_dir,inputs,params,outputs)
+        return inputs,params,outputs
+
+
+    def labels_build_info(self,database,patient_dir):
+        '''inputs, parameters and outputs of the label volume of one patient, as stored in the build manifest'''
+
+        mask_dir=os.path.join(self.anonymize_database,database,patient_dir,'nifti','mask')
+        inputs=self.label_voi_files(database,patient_dir)
+        inputs+=list_files(os.path.join(self.anonymize_database,database,patient_dir,'dicoms','t2'))
+        outputs=[os.path.join(mask_dir,'labels'+self.output_ext)]
+        if self.resample == True:
+            outputs+=[os.path.join(mask_dir,'labels_resampled'+self.output_ext)]
+        params={'resample':self.resample,'spacing':self.resampler.new_spacing,'interpolators':self.resampler.interpolators,
+                'contour_mode':self.contour_mode,'label_map':self.label_map}
+        self.add_crop_info(database,patient_dir,inputs,params,outputs)
+        return inputs,params,outputs
+
+
+    def add_crop_info(self,database,patient_dir,inputs,params,outputs):
+        '''add the gland voi, the crop settings and the crop records to a build info when roi_crop is on'''
+
+        if self.roi_crop is None or self.resample != True:
+            return
+        voi_path=self.roi_crop.find_voi(os.path.join(self.anonymize_database,database,patient_dir,'voi'))
+        if voi_path is not None and voi_path not in inputs:
+            inputs+=[voi_path]
+        outputs+=[record_path(path) for path in outputs if path.endswith('_resampled'+self.output_ext)]
+        params['roi_crop']=self.roi_crop.params()
+
+
+    def label_voi_files(self,database,patient_dir):
+        '''paths of the .voi files of a patient that match an entry of self.label_map'''
+
+        voi_dir=os.path.join(self.anonymize_database,database,patient_dir,'voi')
+        if not os.path.isdir(voi_dir):
+            return []
+        pats=[re.compile(re.escape(name),re.IGNORECASE) for name,label in self.label_map]
+        return [os.path.join(voi_dir,file) for file in sorted(os.listdir(voi_dir))
+                if file.endswith('.voi') and any(pat.search(file)!=None for pat in pats)]
+
+
+    def mask_voi_files(self,database,patient_dir):
+        '''
+        names of the .voi files of a patient that mask_patient turns into masks, in the order of self.segmentation_types
+        -- a type matches anywhere in the file name regardless of capitalization, a file matching several types is listed once
+        '''
+
+        voi_dir=os.path.join(self.anonymize_database,database,patient_dir,'voi')
+        if not os.path.isdir(voi_dir):
+            return []
+        voi_files=[file for file in os.listdir(voi_dir) if file.endswith('.voi')]
+        files=[]
+        for filetype in self.segmentation_types:
+            pat=re.compile(re.escape(filetype),re.IGNORECASE)
+            files+=[file for file in voi_files if pat.search(file)!=None and file not in files]
+        return files
+
+
+    def mask_is_current(self,database,patient_dir,file):
+        '''True if the mask of this voi file was built from the same inputs and settings and still exists'''
+        return self.get_manifest().is_current('voi2mask',database+'/'+patient_dir+'/'+file,
+                                              *self.mask_build_info(database,patient_dir,file))
+
+
+    def get_manifest(self):
+        '''build manifest shared by every database under anonymize_database, opened on first use'''
+        if self.manifest_path is None:
+            self.manifest_path=os.path.join(self.anonymize_database,'build_manifest.sqlite')
+        if self.manifest is None or self.manifest.path!=self.manifest_path:
+            self.manifest=BuildManifest(self.manifest_path)
+        return self.manifest
+
+
     def create_nifti_mask(self,database='',patient_dir='',type=''):
         '''
         creates a mask for each filetype, save in nibabel format
@@ -91,21 +308,17 @@ class VOI_to_nifti_mask(ParseVOI):
         nifti_dir=os.path.join(self.anonymize_database,database,patient_dir,'nifti')
         mask_dir = os.path.join(self.anonymize_database, database, patient_dir, 'nifti', 'mask')
 
-        #get all paths of t2 images and order
-        all_image_paths=self.get_all_paths_image_dir(patient_dir=patient_dir_t2)
-        image_paths_ordered=self.order_dicom(all_image_paths)
+        #t2 image defines the shape, decoded once per patient and reused for every voi file
+        with self.report.stage('dicom_read'):
+            image = self.reference_cache.get(patient_dir_t2,reader=self.read_series)
 
-        #read in first image to get shape
-        reader = sitk.ImageSeriesReader()
-        dicom_names = reader.GetGDCMSeriesFileNames(patient_dir_t2)
-        reader.SetFileNames(dicom_names)
-        image = reader.Execute()
-        numpy_mask = np.zeros(image.GetSize())
-
-        #iterate over mask and update empty array with mask
-        mask_dict = self.mask_coord_dict(database=database,patient_dir=patient_dir,type=type)
-        for key in mask_dict.keys():
-            numpy_mask[:,:,int(key)]=mask_dict[key]
+        #fill every contour of the voi straight into one uint8 volume, (slice,row,column) order
+        voi_path=os.path.join(self.anonymize_database,database,patient_dir,'voi',type)
+        with self.report.stage('voi_parse'):
+            contours=list(self.iter_contours(voi_path))
+        with self.report.stage('rasterize'):
+            numpy_mask = np.zeros(image.GetSize()[::-1],dtype=np.uint8)
+            rasterize_contours(contours,numpy_mask,mode=self.contour_mode)
 
         #make directories if needed
         if not os.path.exists(nifti_dir):
@@ -114,38 +327,91 @@ class VOI_to_nifti_mask(ParseVOI):
         if not os.path.exists(mask_dir):
             os.mkdir(mask_dir)
 
-        #need to save as nifti
-        numpy_mask = np.swapaxes(numpy_mask, 2, 0)
+        #save in the final format (compressed nifti by default) in a single write
         img_out = sitk.GetImageFromArray(numpy_mask)
         img_out.CopyInformation(image)
-        os.chdir(mask_dir)
-        sitk.WriteImage(img_out, type.split('.')[0]+'.nii')
+        with self.report.stage('write'):
+            sitk.WriteImage(img_out, os.path.join(mask_dir,type.split('.')[0]+self.output_ext))
+
+        if self.resample == True:
+            reference = image
+            if self.roi_crop is not None:
+                reference,img_out = self.crop_to_roi(database,patient_dir,image,img_out,
+                                                     os.path.join(mask_dir,type.split('.')[0]+'_resampled'+self.output_ext))
+            #nearest neighbour for masks keeps the mask uint8 with values 0/1
+            #the output grid comes from the t2 header, the t2 itself is not resampled again for every voi file
+            with self.report.stage('resample'):
+                new_image = self.resampler.resample(img_out,kind='mask',reference=reference)
+
+            with self.report.stage('write'):
+                sitk.WriteImage(new_image, os.path.join(mask_dir,type.split('.')[0]+'_resampled'+self.output_ext))
+
+
+
+
+    def create_label_volume(self,database='',patient_dir=''):
+        '''
+        fuse every .voi file of a patient into one uint8 label volume (see rasterize.rasterize_label_map), written once
+        as mask/labels (and resampled once as mask/labels_resampled) instead of one mask per voi file
+        -- label_names(self.label_map) is the matching "labels" section of datalist.json
+        :param patient_dir: name of directory of patient
+        :return: none, saves the label volume
+        '''
+
+        patient_dir_t2=os.path.join(self.anonymize_database,database,patient_dir,'dicoms','t2')
+        mask_dir = os.path.join(self.anonymize_database, database, patient_dir, 'nifti', 'mask')
+
+        with self.report.stage('dicom_read'):
+            image = self.reference_cache.get(patient_dir_t2,reader=self.read_series)
+
+        with self.report.stage('rasterize'):
+            labels = np.zeros(image.GetSize()[::-1],dtype=np.uint8)
+            rasterize_label_map(self.label_voi_files(database,patient_dir),labels,label_map=self.label_map,
+                                mode=self.contour_mode,load=self.iter_contours)
+
+        if not os.path.exists(mask_dir):
+            os.makedirs(mask_dir)
+
+        img_out = sitk.GetImageFromArray(labels)
+        img_out.CopyInformation(image)
+        with self.report.stage('write'):
+            sitk.WriteImage(img_out, os.path.join(mask_dir,'labels'+self.output_ext))
 
         if self.resample == True:
-            new_spacing = [1, 1, 1]
-            orig_size = np.array(img_out.GetSize(), dtype=np.int)
-            orig_spacing = np.array(img_out.GetSpacing())
-            new_size = orig_size * (orig_spacing / new_spacing)
-            new_size = np.ceil(new_size).astype(np.int)  # Image dimensions are in integers
-            new_size = [int(s) for s in new_size]
+            reference = image
+            if self.roi_crop is not None:
+                reference,img_out = self.crop_to_roi(database,patient_dir,image,img_out,
+                                                     os.path.join(mask_dir,'labels_resampled'+self.output_ext))
+            #nearest neighbour keeps the label values
+            with self.report.stage('resample'):
+                new_image = self.resampler.resample(img_out,kind='mask',reference=reference)
+            with self.report.stage('write'):
+                sitk.WriteImage(new_image, os.path.join(mask_dir,'labels_resampled'+self.output_ext))
+
+
+    def crop_to_roi(self,database,patient_dir,image,mask,output_path):
+        '''
+        crop the t2 and a mask on its grid to the gland voi (see roi_crop.RoiCrop), the same box Dicom2Nifti uses for
+        the series, the crop record is written next to output_path
+        :return: (cropped t2, the reference of the resampling, cropped mask)
+        '''
+        voi_dir=os.path.join(self.anonymize_database,database,patient_dir,'voi')
+        with self.report.stage('crop'):
+            region=self.roi_crop.voi_region(voi_dir,image,cache=self.voi_cache)
+            self.roi_crop.save_record(image,region,output_path)
+            return self.roi_crop.crop(image,region),self.roi_crop.crop(mask,region)
 
-            #t2 resample
-            resample = sitk.ResampleImageFilter()
-            resample.SetInterpolator = sitk.sitkLinear
-            resample.SetOutputSpacing(new_spacing)
-            resample.SetSize(new_size)
-            resample.SetOutputDirection(image.GetDirection())
-            resample.SetOutputOrigin(image.GetOrigin())
-            image_resamp = resample.Execute(image)
-            new_image = resample.Execute(img_out)
-            new_arr = sitk.GetArrayFromImage(new_image)
-            new_arr[new_arr>0]=1
-            new_image = sitk.GetImageFromArray(new_arr)
-            new_image.CopyInformation(image_resamp)
 
-            sitk.WriteImage(new_image, type.split('.')[0] + '_resampled.nii')
+    def read_series(self,series_dir):
+        '''read a dicom series, through the prefetcher while one is running'''
+        if self.prefetcher is not None:
+            return self.prefetcher.read(series_dir)
+        return read_dicom_series(series_dir)
 
 
+    def label_names(self):
+        '''"labels" section of datalist.json matching the label volumes'''
+        return label_names(self.label_map)
 
 
     def mask_coord_dict(self,database='',patient_dir='',type=''):
@@ -160,22 +426,17 @@ class VOI_to_nifti_mask(ParseVOI):
         # define path to voi file
         voi_path=os.path.join(self.anonymize_database,database,patient_dir,'voi',type)
 
-        #read in .voi file as pandas df
-        pd_df = pd.read_fwf(voi_path)
-
-        # use get_ROI_slice_loc to find location of each segment
-        dict=self.get_ROI_slice_loc(voi_path)
+        # read .voi file once, contours grouped by slice
+        contour_dict=self.slice_contour_dict(voi_path)
         img_shape=self.get_image_size(patient_dir=os.path.join(self.anonymize_database,database,patient_dir))
 
         output_dict={}
-        for slice in dict.keys():
-            values=dict[slice]
-            select_val=list(range(values[1],values[2]))
-            specific_part=pd_df.iloc[select_val,:]
-            split_df = specific_part.join(specific_part['MIPAV VOI FILE'].str.split(' ', 1, expand=True).rename(columns={0: "X", 1: "Y"})).drop(['MIPAV VOI FILE'], axis=1)
-            X_coord=np.array(split_df['X'].tolist(),dtype=float).astype(int)
-            Y_coord=np.array(split_df['Y'].tolist(),dtype=float).astype(int)
-            mask=self.poly2mask(vertex_row_coords=X_coord, vertex_col_coords=Y_coord, shape=img_shape)
+        for slice in contour_dict.keys():
+            mask=np.zeros(img_shape,dtype=np.uint8)
+            for vertices in contour_dict[slice]:
+                X_coord=vertices[:,0].astype(int)
+                Y_coord=vertices[:,1].astype(int)
+                mask|=self.poly2mask(vertex_row_coords=X_coord, vertex_col_coords=Y_coord, shape=img_shape)
             output_dict[slice]=mask
 
         return(output_dict)
@@ -187,14 +448,9 @@ class VOI_to_nifti_mask(ParseVOI):
         return shape of image (num pixels in x and y directions)
         '''
 
-        #get path to first image in each directory
-        patient_dir_full=os.path.join(patient_dir,'dicoms','t2')
-        directory=os.path.join(patient_dir_full,os.listdir(os.path.join(patient_dir_full))[0])
-
-        #read in data and get shape
-        ds = pydicom.dcmread(directory,force=True)
-        data = ds.pixel_array
-        return(data.shape)
+        #rows/columns come from the header-only slice index, no pixel data is decoded
+        index = index_dicom_series(os.path.join(patient_dir,'dicoms','t2'))
+        return((index.rows,index.columns))
 
 
     def get_all_paths_image_dir(self,patient_dir=''):
@@ -209,7 +465,7 @@ class VOI_to_nifti_mask(ParseVOI):
     def poly2mask(self,vertex_row_coords, vertex_col_coords, shape):
         ''''''
         fill_row_coords, fill_col_coords = draw.polygon(vertex_row_coords, vertex_col_coords, shape)
-        mask = np.zeros(shape, dtype=np.int)
+        mask = np.zeros(shape, dtype=np.uint8)
         mask[fill_row_coords, fill_col_coords] = 1
         return mask
 
@@ -219,13 +475,7 @@ class VOI_to_nifti_mask(ParseVOI):
         :param dicom_file_list
         :return list of files in correct order
         '''
-        dicoms={}
-        for path in dicom_file_list:
-            file=path
-            ds=pydicom.read_file(path,force=True)
-            dicoms[str(file)] = float(ds.SliceLocation)
-        updated_imagelist=[key for (key, value) in sorted(dicoms.items(), key=lambda x: x[1])]
-        return(updated_imagelist)
+        return(order_dicom_files(dicom_file_list).paths)
 
 
 
@@ -233,4 +483,6 @@ class VOI_to_nifti_mask(ParseVOI):
 if __name__=='__main__':
     c=VOI_to_nifti_mask()
     c.create_masks_all_patients()
+    c.report.summary()
+    c.report.save(report_path(os.path.dirname(c.get_manifest().path)))
 
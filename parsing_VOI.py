@@ -1,8 +1,13 @@
 #author @t_sanf
 
 import os
-import pandas as pd
+import hashlib
+import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from collections import Counter
+from collections import namedtuple
 from functools import reduce
 from xml.etree.ElementTree import ElementTree
 from xml.etree.ElementTree import Element
@@ -12,8 +17,11 @@ import xml.etree.ElementTree as etree
 class ParseVOI(object):
     '''
     Convert VOI files to bounding boxes
+    -- set voi_cache to a VOICache to load parsed contours from binary files instead of re-reading the text
     '''
 
+    voi_cache=None
+
     def __init__(self):
         '''
         :param filePATH (str) --> the path to the directory containing VOI files of interest
@@ -21,14 +29,16 @@ class ParseVOI(object):
         self.PATH=''
 
     def list_of_dicts_all_images(self,filepaths):
-        '''takes a
+        '''takes a list of .voi files and returns the bounding boxes of each
+        note - for large datasets use bbox_table, which is parallel and returns one array for all files
 
         :param filepaths --> list of filepaths
-        :output
+        :output list of dicts from BBox_from_position, one per file
         '''
 
-        for file in os.listdir(filepaths):
-            one_dict=self.BBox_from_position(path=file)
+        list_segment=[]
+        for path in filepaths:
+            one_dict=self.BBox_from_position(path=path)
             list_segment.append(one_dict)
         return(list_segment)
 
@@ -53,78 +63,283 @@ class ParseVOI(object):
 
     def BBox_from_position(self,path):
         '''
-        take output from get ROI_slice_loc and return category and bbox for each slice
+        parse the .voi file once and return category and bbox for each slice
         :return: dict {slice:(category,xmin,ymin,xmax,ymax)}
         '''
 
-        pd_df=pd.read_fwf(path)
+        filename=path.split(os.sep)[-1].split('.')[0]
+
+        # single pass over the file, take min/max over every contour on the slice
+        bbox_dict={}
+        for slice, vertices in self.slice_vertex_dict(path).items():
+            xmin,ymin=vertices.min(axis=0)
+            xmax,ymax=vertices.max(axis=0)
+            bbox_dict[slice]=(filename,int(xmin),int(ymin),int(xmax),int(ymax))
+        return(bbox_dict)
+
 
-        # use get_ROI_slice_loc to find location of each segment
-        dict=self.get_ROI_slice_loc(path=path)
-        for slice in dict.keys():
-            values=dict[slice]
-            category=values[0]
-            select_val=list(range(values[1],values[2]))
-            specific_part=pd_df.iloc[select_val,:]
-            split_df = specific_part.join(specific_part['MIPAV VOI FILE'].str.split(' ', 1, expand=True).rename(columns={0: "X", 1: "Y"})).drop(['MIPAV VOI FILE'], axis=1)
+    def bbox_table(self,path,workers=None,chunksize=64):
+        '''
+        bounding boxes of every .voi file in a directory tree, files are parsed in parallel
+        :param path (str) --> root directory, searched recursively
+        :param workers (int) --> number of processes, defaults to the number of cpus, 1 parses in this process
+        :return: structured numpy array with fields file, slice, category, xmin, ymin, xmax, ymax, one row per
+                 slice of every file (see voi_bboxes), files are in sorted path order
+            -- file is the path relative to the root directory, files that cannot be parsed are left out and printed
+        '''
 
-            # parse to find max/min X and Y values, save into dictionary
-            xmin = int(float(split_df["X"].min()))
-            ymin = int(float(split_df["Y"].min()))
-            xmax = int(float(split_df["X"].max()))
-            ymax = int(float(split_df["Y"].max()))
-            tuple=(category,xmin,ymin,xmax,ymax)
-            dict.update({slice:tuple})
-        return(dict)
+        paths=[]
+        for root,dirs,files in os.walk(path):
+            dirs.sort()
+            paths+=[os.path.join(root,file) for file in sorted(files) if file.endswith('.voi')]
+
+        if workers is None:
+            workers=os.cpu_count() or 1
+        if workers<=1 or len(paths)<=chunksize:
+            results=map(partial(_voi_bboxes_or_error,cache=self.voi_cache),paths)
+            pool=None
+        else:
+            pool=ProcessPoolExecutor(max_workers=workers,mp_context=multiprocessing.get_context('spawn'))
+            results=pool.map(partial(_voi_bboxes_or_error,cache=self.voi_cache),paths,chunksize=chunksize)
+
+        tables=[]
+        try:
+            for file,(table,error) in zip(paths,results):
+                if error is not None:
+                    print('cannot parse file {}: {}'.format(file,error))
+                    continue
+                table['file']=os.path.relpath(file,path)
+                tables+=[table]
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return bbox_concatenate(tables)
 
 
     def get_ROI_slice_loc(self,path=None):
         '''
         selects each slice number and the location of starting coord and end coord
+        note - locations are row offsets as counted by the old pd.read_fwf parser (header row excluded)
         :return: dict of {slice number:(tuple of start location, end location)}
 
         '''
 
-        pd_df=pd.read_fwf(path)
-
         #get the name of the file
         filename=path.split(os.sep)[-1].split('.')[0]
 
-        #initialize empty list and empty dictionary
-        slice_num_list=[]
-        last_line=[]
         loc_dict={}
+        for contour in self.iter_contours(path):
+            slice_num=str(contour.slice)
+            if slice_num in loc_dict:
+                start=loc_dict[slice_num][1]
+            else:
+                start=contour.start-1
+            loc_dict.update({slice_num:(filename,start,contour.end-2)})
+        return(loc_dict)
 
-        #find the location of the last line -->
-
-        for line in range(len(pd_df)):
-            line_specific=pd_df.iloc[line,:]
-            as_list=line_specific.str.split(r"\t")[0]
-            if "# slice number" in as_list: #find location of all #slice numbers
-                slice_num_list.append(line)
-            if '# unique ID of the VOI' in as_list:
-                last_line.append(line)
-
-        for i in range(len(slice_num_list)):
-            #for all values except the last value
-            if i<(len(slice_num_list)-1):
-                loc=slice_num_list[i]
-                line_specific=pd_df.iloc[loc,:]
-                slice_num=line_specific.str.split(r"\t")[0][0]
-                start=slice_num_list[i]+3
-                end=slice_num_list[i+1]-1
-                loc_dict.update({slice_num:(filename,start,end)})
-
-            #for the last value
-            if i == (len(slice_num_list) - 1):
-                loc = slice_num_list[i]
-                line_specific=pd_df.iloc[loc,:]
-                slice_num=line_specific.str.split(r"\t")[0][0]
-                start=slice_num_list[i]+3
-                end=(last_line[0]-1)
-                loc_dict.update({slice_num: (filename, start, end)})
 
-        return(loc_dict)
+    def slice_contour_dict(self,path):
+        '''
+        read a .voi file once and group contours by slice
+        :param path (str) --> path to .voi file
+        :return: dict of {slice number (str): [list of (n_pts,2) float arrays of X,Y vertices]}
+        '''
+
+        contour_dict={}
+        for contour in self.iter_contours(path):
+            contour_dict.setdefault(str(contour.slice),[]).append(contour.vertices)
+        return(contour_dict)
+
+
+    def slice_vertex_dict(self,path):
+        '''
+        same as slice_contour_dict but with all contours of a slice stacked into one vertex array
+        :return: dict of {slice number (str): (n_pts,2) float array of X,Y vertices}
+        '''
+
+        return({slice:np.concatenate(contours,axis=0) for slice,contours in self.slice_contour_dict(path).items()})
+
+
+    def iter_contours(self,path):
+        '''contours of a .voi file, from self.voi_cache when one is set, see iter_voi_contours'''
+        if self.voi_cache is None:
+            return iter_voi_contours(path)
+        return iter(self.voi_cache.contours(path))
+
+
+##########helper functions##########
+Contour=namedtuple('Contour',['slice','start','end','vertices'])
+
+def iter_voi_contours(path):
+    '''
+    streaming parser for MIPAV .voi files, reads the file line by line exactly once
+    -- a new contour starts at each '# number of pts in contour' line, the vertex lines that follow are 'X Y [Z]'
+    -- a contour ends at the next header line ('# ...') or at the end of the file
+    :param path (str) --> path to .voi file
+    :return: generator of Contour(slice, start, end, vertices)
+        -- start/end are the 0-based line numbers of the vertex block in the file, end exclusive
+        -- vertices is an (n_pts,2) float64 array of X,Y coordinates
+    '''
+
+    slice_num=None
+    points=None
+    start=0
+    with open(path,'r') as f:
+        for line_num,line in enumerate(f):
+            if '#' not in line:
+                if points is not None:
+                    xy=line.split()
+                    if len(xy)>=2:
+                        points.append((float(xy[0]),float(xy[1])))
+                continue
+
+            #any header line closes the contour currently being read
+            if points is not None:
+                if points:
+                    yield Contour(slice_num,start,line_num,np.array(points,dtype=np.float64))
+                points=None
+
+            value,comment=line.split('#',1)
+            comment=comment.strip()
+            if comment.startswith('slice number'):
+                slice_num=int(value)
+            elif comment.startswith('number of pts in contour'):
+                points=[]
+                start=line_num+1
+
+        if points:
+            yield Contour(slice_num,start,line_num+1,np.array(points,dtype=np.float64))
+
+
+class VOICache:
+    '''
+    on-disk cache of parsed .voi files, so unchanged files are never tokenized again, opt-in: pass one as voi_cache
+    -- each .voi file is stored as two .npy files named after the sha1 of its absolute path:
+        -- <hash>.npy: every vertex of the file, (n_pts,2) float64, read in one go on load, contours are views into it
+        -- <hash>.idx.npy: int64 table, row 0 is (file size, file mtime_ns, format version, 0, 0),
+           then one row (slice, start, end, vertex offset, vertex count) per contour
+    -- an entry is valid while the .voi file has the same size and mtime, otherwise it is parsed and written again
+    -- entries are written to .part files and renamed, concurrent workers never read a half written entry
+    -- entries are not memory mapped, an open mapping would make the rename of a refreshed entry fail on windows
+    -- the cache only speeds up parsing, an entry that cannot be written is reported and the parsed contours returned
+    '''
+
+    VERSION=1
+
+    def __init__(self,cache_dir=os.path.join(os.path.expanduser('~'),'.cache','clara_scripts','voi')):
+        self.cache_dir=cache_dir
+
+    def entry_paths(self,path):
+        '''(vertex file, index file) of the cache entry of a .voi file'''
+        name=hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+        return os.path.join(self.cache_dir,name+'.npy'),os.path.join(self.cache_dir,name+'.idx.npy')
+
+    def contours(self,path):
+        '''
+        parsed contours of a .voi file, loaded from the cache or parsed and stored
+        :return: list of Contour(slice, start, end, vertices), vertices are views into the array of the whole file
+        '''
+
+        stat=os.stat(path)
+        vertex_path,index_path=self.entry_paths(path)
+        try:
+            index=np.load(index_path)
+            if tuple(index[0,:3])!=(stat.st_size,stat.st_mtime_ns,self.VERSION):
+                raise ValueError('stale cache entry')
+            vertices=np.load(vertex_path) if index[1:,4].sum() else np.zeros((0,2))
+        except (OSError,ValueError,IndexError):
+            return self.store(path,stat)
+        return [Contour(int(slice),int(start),int(end),vertices[offset:offset+count])
+                for slice,start,end,offset,count in index[1:]]
+
+    def store(self,path,stat=None):
+        '''parse a .voi file and write its cache entry, returns the parsed contours'''
+
+        if stat is None:
+            stat=os.stat(path)
+        contours=list(iter_voi_contours(path))
+        counts=[len(contour.vertices) for contour in contours]
+        offsets=np.cumsum([0]+counts[:-1])
+        index=np.array([[stat.st_size,stat.st_mtime_ns,self.VERSION,0,0]]+
+                       [[contour.slice,contour.start,contour.end,offset,count] for contour,offset,count in zip(contours,offsets,counts)],
+                       dtype=np.int64)
+        vertices=np.concatenate([contour.vertices for contour in contours]) if contours else np.zeros((0,2))
+
+        vertex_path,index_path=self.entry_paths(path)
+        try:
+            os.makedirs(self.cache_dir,exist_ok=True)
+            for out_path,array in ((vertex_path,vertices),(index_path,index)):
+                part_path='{}.{}.part'.format(out_path,os.getpid())
+                try:
+                    with open(part_path,'wb') as f:
+                        np.save(f,array)
+                    os.replace(part_path,out_path)
+                finally:
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+        except OSError as e:
+            print('voi cache entry of {} not written: {}'.format(path,e))
+        return contours
+
+    def clear(self):
+        '''remove every cache entry'''
+        if os.path.isdir(self.cache_dir):
+            for file in os.listdir(self.cache_dir):
+                if file.endswith('.npy'):
+                    os.remove(os.path.join(self.cache_dir,file))
+
+
+def voi_bboxes(path,cache=None):
+    '''
+    bounding box of every slice of one .voi file, same numbers as ParseVOI.BBox_from_position (coordinates truncated
+    to int) in one row per slice, sorted by slice
+    :param path (str) --> path to .voi file
+    :param cache (VOICache) --> load the contours from this cache
+    :return: structured numpy array, fields file (str), slice (int32), category (str, the file name without extension),
+             xmin, ymin, xmax, ymax (int32)
+    '''
+
+    boxes={}
+    for contour in (iter_voi_contours(path) if cache is None else cache.contours(path)):
+        box=np.concatenate([contour.vertices.min(axis=0),contour.vertices.max(axis=0)])
+        if contour.slice in boxes:
+            old=boxes[contour.slice]
+            box=np.concatenate([np.minimum(old[:2],box[:2]),np.maximum(old[2:],box[2:])])
+        boxes[contour.slice]=box
+
+    category=path.split(os.sep)[-1].split('.')[0]
+    table=np.zeros(len(boxes),dtype=bbox_dtype(len(path),len(category)))
+    table['file']=path
+    table['category']=category
+    if boxes:
+        slices=sorted(boxes)
+        table['slice']=slices
+        coords=np.array([boxes[slice] for slice in slices]).astype(np.int32)
+        for i,field in enumerate(('xmin','ymin','xmax','ymax')):
+            table[field]=coords[:,i]
+    return table
+
+
+def bbox_dtype(file_len=1,category_len=1):
+    '''dtype of a bounding box table, strings are fixed width numpy unicode'''
+    return np.dtype([('file','U{}'.format(max(file_len,1))),('slice',np.int32),('category','U{}'.format(max(category_len,1))),
+                     ('xmin',np.int32),('ymin',np.int32),('xmax',np.int32),('ymax',np.int32)])
+
+
+def bbox_concatenate(tables):
+    '''concatenate bounding box tables, string fields are widened to the longest entry'''
+    file_len=max([table.dtype['file'].itemsize//4 for table in tables]+[1])
+    category_len=max([table.dtype['category'].itemsize//4 for table in tables]+[1])
+    dtype=bbox_dtype(file_len,category_len)
+    return np.concatenate([table.astype(dtype) for table in tables]) if tables else np.zeros(0,dtype=dtype)
+
+
+def _voi_bboxes_or_error(path,cache=None):
+    '''voi_bboxes inside a worker, errors are returned so one bad file does not stop the pool'''
+    try:
+        return voi_bboxes(path,cache=cache),None
+    except Exception as e:
+        return None,repr(e)
 
 
 def intersection(list1, list2):
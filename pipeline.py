@@ -0,0 +1,295 @@
+#author @t_sanf
+
+import os
+import re
+import json
+import queue
+import threading
+import traceback
+import numpy as np
+import SimpleITK as sitk
+from dicom_io import read_dicom_series
+from parsing_VOI import iter_voi_contours
+from rasterize import rasterize_contours, rasterize_label_map, label_names
+from resampling import ResampleEngine
+from roi_crop import record_path
+from build_manifest import BuildManifest, list_files
+from dataset_index import DatasetIndex
+from dataprep_for_clara import CLARA_HEADER
+from instrumentation import run_report, report_path
+
+# marks the end of the patient stream, passed from stage to stage
+END=None
+
+
+class ClaraPipeline:
+    '''
+    stream every patient from dicom + voi straight into a clara dataset: convert -> mask -> resample -> write
+    -- replaces running dicom2nifti_withAlign_withResample, nifti_mask_withResample, sort_data and clara_filestructure
+       by hand, where every stage wrote full volumes to disk for the next one to read back
+    -- each stage runs in its own thread and hands volumes to the next one through a bounded queue, at most
+       queue_size patients wait between two stages so memory stays bounded however large the database is
+    -- only the final img_<id>.nii.gz / seg_<id>.nii.gz are written, compressed in the same write
+    -- a patient that fails in any stage is passed through to the end with its traceback, the other patients go on
+    -- patients of different databases that map to the same dataset id are reported and only the first one is written
+    '''
+
+    def __init__(self):
+        self.basePATH='/home/tom/Desktop/'
+        self.databases=['prostateX']
+        self.savepath='/home/tom/clara_experiments/data_prostate/SUNY_wp_for_clara'  #dataset directory, img_/seg_ files
+        self.clarapath='/workspace/data/data_prostate/SUNY_wp_for_clara'  #same directory as seen from clara
+        self.voi_type='wp'  #segmentation written as the label, matched case-insensitively in the voi file name
+        self.label_map=None  #(name, label) pairs, e.g. rasterize.LABEL_MAP, fuses every matching voi into one label volume instead of voi_type
+        self.resampler=ResampleEngine(new_spacing=[1,1,1])
+        self.roi_crop=None  #roi_crop.RoiCrop(margin=10) crops image and label to the gland (wp voi) before resampling, None keeps the full field of view
+        self.contour_mode='union'  #see rasterize.rasterize_contours
+        self.voi_cache=None  #parsing_VOI.VOICache(cache_dir) keeps parsed .voi files as binary, None re-reads the text every time
+        self.queue_size=2  #patients held between two stages
+        self.keep_intermediates=False  #also write the native resolution t2 and mask to nifti/ as the old scripts did
+        self.incremental=True  #skip patients whose dicoms, voi and settings did not change since the last run
+        self.manifest_path=None  #build manifest file, defaults to savepath/build_manifest.sqlite
+        self.manifest=None
+        self.skipped=[]  #(patient directory, reason) of patients left out by the last find_patients
+        self.report=run_report  #per patient, per stage timings, see instrumentation.RunReport
+
+    def run(self,val_p=0.2,seed=0):
+        '''
+        run every patient of every database through the pipeline and write datalist.json
+        :param val_p (float): fraction of the dataset in the validation set
+        :param seed (int): random seed of the training/validation split
+        :return: list of (patient directory, traceback) that failed
+        '''
+
+        if not os.path.exists(self.savepath):
+            os.makedirs(self.savepath)
+
+        stages=[self.read_stage,self.mask_stage,self.resample_stage,self.write_stage]
+        queues=[queue.Queue(maxsize=self.queue_size) for stage in stages]
+        results=queue.Queue()
+        threads=[threading.Thread(target=self.run_stage,args=(stage,queues[i],queues[i+1] if i+1<len(stages) else results),
+                                  name=stage.__name__,daemon=True) for i,stage in enumerate(stages)]
+        for thread in threads:
+            thread.start()
+
+        patients=self.find_patients()
+        print('total of {} patients to process'.format(len(patients)))
+        for database,patient in patients:
+            queues[0].put({'database':database,'patient':patient})
+        queues[0].put(END)
+
+        exception_logger=list(self.skipped)
+        for item in iter(results.get,END):
+            if 'error' in item:
+                print('patient {} failed in {}'.format(item['patient'],item['stage']))
+                exception_logger+=[(os.path.join(self.basePATH,item['database'],item['patient']),item['error'])]
+            else:
+                print('patient {} done'.format(item['patient']))
+        for thread in threads:
+            thread.join()
+
+        self.write_datalist(val_p=val_p,seed=seed)
+        print("all patients that cannot be processed: {}".format([patient for patient,error in exception_logger]))
+        return exception_logger
+
+    def run_stage(self,stage,in_queue,out_queue):
+        '''apply one stage to every item of in_queue, failed items skip the remaining stages'''
+
+        for item in iter(in_queue.get,END):
+            if 'error' not in item:
+                try:
+                    with self.report.patient(item['database']+'/'+item['patient']):
+                        stage(item)
+                except Exception:
+                    item['stage']=stage.__name__
+                    item['error']=traceback.format_exc()
+                    # drop the volumes of a failed patient right away
+                    for key in ('t2','mask'):
+                        item.pop(key,None)
+            out_queue.put(item)
+        out_queue.put(END)
+
+    def find_patients(self):
+        '''
+        (database, patient) of every patient with a t2 series and a voi file, minus patients that are up to date
+        -- a patient whose dataset id was already taken by a patient of another database would overwrite its
+           img_/seg_ pair, it is left out and listed in self.skipped
+        '''
+
+        patients=[]; owners={}; self.skipped=[]
+        for database in self.databases:
+            for patient in sorted(os.listdir(os.path.join(self.basePATH,database))):
+                if not os.path.isdir(os.path.join(self.basePATH,database,patient,'dicoms','t2')):
+                    continue
+                if not self.find_vois(database,patient):
+                    print('no {} voi file for patient {}'.format(self.voi_type if self.label_map is None else 'labelled',patient))
+                    continue
+                id=self.patient_id(patient)
+                if id in owners:
+                    reason='dataset id {} is already used by {}'.format(id,owners[id])
+                    print('patient {} of {} skipped, {}'.format(patient,database,reason))
+                    self.skipped+=[(os.path.join(self.basePATH,database,patient),reason)]
+                    continue
+                owners[id]=database+'/'+patient
+                if self.incremental and self.get_manifest().is_current('pipeline',database+'/'+patient,
+                                                                       *self.build_info(database,patient)):
+                    continue
+                patients+=[(database,patient)]
+        return patients
+
+    def find_voi(self,database,patient):
+        '''path to the first voi file of self.voi_type (e.g. wp_bt.voi), None if the patient has none'''
+
+        voi_dir=os.path.join(self.basePATH,database,patient,'voi')
+        if not os.path.isdir(voi_dir):
+            return None
+        pat=re.compile(re.escape(self.voi_type),re.IGNORECASE)
+        for file in sorted(os.listdir(voi_dir)):
+            if file.endswith('.voi') and pat.search(file)!=None:
+                return os.path.join(voi_dir,file)
+        return None
+
+    def find_vois(self,database,patient):
+        '''voi files that make up the label of a patient, every file matching label_map or the voi_type file'''
+
+        if self.label_map is None:
+            voi_path=self.find_voi(database,patient)
+            return [] if voi_path is None else [voi_path]
+        voi_dir=os.path.join(self.basePATH,database,patient,'voi')
+        if not os.path.isdir(voi_dir):
+            return []
+        pats=[re.compile(re.escape(name),re.IGNORECASE) for name,label in self.label_map]
+        return [os.path.join(voi_dir,file) for file in sorted(os.listdir(voi_dir))
+                if file.endswith('.voi') and any(pat.search(file)!=None for pat in pats)]
+
+    def load_contours(self,voi_path):
+        '''contours of a voi file, through the voi cache when there is one'''
+        return list(iter_voi_contours(voi_path)) if self.voi_cache is None else self.voi_cache.contours(voi_path)
+
+    def patient_id(self,patient):
+        '''dataset id of a patient directory, same naming as ToClaraFormat.sort_data(anon=False)'''
+        return patient.split('_')[0]
+
+    def build_info(self,database,patient):
+        '''inputs, parameters and outputs of one patient, as stored in the build manifest'''
+
+        inputs=list_files(os.path.join(self.basePATH,database,patient,'dicoms','t2'))+self.find_vois(database,patient)
+        id=self.patient_id(patient)
+        outputs=[os.path.join(self.savepath,'img_'+id+'.nii.gz'),os.path.join(self.savepath,'seg_'+id+'.nii.gz')]
+        params={'spacing':self.resampler.new_spacing,'interpolators':self.resampler.interpolators,
+                'contour_mode':self.contour_mode,'voi_type':self.voi_type,'label_map':self.label_map}
+        if self.roi_crop is not None:
+            voi_path=self.roi_crop.find_voi(os.path.join(self.basePATH,database,patient,'voi'))
+            if voi_path is not None and voi_path not in inputs:
+                inputs+=[voi_path]
+            outputs+=[record_path(outputs[0])]
+            params['roi_crop']=self.roi_crop.params()
+        return inputs,params,outputs
+
+    def get_manifest(self):
+        '''build manifest kept in the dataset directory, opened on first use'''
+        if self.manifest_path is None:
+            self.manifest_path=os.path.join(self.savepath,'build_manifest.sqlite')
+        if self.manifest is None or self.manifest.path!=self.manifest_path:
+            self.manifest=BuildManifest(self.manifest_path)
+        return self.manifest
+
+    ###### stages, each one fills in the item handed to the next ######
+
+    def read_stage(self,item):
+        '''decode the t2 dicom series'''
+        with self.report.stage('dicom_read'):
+            item['t2']=read_dicom_series(os.path.join(self.basePATH,item['database'],item['patient'],'dicoms','t2'))
+
+    def mask_stage(self,item):
+        '''rasterize the voi on the t2 grid, the mask only exists in memory'''
+
+        image=item['t2']
+        numpy_mask=np.zeros(image.GetSize()[::-1],dtype=np.uint8)
+        if self.label_map is not None:
+            with self.report.stage('rasterize'):
+                rasterize_label_map(self.find_vois(item['database'],item['patient']),numpy_mask,label_map=self.label_map,
+                                    mode=self.contour_mode,load=self.load_contours)
+        else:
+            with self.report.stage('voi_parse'):
+                contours=self.load_contours(self.find_voi(item['database'],item['patient']))
+            with self.report.stage('rasterize'):
+                rasterize_contours(contours,numpy_mask,mode=self.contour_mode)
+        mask=sitk.GetImageFromArray(numpy_mask)
+        mask.CopyInformation(image)
+        item['mask']=mask
+
+    def resample_stage(self,item):
+        '''resample image and mask onto the same grid, computed from the t2 header'''
+
+        if self.keep_intermediates:
+            nifti_dir=os.path.join(self.basePATH,item['database'],item['patient'],'nifti')
+            voi_name='labels' if self.label_map is not None else os.path.basename(self.find_voi(item['database'],item['patient'])).split('.')[0]
+            for name in ('t2','mask'):
+                if not os.path.exists(os.path.join(nifti_dir,name)):
+                    os.makedirs(os.path.join(nifti_dir,name))
+            with self.report.stage('write'):
+                sitk.WriteImage(item['t2'],os.path.join(nifti_dir,'t2','t2.nii.gz'))
+                sitk.WriteImage(item['mask'],os.path.join(nifti_dir,'mask',voi_name+'.nii.gz'))
+
+        if self.roi_crop is not None:
+            with self.report.stage('crop'):
+                voi_dir=os.path.join(self.basePATH,item['database'],item['patient'],'voi')
+                region=self.roi_crop.voi_region(voi_dir,item['t2'],cache=self.voi_cache)
+                item['crop']=self.roi_crop.record(item['t2'],region)
+                item['t2']=self.roi_crop.crop(item['t2'],region)
+                item['mask']=self.roi_crop.crop(item['mask'],region)
+
+        with self.report.stage('resample'):
+            image=item['t2']
+            item['mask']=self.resampler.resample(item['mask'],kind='mask',reference=image)
+            item['t2']=self.resampler.resample(image)
+
+    def write_stage(self,item):
+        '''
+        write the final compressed img_/seg_ pair into the dataset directory and record it in the manifest
+        -- both files are written under hidden temporary names and renamed once both writes succeeded, a failed write
+           leaves no img_ without its seg_ (or the reverse) in the dataset
+        '''
+
+        id=self.patient_id(item['patient'])
+        paths=[os.path.join(self.savepath,'img_'+id+'.nii.gz'),os.path.join(self.savepath,'seg_'+id+'.nii.gz')]
+        temps=[os.path.join(self.savepath,'.'+os.path.basename(path)) for path in paths]
+        replacing=False
+        with self.report.stage('write'):
+            try:
+                sitk.WriteImage(item.pop('t2'),temps[0])
+                sitk.WriteImage(item.pop('mask'),temps[1])
+                replacing=True
+                for temp,path in zip(temps,paths):
+                    os.replace(temp,path)
+            except Exception:
+                for path in temps+(paths if replacing else []):
+                    if os.path.exists(path):
+                        os.remove(path)
+                raise
+        if 'crop' in item:
+            with open(record_path(os.path.join(self.savepath,'img_'+id+'.nii.gz')),'w') as outfile:
+                json.dump(item.pop('crop'),outfile,indent=2)
+        self.get_manifest().record('pipeline',item['database']+'/'+item['patient'],
+                                   *self.build_info(item['database'],item['patient']))
+
+    def write_datalist(self,val_p=0.2,seed=0):
+        '''datalist.json next to the dataset, built from one scan of the dataset directory, unpaired ids are reported and left out'''
+
+        header=dict(CLARA_HEADER)
+        if self.label_map is not None:
+            header['labels']=label_names(self.label_map)
+        index=DatasetIndex().scan(self.savepath)
+        missing=index.unpaired()
+        if missing:
+            print('{} ids do not have both an image and a segmentation and are left out of the datalist: {}'.format(len(missing),missing))
+        return index.write_datalists({'datalist.json':index.split_random(val_p=val_p,seed=seed)},self.savepath,
+                                     header,prefix=self.clarapath)
+
+
+if __name__=='__main__':
+    c=ClaraPipeline()
+    c.run()
+    c.report.summary()
+    c.report.save(report_path(os.path.dirname(c.get_manifest().path)))
@@ -0,0 +1,144 @@
+#author @t_sanf
+
+import os
+import re
+import numpy as np
+from parsing_VOI import iter_voi_contours
+
+# default label volume: structures are painted in this order, later entries win where they overlap
+LABEL_MAP=[('wp',1),('tz',2),('PIRADS',3)]
+
+
+def rasterize_contours(contours,volume,mode='union',value=1):
+    '''
+    fill polygon contours straight into a preallocated volume, no full-slice temporary arrays are made
+    -- volume is in SimpleITK array order (slice, row, column), i.e. (z, y, x), contour vertices are (X, Y)
+    -- vertices are truncated to integer pixels before filling, same as the old poly2mask path
+    -- the old path called skimage.draw.polygon with X as the row coordinate and swapped the axes afterwards, the
+       pixel rule is not symmetric under that swap (pixels on concave or self-touching edges differ), so the spans
+       are computed along X (one run per column) to reproduce the old masks pixel for pixel
+    :param contours: iterable of parsing_VOI.Contour (e.g. iter_voi_contours(path))
+    :param volume (np.ndarray): uint8 volume, modified in place
+    :param mode (str): 'union' sets every pixel inside any contour,
+                       'xor' toggles pixels so a contour drawn inside another one on the same slice becomes a hole
+    :param value (int): value written inside the contours
+    :return: volume
+    '''
+
+    if mode not in ('union','xor'):
+        raise ValueError('unknown rasterization mode {}'.format(mode))
+
+    shape=volume.shape[:0:-1]  # (columns, rows), the plane is filled through its transpose
+    for contour in contours:
+        vertices=contour.vertices.astype(int)
+        plane=volume[int(contour.slice)].T
+        for column,start,stop in polygon_spans(vertices[:,1],vertices[:,0],shape):
+            if mode=='union':
+                plane[column,start:stop]=value
+            else:
+                plane[column,start:stop]^=value
+    return volume
+
+
+def polygon_spans(x,y,shape):
+    '''
+    scanline fill of one polygon with integer vertices, vectorized over all edges of the polygon
+    -- same pixel rule as skimage.draw.polygon (used by poly2mask): a pixel is filled when it is a vertex or when a
+       ray to its right or a ray to its left crosses an odd number of edges, which also picks up pixels on an edge
+    -- cost is O(edges + rows) instead of O(edges * pixels in the bounding box)
+    :param x, y (np.ndarray): integer vertex column and row coordinates
+    :param shape (tuple): (rows, columns) of the plane, spans are clipped to it
+    :return: list of (row, start column, stop column) runs, stop exclusive, runs never overlap
+    '''
+
+    x=np.asarray(x,dtype=np.int64); y=np.asarray(y,dtype=np.int64)
+    x_next=np.roll(x,-1); y_next=np.roll(y,-1)
+    dx=x_next-x; dy=y_next-y
+    n_rows=np.abs(dy)
+    edge=np.repeat(np.arange(len(x)),n_rows)
+    ramp=_ramp(n_rows)
+
+    # ray to the right: edges cross rows [min y, max y), odd crossings right of the pixel for [ceil(x0), ceil(x1))
+    rows=np.repeat(np.minimum(y,y_next),n_rows)+ramp
+    right_rows,right_starts,right_stops=_pair_crossings(rows,dx[edge]*(rows-y[edge])/dy[edge]+x[edge],np.ceil,0)
+
+    # ray to the left: edges cross rows (min y, max y], odd crossings left of the pixel for (floor(x0), floor(x1)]
+    rows=rows+1
+    left_rows,left_starts,left_stops=_pair_crossings(rows,dx[edge]*(rows-y[edge])/dy[edge]+x[edge],np.floor,1)
+
+    rows=np.concatenate([right_rows,left_rows,y])
+    starts=np.clip(np.concatenate([right_starts,left_starts,x]),0,shape[1])
+    stops=np.clip(np.concatenate([right_stops,left_stops,x+1]),0,shape[1])
+    keep=(rows>=0)&(rows<shape[0])&(stops>starts)
+    return _merge_spans(rows[keep],starts[keep],stops[keep])
+
+
+def _pair_crossings(rows,crossing,rounding,offset):
+    '''sort crossings on each row and pair them up into (row, start, stop) runs'''
+    order=np.lexsort((crossing,rows))
+    crossing=rounding(crossing[order]).astype(np.int64)+offset
+    return rows[order][::2],crossing[::2],crossing[1::2]
+
+
+def _ramp(counts):
+    '''concatenation of arange(n) for every n in counts'''
+    return np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts,counts)
+
+
+def _merge_spans(rows,starts,stops):
+    '''merge overlapping or touching (row, start, stop) runs so every pixel is covered by a single run'''
+
+    if len(rows)==0:
+        return []
+    order=np.lexsort((starts,rows))
+    rows=rows[order]; starts=starts[order]; stops=stops[order]
+
+    # running max of stop within each row, offset by row so the max never leaks into the next row
+    width=int(stops.max())+1
+    reach=np.maximum.accumulate(stops+rows*width)-rows*width
+    new_run=np.ones(len(rows),dtype=bool)
+    new_run[1:]=(rows[1:]!=rows[:-1])|(starts[1:]>reach[:-1])
+    run_id=np.cumsum(new_run)-1
+    run_stops=np.zeros(run_id[-1]+1,dtype=np.int64)
+    np.maximum.at(run_stops,run_id,reach)
+    return list(zip(rows[new_run].tolist(),starts[new_run].tolist(),run_stops.tolist()))
+
+
+def rasterize_voi(path,volume,mode='union',value=1):
+    '''stream a .voi file into a preallocated volume, see rasterize_contours'''
+    return rasterize_contours(iter_voi_contours(path),volume,mode=mode,value=value)
+
+
+def rasterize_label_map(voi_paths,volume,label_map=LABEL_MAP,mode='union',load=iter_voi_contours):
+    '''
+    fuse the .voi files of one patient into a single label volume
+    -- every entry (name, label) of label_map paints all files whose name contains name (case insensitive) with
+       label, entries are painted in order so a later entry has priority where structures overlap
+    :param voi_paths (list): paths of the .voi files of the patient
+    :param volume (np.ndarray): uint8 volume, modified in place
+    :param label_map (list): (name, label) pairs in painting order
+    :param mode (str): contour mode within each file, see rasterize_contours
+    :param load: callable returning the contours of a .voi path (iter_voi_contours or VOICache.contours)
+    :return: volume
+    '''
+
+    for name,label in label_map:
+        pat=re.compile(re.escape(name),re.IGNORECASE)
+        for path in sorted(voi_paths):
+            if pat.search(os.path.basename(path))==None:
+                continue
+            if mode=='union':
+                rasterize_contours(load(path),volume,mode=mode,value=label)
+            else:
+                # holes of one structure must not cut into the labels painted before it
+                scratch=rasterize_contours(load(path),np.zeros_like(volume),mode=mode)
+                volume[scratch>0]=label
+    return volume
+
+
+def label_names(label_map=LABEL_MAP):
+    '''"labels" section of a clara datalist.json for a label map, {"0": "background", "1": "wp", ...}'''
+    names={'0':'background'}
+    for name,label in label_map:
+        names[str(label)]=name
+    return names
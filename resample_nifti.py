@@ -1,7 +1,12 @@
 import SimpleITK as sitk
-import numpy as np
-import nibabel as nib
 import os
+from resampling import ResampleEngine
+from roi_crop import record_path
+from build_manifest import BuildManifest
+from nifti_io import compress_nii_files, find_nii_files, NiftiVolume
+from instrumentation import run_report, report_path
+from dataset_index import DatasetIndex
+from batch_runner import run_tasks
 
 class ResampleNifti4Clara:
     '''this script is designed to resampled properly labeled .nifti files to 1x1x1 for clara'''
@@ -9,17 +14,125 @@ class ResampleNifti4Clara:
     def __init__(self):
         self.imgpath='/home/tom/clara_experiments/kidney_data/RightKidney'
         self.savepath='/home/tom/clara_experiments/kidney_data/RightKidney_resampled'
+        self.resampler=ResampleEngine(new_spacing=[1,1,1])
+        self.roi_crop=None #roi_crop.RoiCrop(margin=10) crops each pair to the nonzero box of its mask before resampling, None keeps the full field of view
+        self.mask_ext='.nii.gz' #format of the resampled masks, written compressed in one pass
+        self.incremental=True #skip files whose input and settings did not change since the last run
+        self.workers=1 #number of img/seg pairs resampled in parallel (process pool)
+        self.manifest_path=None #build manifest file, defaults to savepath/build_manifest.sqlite
+        self.manifest=None
+        self.report=run_report #per patient, per stage timings, see instrumentation.RunReport
+
+    def resample_all_pts(self,imgn='img',segn='seg',workers=None):
+        '''
+        resample every img/seg pair in imgpath
+        -- files are paired by id in one directory scan, masks without an image are reported up front and skipped
+        -- pairs are resampled in a process pool, each image is read once and is the reference of its own mask
+        -- pairs whose outputs are up to date in the build manifest are skipped
+        :param workers (int): number of pairs resampled in parallel, defaults to self.workers
+        :return: list of (ids, traceback) that failed
+        '''
 
-    def resample_all_pts(self,imgn='img',segn='seg'):
-        '''use function below, iterate over patients'''
+        if workers is None:
+            workers=self.workers
+        index=DatasetIndex(i_name=imgn,s_name=segn).scan(self.imgpath)
+        for id in index.unpaired():
+            if 'image' not in index.entries[id]:
+                print('segmentation {} has no image, skipped'.format(index.entries[id]['label']))
+            else:
+                print('image {} has no segmentation, only the image is resampled'.format(index.entries[id]['image']))
+
+        tasks=[]
+        for id in sorted(index.entries):
+            img_file=index.entries[id].get('image')
+            if img_file is None:
+                continue
+            seg_file=index.entries[id].get('label')
+            if self.incremental and all(self.get_manifest().is_current('resample',file,*info)
+                                        for file,info in self.pair_build_info(img_file,seg_file)):
+                continue
+            tasks+=[(id,img_file,seg_file)]
+        print('total of {} pairs to resample'.format(len(tasks)))
+
+        done,failed=run_tasks(self.resample_pair,tasks,workers=workers,name='resampling')
+        for task,result in done:
+            for file,info in self.pair_build_info(*task[1:]):
+                self.get_manifest().record('resample',file,*info)
+        for task,error in failed:
+            print(error)
+        return [(task[0],error) for task,error in failed]
+
+    def resample_pair(self,id,img_file,seg_file=None):
+        '''
+        resample one image and its mask, the image is read once and defines the grid of the mask
+        :param img_file (str): image file name in imgpath
+        :param seg_file (str): mask file name in imgpath, None for an image without mask
+        '''
 
-        for file in os.listdir(self.imgpath):
-            print('processing file {}'.format(file))
-            id=file.split('_')[0]
-            if id==imgn:
-                self.resample_img(Input_path=os.path.join(self.imgpath,file), savename=file)
-            if id==segn:
-                self.resample_mask(Input_path=os.path.join(self.imgpath,file))
+        with self.report.patient(id):
+            with self.report.stage('read'):
+                image = sitk.ReadImage(os.path.join(self.imgpath,img_file))
+                img_out = None if seg_file is None else sitk.ReadImage(os.path.join(self.imgpath,seg_file)) > 0
+            if self.roi_crop is not None and img_out is not None:
+                #the box of the mask itself, image and mask are cut identically
+                with self.report.stage('crop'):
+                    region=self.roi_crop.region(self.roi_crop.mask_box(img_out),image)
+                    self.roi_crop.save_record(image,region,self.resampled_path(img_file))
+                    image,img_out=self.roi_crop.crop(image,region),self.roi_crop.crop(img_out,region)
+            with self.report.stage('resample'):
+                new_image = self.resampler.resample(image)
+            with self.report.stage('write'):
+                sitk.WriteImage(new_image, self.resampled_path(img_file))
+            if img_out is None:
+                return
+            with self.report.stage('resample'):
+                new_image = self.resampler.resample(img_out,kind='mask',reference=image)
+            with self.report.stage('write'):
+                sitk.WriteImage(new_image, self.resampled_path(seg_file,mask=True))
+
+    def pair_build_info(self,img_file,seg_file=None):
+        '''[(file, build info)] of an image and of its mask, if it has one'''
+        infos=[(img_file,self.resample_build_info(img_file,seg_file=seg_file))]
+        if seg_file is not None:
+            infos+=[(seg_file,self.resample_build_info(seg_file,img_file=img_file))]
+        return infos
+
+    def resample_build_info(self,file,img_file=None,seg_file=None):
+        '''
+        inputs, parameters and outputs of resampling one file, as stored in the build manifest
+        :param file (str): image or mask file name in imgpath
+        :param img_file (str): for a mask, the image it is paired with in the dataset index, None for an image
+        :param seg_file (str): for an image, the mask it is paired with (its box is the crop), None if it has none
+        '''
+
+        Input_path=os.path.join(self.imgpath,file)
+        params={'spacing':self.resampler.new_spacing,'interpolators':self.resampler.interpolators}
+        if self.roi_crop is not None:
+            params['roi_crop']=self.roi_crop.params()
+        if img_file is None:
+            # a cropped image also depends on the mask its box comes from
+            if self.roi_crop is not None and seg_file is not None:
+                return [Input_path,os.path.join(self.imgpath,seg_file)],params,[self.resampled_path(file),record_path(self.resampled_path(file))]
+            return [Input_path],params,[self.resampled_path(file)]
+
+        # masks also depend on the image they take their geometry from
+        return [Input_path,os.path.join(self.imgpath,img_file)],params,[self.resampled_path(file,mask=True)]
+
+    def resampled_path(self,file,mask=False):
+        '''path of the resampled version of an image file (or of a mask file with mask=True) in savepath'''
+        if mask:
+            return os.path.join(self.savepath,file.split('.')[0]+'-resampled'+self.mask_ext)
+        if file.endswith('.nii'):
+            return os.path.join(self.savepath,file[:-len('.nii')]+'-resampled.nii')
+        return os.path.join(self.savepath,str.replace(file,'.nii.gz','-resampled.nii.gz'))
+
+    def get_manifest(self):
+        '''build manifest kept next to the resampled files, opened on first use'''
+        if self.manifest_path is None:
+            self.manifest_path=os.path.join(self.savepath,'build_manifest.sqlite')
+        if self.manifest is None or self.manifest.path!=self.manifest_path:
+            self.manifest=BuildManifest(self.manifest_path)
+        return self.manifest
 
     def resample_img(self,Input_path, savename):
         '''
@@ -30,69 +143,45 @@ class ResampleNifti4Clara:
         '''
 
         #print("Reading Dicom directory:", Input_path)
-        image = sitk.ReadImage(os.path.join(Input_path))
-        new_spacing = [1, 1, 1]
-        orig_size = np.array(image.GetSize(), dtype=np.int)
-        orig_spacing = np.array(image.GetSpacing())
-        new_size = orig_size * (orig_spacing / new_spacing)
-        new_size = np.ceil(new_size).astype(np.int)  # Image dimensions are in integers
-        new_size = [int(s) for s in new_size]
-
-        resample = sitk.ResampleImageFilter()
-        resample.SetInterpolator = sitk.sitkLinear
-        resample.SetOutputSpacing(new_spacing)
-        resample.SetSize(new_size)
-        resample.SetOutputDirection(image.GetDirection())
-        resample.SetOutputOrigin(image.GetOrigin())
-        new_image = resample.Execute(image)
-        sitk.WriteImage(new_image, os.path.join(self.savepath,str.replace(savename,'.nii.gz','-resampled.nii.gz')))
+        with self.report.stage('read'):
+            image = sitk.ReadImage(os.path.join(Input_path))
+        with self.report.stage('resample'):
+            new_image = self.resampler.resample(image)
+        with self.report.stage('write'):
+            sitk.WriteImage(new_image, os.path.join(self.savepath,str.replace(savename,'.nii.gz','-resampled.nii.gz')))
 
     def resample_mask(self,Input_path):
         '''
         Reesample the mask with image affine matrix to match the image
         '''
 
-        # read in first image to get shape
-        img_out = sitk.ReadImage(os.path.join(Input_path))
-        image= sitk.ReadImage(os.path.join(os.path.split(Input_path)[0],'img_'+'_'.join(os.path.split(Input_path)[1].split('_')[1:])))
-
-        new_spacing = [1, 1, 1]
-        orig_size = np.array(img_out.GetSize(), dtype=np.int)
-        orig_spacing = np.array(img_out.GetSpacing())
-        new_size = orig_size * (orig_spacing / new_spacing)
-        new_size = np.ceil(new_size).astype(np.int)  # Image dimensions are in integers
-        new_size = [int(s) for s in new_size]
-
-        # t2 resample
-        resample = sitk.ResampleImageFilter()
-        resample.SetInterpolator = sitk.sitkLinear
-        resample.SetOutputSpacing(new_spacing)
-        resample.SetSize(new_size)
-        resample.SetOutputDirection(image.GetDirection())
-        resample.SetOutputOrigin(image.GetOrigin())
-        image_resamp = resample.Execute(image) # t2
-        new_image = resample.Execute(img_out)  # mask
-        new_arr = sitk.GetArrayFromImage(new_image)
-        new_arr[new_arr > 0] = 1
-        new_image = sitk.GetImageFromArray(new_arr)
-        new_image.CopyInformation(image_resamp)
-        sitk.WriteImage(new_image, os.path.join(self.savepath,os.path.split(Input_path)[1].split('.')[0] + '-resampled.nii'))
-
-    def compress_nii(self):
-        '''recursively converts .nii files to .nii.gz and removes original .nii file
-        :param path - path to directory that contains all files
+        # read in mask as uint8 0/1, only the header of the image is read for its geometry
+        with self.report.stage('read'):
+            img_out = sitk.ReadImage(os.path.join(Input_path)) > 0
+            image= NiftiVolume(os.path.join(os.path.split(Input_path)[0],'img_'+'_'.join(os.path.split(Input_path)[1].split('_')[1:])))
+
+        # nearest neighbour keeps the mask uint8 with values 0/1
+        # output grid is computed from the image header, the image voxels are never read
+        with self.report.stage('resample'):
+            new_image = self.resampler.resample(img_out,kind='mask',reference=image)  # mask
+        with self.report.stage('write'):
+            sitk.WriteImage(new_image, os.path.join(self.savepath,os.path.split(Input_path)[1].split('.')[0] + '-resampled' + self.mask_ext))
+
+    def compress_nii(self,workers=None,compresslevel=6):
+        '''converts .nii files in savepath to .nii.gz and removes original .nii file
+        -- streams raw bytes through gzip in a thread pool, see nifti_io.compress_nii_files
+        :param workers - number of files compressed at the same time, defaults to the number of cpus
+        :param compresslevel - gzip level 1 (fast) to 9 (small)
 
         '''
-        path=self.savepath
-        for file in os.listdir(path):
-            if file.endswith('.nii'):
-                n_f = nib.load(os.path.join(path, file))
-                nib.save(n_f, os.path.join(path, file + '.gz'))
-                os.remove(os.path.join(path, file))
+        with self.report.stage('compress'):
+            compress_nii_files(find_nii_files(self.savepath,recursive=False),workers=workers,compresslevel=compresslevel)
 
 
 if __name__=="__main__":
     c=ResampleNifti4Clara()
     c.resample_all_pts()
     c.compress_nii()
+    c.report.summary()
+    c.report.save(report_path(os.path.dirname(c.get_manifest().path)))
 
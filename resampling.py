@@ -0,0 +1,92 @@
+#author @t_sanf
+
+from collections import OrderedDict
+import numpy as np
+import SimpleITK as sitk
+
+
+class ResampleEngine:
+    '''
+    resample images and masks to a fixed voxel spacing (1x1x1 by default)
+    -- interpolator is chosen per kind of data, linear for images and nearest neighbour for masks
+       (sitk.sitkLabelGaussian is a smoother alternative for masks)
+    -- a prepared ResampleImageFilter is cached per input geometry (size, spacing, direction, origin) and kind,
+       volumes with the same geometry reuse it instead of building a new filter
+    '''
+
+    def __init__(self,new_spacing=(1,1,1),image_interpolator=sitk.sitkLinear,mask_interpolator=sitk.sitkNearestNeighbor,
+                 number_of_threads=None,max_filters=32):
+        '''
+        :param new_spacing: output spacing in mm
+        :param image_interpolator: SimpleITK interpolator for kind='image'
+        :param mask_interpolator: SimpleITK interpolator for kind='mask'
+        :param number_of_threads (int): threads used by each filter, None keeps the SimpleITK global default
+        :param max_filters (int): number of prepared filters kept in the cache
+        '''
+        self.new_spacing=[float(s) for s in new_spacing]
+        self.interpolators={'image':image_interpolator,'mask':mask_interpolator}
+        self.number_of_threads=number_of_threads
+        self.max_filters=max_filters
+        self.filters=OrderedDict()
+
+    def __getstate__(self):
+        '''prepared filters are not picklable, an engine sent to a worker process starts with an empty filter cache'''
+        state=self.__dict__.copy()
+        state['filters']=OrderedDict()
+        return state
+
+    def target_size(self,image):
+        '''size of the resampled volume, the physical extent is kept and rounded up to whole voxels'''
+        orig_size = np.array(image.GetSize(), dtype=int)
+        orig_spacing = np.array(image.GetSpacing())
+        new_size = orig_size * (orig_spacing / np.array(self.new_spacing))
+        new_size = np.ceil(new_size).astype(int)  # Image dimensions are in integers
+        return [int(s) for s in new_size]
+
+    def target_geometry(self,reference):
+        '''
+        geometry of the resampled volume computed from the reference header alone, no voxels are resampled
+        -- every mask resampled against the same reference ends up on exactly this grid
+        :return: (size, spacing, origin, direction)
+        '''
+        return (self.target_size(reference),self.new_spacing,reference.GetOrigin(),reference.GetDirection())
+
+    def get_filter(self,reference,kind='image'):
+        '''
+        return the prepared filter for the geometry of the reference image, building it only on a cache miss
+        :param reference: SimpleITK image defining the geometry
+        :param kind (str): 'image' or 'mask'
+        '''
+
+        key=(reference.GetSize(),reference.GetSpacing(),reference.GetDirection(),reference.GetOrigin(),kind)
+        if key in self.filters:
+            self.filters.move_to_end(key)
+            return self.filters[key]
+
+        size,spacing,origin,direction=self.target_geometry(reference)
+        resample = sitk.ResampleImageFilter()
+        resample.SetInterpolator(self.interpolators[kind])
+        resample.SetOutputSpacing(spacing)
+        resample.SetSize(size)
+        resample.SetOutputDirection(direction)
+        resample.SetOutputOrigin(origin)
+        if self.number_of_threads is not None:
+            resample.SetNumberOfThreads(self.number_of_threads)
+
+        self.filters[key]=resample
+        while len(self.filters)>self.max_filters:
+            self.filters.popitem(last=False)
+        return resample
+
+    def resample(self,image,kind='image',reference=None):
+        '''
+        resample a volume to the engine spacing
+        :param image: SimpleITK image to resample
+        :param kind (str): 'image' or 'mask', selects the interpolator
+        :param reference: image whose geometry (origin, direction, extent) defines the output, defaults to image itself
+        :return: resampled SimpleITK image, same pixel type as the input
+        '''
+
+        if reference is None:
+            reference=image
+        return self.get_filter(reference,kind=kind).Execute(image)
@@ -0,0 +1,136 @@
+#author @t_sanf
+
+import os
+import re
+import json
+import numpy as np
+import SimpleITK as sitk
+from parsing_VOI import voi_bboxes
+
+
+class RoiCrop:
+    '''
+    crop volumes to a box around the gland before resampling, most of a t2 field of view is not needed for
+    segmentation and upsampling it to 1x1x1 mm dominates output size and resample time
+    -- the box is the extent of every contour of the gland voi (wp by default, same numbers as
+       ParseVOI.BBox_from_position) or of the nonzero voxels of an existing mask, grown by margin mm on every side
+    -- the box is computed on the native grid, so the image and every mask of a patient are cut identically and
+       masks resampled against the cropped image land on its grid
+    -- cropping keeps the physical position (origin moves with the box), the crop record saved next to the output holds
+       the box and the original geometry, map_to_original puts a prediction back on the original grid
+    '''
+
+    def __init__(self,margin=10,voi_type='wp'):
+        '''
+        :param margin (float or 3 floats): mm added around the box, (x, y, z) or the same on every axis
+        :param voi_type (str): voi file the box is taken from, matched case-insensitively in the file name
+        '''
+        self.margin=margin
+        self.voi_type=voi_type
+
+    def params(self):
+        '''settings that change the output, as stored in the build manifest'''
+        return {'margin':self.margin,'voi_type':self.voi_type}
+
+    def find_voi(self,voi_dir):
+        '''path to the first voi file of voi_type in a directory, None if there is none'''
+        if not os.path.isdir(voi_dir):
+            return None
+        pat=re.compile(re.escape(self.voi_type),re.IGNORECASE)
+        for file in sorted(os.listdir(voi_dir)):
+            if file.endswith('.voi') and pat.search(file)!=None:
+                return os.path.join(voi_dir,file)
+        return None
+
+    def voi_box(self,voi_path,cache=None):
+        '''
+        index box (x0, y0, z0, x1, y1, z1), stops exclusive, around every contour of a voi file
+        :param cache (VOICache): load the contours from this cache
+        :return: None if the file has no contours
+        '''
+        table=voi_bboxes(voi_path,cache=cache)
+        if not len(table):
+            return None
+        return (int(table['xmin'].min()),int(table['ymin'].min()),int(table['slice'].min()),
+                int(table['xmax'].max())+1,int(table['ymax'].max())+1,int(table['slice'].max())+1)
+
+    def mask_box(self,mask):
+        '''index box (x0, y0, z0, x1, y1, z1), stops exclusive, around the nonzero voxels of a mask, None if it is empty'''
+        arr=sitk.GetArrayViewFromImage(mask)
+        z=np.flatnonzero(arr.any(axis=(1,2)))
+        if not len(z):
+            return None
+        y=np.flatnonzero(arr.any(axis=(0,2))); x=np.flatnonzero(arr.any(axis=(0,1)))
+        return (int(x[0]),int(y[0]),int(z[0]),int(x[-1])+1,int(y[-1])+1,int(z[-1])+1)
+
+    def region(self,box,image):
+        '''
+        box grown by the margin and clipped to the image
+        -- a box that does not overlap the image (e.g. a voi drawn on another series) keeps the whole image
+        :param box: index box from voi_box or mask_box, None for the whole image
+        :param image: SimpleITK image (or nifti_io.NiftiVolume) on whose grid the box was computed
+        :return: (index, size) in SimpleITK (x, y, z) order
+        '''
+        size=list(image.GetSize())
+        if box is None:
+            return [0,0,0],size
+        margin=np.broadcast_to(np.asarray(self.margin,dtype=float),(3,))
+        pad=np.ceil(margin/np.array(image.GetSpacing())).astype(int)
+        start=np.clip(np.array(box[:3])-pad,0,size)
+        stop=np.clip(np.array(box[3:])+pad,0,size)
+        if np.any(stop<=start):
+            print('box {} is outside the image of size {}, the full field of view is kept'.format(list(box),size))
+            return [0,0,0],size
+        return [int(i) for i in start],[int(i) for i in stop-start]
+
+    def voi_region(self,voi_dir,image,cache=None):
+        '''region of the gland voi found in voi_dir, the whole image (and a message) if there is no usable voi'''
+        voi_path=self.find_voi(voi_dir)
+        box=None if voi_path is None else self.voi_box(voi_path,cache=cache)
+        if box is None:
+            print('no {} contours in {}, the full field of view is kept'.format(self.voi_type,voi_dir))
+        return self.region(box,image)
+
+    def crop(self,image,region):
+        '''cut a region out of an image, origin is moved so every voxel keeps its physical position'''
+        index,size=region
+        if index==[0,0,0] and size==list(image.GetSize()):
+            return image
+        return sitk.RegionOfInterest(image,size,index)
+
+    def record(self,image,region):
+        '''crop record of a region of an image: the box and the original geometry needed to map results back'''
+        index,size=region
+        return {'index':index,'size':size,'original_size':list(image.GetSize()),'original_spacing':list(image.GetSpacing()),
+                'original_origin':list(image.GetOrigin()),'original_direction':list(image.GetDirection()),**self.params()}
+
+    def save_record(self,image,region,output_path):
+        '''write the crop record of output_path next to it, see record_path'''
+        with open(record_path(output_path),'w') as outfile:
+            json.dump(self.record(image,region),outfile,indent=2)
+        return record_path(output_path)
+
+
+def record_path(output_path):
+    '''crop record written next to a cropped output, e.g. t2_resampled.nii.gz -> t2_resampled_crop.json'''
+    stem=output_path[:-len('.nii.gz')] if output_path.endswith('.nii.gz') else os.path.splitext(output_path)[0]
+    return stem+'_crop.json'
+
+
+def map_to_original(prediction,record,interpolator=sitk.sitkNearestNeighbor,default=0):
+    '''
+    put a result computed on a cropped (and resampled) volume back on the original, uncropped grid
+    :param prediction: SimpleITK image, e.g. a segmentation predicted on img_<id>.nii.gz
+    :param record (dict or str): crop record, or the path of its json file
+    :param interpolator: nearest neighbour for labels, sitk.sitkLinear for probabilities
+    :param default: value outside the crop box
+    :return: SimpleITK image with the original size, spacing, origin and direction
+    '''
+    if isinstance(record,str):
+        with open(record) as f:
+            record=json.load(f)
+    reference=sitk.Image([int(s) for s in record['original_size']],prediction.GetPixelID())
+    reference.SetSpacing(record['original_spacing'])
+    reference.SetOrigin(record['original_origin'])
+    reference.SetDirection(record['original_direction'])
+    return sitk.Resample(prediction,reference,sitk.Transform(),interpolator,default)
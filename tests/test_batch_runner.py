@@ -0,0 +1,27 @@
+import errno
+from batch_runner import is_transient, run_tasks, TRANSIENT_ERRORS
+
+calls=[]
+
+
+def _fail(error):
+    calls.append(error)
+    raise error
+
+
+def test_only_transient_os_errors_are_retried():
+    assert is_transient(OSError(errno.EIO,'i/o error'))
+    assert is_transient(TimeoutError(errno.ETIMEDOUT,'timed out'))
+    assert not is_transient(FileNotFoundError(errno.ENOENT,'missing'))
+    assert not is_transient(PermissionError(errno.EACCES,'denied'))
+    assert not is_transient(OSError('no errno'))
+    assert not is_transient(ValueError('bad header'))
+    assert is_transient(FileNotFoundError(errno.ENOENT,'missing'),retry_on=TRANSIENT_ERRORS+(FileNotFoundError,))
+
+
+def test_run_tasks_retries_transient_errors_only():
+    del calls[:]
+    done,failed=run_tasks(_fail,[(OSError(errno.ESTALE,'stale handle'),),(FileNotFoundError(errno.ENOENT,'missing'),)],
+                          retries=2,retry_delay=0)
+    assert done==[] and len(failed)==2
+    assert [type(error) for error in calls]==[OSError]*3+[FileNotFoundError]
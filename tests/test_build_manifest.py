@@ -0,0 +1,38 @@
+import os
+from build_manifest import BuildManifest
+
+
+def _write(path,text):
+    with open(path,'w') as f:
+        f.write(text)
+    return path
+
+
+def test_recorded_build_is_current(tmp_path):
+    source=_write(str(tmp_path/'in'),'a'); output=_write(str(tmp_path/'out'),'b')
+    manifest=BuildManifest(str(tmp_path/'m.sqlite'))
+    manifest.record('s','k',[source],{'spacing':1},[output])
+    assert manifest.is_current('s','k',[source],{'spacing':1})
+    assert not manifest.is_current('s','k',[source],{'spacing':2})
+    os.remove(output)
+    assert not manifest.is_current('s','k',[source],{'spacing':1})
+
+
+def test_missing_input_is_not_current(tmp_path):
+    source=_write(str(tmp_path/'in'),'a'); output=_write(str(tmp_path/'out'),'b')
+    manifest=BuildManifest(str(tmp_path/'m.sqlite'))
+    manifest.record('s','k',[source],{},[output])
+    os.remove(source)
+    assert not manifest.is_current('s','k',[source],{})
+
+
+def test_touched_input(tmp_path):
+    source=_write(str(tmp_path/'in'),'a'); output=_write(str(tmp_path/'out'),'b')
+    plain=BuildManifest(str(tmp_path/'plain.sqlite'))
+    hashed=BuildManifest(str(tmp_path/'hashed.sqlite'),content_hash=True)
+    for manifest in (plain,hashed):
+        manifest.record('s','k',[source],{},[output])
+    stat=os.stat(source)
+    os.utime(source,ns=(stat.st_atime_ns,stat.st_mtime_ns+10**9))
+    assert not plain.is_current('s','k',[source],{})
+    assert hashed.is_current('s','k',[source],{})
@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+from instrumentation import RunReport, reset_peak_rss
+
+
+@pytest.mark.skipif(not reset_peak_rss(),reason='the peak rss cannot be reset on this platform')
+def test_peak_rss_is_per_stage():
+    report=RunReport()
+    with report.patient('pt0'):
+        with report.stage('outer'):
+            with report.stage('large'):
+                array=np.ones(32*1024**2); del array
+            with report.stage('small'):
+                array=np.ones(1024); del array
+    peaks={record['stage']:record['peak_rss_mb'] for record in report.records}
+    assert peaks['large']-peaks['small']>200
+    assert peaks['outer']>=peaks['large']
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from skimage import draw
+from parsing_VOI import Contour
+from rasterize import rasterize_contours, polygon_spans
+
+
+def old_poly2mask(x,y,shape):
+    '''mask of the original pipeline: draw.polygon with X as the row coordinate, axes swapped afterwards'''
+    mask=np.zeros(shape[::-1],dtype=np.uint8)
+    rr,cc=draw.polygon(x,y,shape[::-1])
+    mask[rr,cc]=1
+    return mask.T
+
+
+def random_polygons(seed,count=500):
+    '''concave, self-intersecting, self-touching and noisy prostate-like integer polygons, partly out of bounds'''
+    rng=np.random.default_rng(seed)
+    for i in range(count):
+        n=int(rng.integers(3,40))
+        kind=i%4
+        if kind==0:  # arbitrary, mostly self-intersecting
+            x=rng.integers(-5,70,n); y=rng.integers(-5,55,n)
+        elif kind==1:  # noisy star shaped outline, concave
+            t=np.sort(rng.random(n))*2*np.pi; r=rng.uniform(5,25)*(1+0.3*rng.standard_normal(n))
+            x=(32+r*np.cos(t)).astype(int); y=(25+0.8*r*np.sin(t)).astype(int)
+        elif kind==2:  # vertices on a coarse grid, many collinear and touching edges
+            x=rng.integers(0,8,n)*8; y=rng.integers(0,7,n)*7
+        else:  # repeated vertices
+            x=rng.integers(0,64,n); y=rng.integers(0,50,n); j=rng.integers(0,n,n//2); x[j]=x[(j+1)%n]; y[j]=y[(j+2)%n]
+        yield x,y
+
+
+@pytest.mark.parametrize('seed',[0,1,2])
+def test_matches_old_poly2mask(seed):
+    shape=(50,64)  # rows, columns, not square on purpose
+    for x,y in random_polygons(seed):
+        volume=np.zeros((1,)+shape,dtype=np.uint8)
+        rasterize_contours([Contour(0,0,0,np.stack([x,y],axis=1))],volume)
+        np.testing.assert_array_equal(volume[0],old_poly2mask(x,y,shape),err_msg='x={} y={}'.format(list(x),list(y)))
+
+
+@pytest.mark.parametrize('seed',[3,4])
+def test_spans_match_skimage(seed):
+    shape=(50,64)
+    for x,y in random_polygons(seed):
+        expected=np.zeros(shape,dtype=np.uint8)
+        rr,cc=draw.polygon(y,x,shape)
+        expected[rr,cc]=1
+        filled=np.zeros(shape,dtype=np.uint8)
+        for row,start,stop in polygon_spans(x,y,shape):
+            filled[row,start:stop]+=1
+        np.testing.assert_array_equal(filled,expected,err_msg='x={} y={}'.format(list(x),list(y)))
+
+
+def test_xor_makes_holes():
+    outer=np.array([[2,2],[20,2],[20,20],[2,20]]); inner=np.array([[8,8],[14,8],[14,14],[8,14]])
+    contours=[Contour(1,0,0,outer),Contour(1,0,0,inner)]
+    union=rasterize_contours(contours,np.zeros((3,24,24),dtype=np.uint8))
+    holes=rasterize_contours(contours,np.zeros((3,24,24),dtype=np.uint8),mode='xor')
+    assert union[1,11,11]==1 and holes[1,11,11]==0
+    assert holes[1,4,4]==1 and union[0].sum()==0 and union[2].sum()==0
@@ -0,0 +1,39 @@
+import os
+import numpy as np
+import SimpleITK as sitk
+from dataset_index import DatasetIndex
+from resample_nifti import ResampleNifti4Clara
+
+
+def _write(path,array,spacing=(0.5,0.5,3.)):
+    image=sitk.GetImageFromArray(array)
+    image.SetSpacing(spacing)
+    sitk.WriteImage(image,path)
+
+
+def _dataset(path,ids,orphan_segs=(),orphan_imgs=()):
+    os.makedirs(path)
+    mask=np.zeros((4,12,12),dtype=np.uint8); mask[1:3,3:8,4:9]=1
+    for id in list(ids)+list(orphan_imgs):
+        _write(os.path.join(path,'img_{}.nii.gz'.format(id)),mask.astype(np.int16)*100)
+    for id in list(ids)+list(orphan_segs):
+        _write(os.path.join(path,'seg_{}.nii.gz'.format(id)),mask)
+
+
+def test_index_reports_unpaired_files(tmp_path):
+    _dataset(str(tmp_path/'in'),['0','1'],orphan_segs=['9'],orphan_imgs=['5'])
+    index=DatasetIndex().scan(str(tmp_path/'in'))
+    assert index.ids()==['0','1']
+    assert index.unpaired()==['5','9']
+
+
+def test_orphan_segmentation_is_skipped(tmp_path):
+    _dataset(str(tmp_path/'in'),['0','1','2'],orphan_segs=['9'])
+    for incremental in (True,False):
+        resampler=ResampleNifti4Clara()
+        resampler.imgpath=str(tmp_path/'in'); resampler.savepath=str(tmp_path/'out{}'.format(incremental))
+        resampler.incremental=incremental
+        os.makedirs(resampler.savepath)
+        assert resampler.resample_all_pts()==[]
+        written=sorted(file for file in os.listdir(resampler.savepath) if file.endswith('.nii.gz'))
+        assert written==['img_{}-resampled.nii.gz'.format(i) for i in range(3)]+['seg_{}-resampled.nii.gz'.format(i) for i in range(3)]
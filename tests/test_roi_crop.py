@@ -0,0 +1,22 @@
+import SimpleITK as sitk
+from roi_crop import RoiCrop
+
+
+def _image():
+    image=sitk.Image([20,20,10],sitk.sitkUInt8)
+    image.SetSpacing([1,1,3])
+    return image
+
+
+def test_region_is_grown_and_clipped():
+    crop=RoiCrop(margin=2)
+    assert crop.region((2,2,1,5,5,3),_image())==([0,0,0],[7,7,4])
+    assert crop.region((10,10,4,12,12,5),_image())==([8,8,3],[6,6,3])
+
+
+def test_box_outside_the_image_keeps_the_whole_image():
+    image=_image()
+    crop=RoiCrop(margin=2)
+    region=crop.region((30,30,12,35,35,14),image)
+    assert region==([0,0,0],[20,20,10])
+    assert crop.crop(image,region) is image
@@ -0,0 +1,48 @@
+import os
+import numpy as np
+from parsing_VOI import VOICache, iter_voi_contours
+
+
+def _write_voi(path,slices):
+    '''MIPAV voi file with one square contour of side size on every (slice, size)'''
+    lines=['MIPAV VOI FILE','255\t\t# curvetype of the VOI <Contour>','0\t\t# presentation colour',
+           '{}\t\t# number of slices for the VOI'.format(len(slices))]
+    for slice,size in slices:
+        lines+=['{}\t\t# slice number'.format(slice),'1\t\t# number of contours in slice','4\t\t# number of pts in contour <Chain-element-type>']
+        lines+=['{:.4f} {:.4f}'.format(x,y) for x,y in ((1,1),(1+size,1),(1+size,1+size),(1,1+size))]
+    with open(path,'w') as f:
+        f.write('\n'.join(lines)+'\n')
+    return path
+
+
+def _same(contours,expected):
+    assert [c[:3] for c in contours]==[c[:3] for c in expected]
+    for contour,other in zip(contours,expected):
+        np.testing.assert_array_equal(contour.vertices,other.vertices)
+
+
+def test_cache_returns_the_parsed_contours(tmp_path):
+    voi=_write_voi(str(tmp_path/'wp.voi'),[(2,5),(3,6)])
+    cache=VOICache(str(tmp_path/'cache'))
+    _same(cache.contours(voi),list(iter_voi_contours(voi)))
+    assert len(os.listdir(str(tmp_path/'cache')))==2
+    _same(cache.contours(voi),list(iter_voi_contours(voi)))
+
+
+def test_changed_file_replaces_a_loaded_entry(tmp_path):
+    voi=_write_voi(str(tmp_path/'wp.voi'),[(2,5)])
+    cache=VOICache(str(tmp_path/'cache'))
+    cache.contours(voi)
+    loaded=cache.contours(voi)
+    stat=os.stat(voi)
+    _write_voi(voi,[(2,5),(4,7)])
+    os.utime(voi,ns=(stat.st_atime_ns,stat.st_mtime_ns+10**9))
+    _same(cache.contours(voi),list(iter_voi_contours(voi)))
+    assert len(loaded)==1
+
+
+def test_unwritable_cache_still_parses(tmp_path):
+    voi=_write_voi(str(tmp_path/'wp.voi'),[(2,5)])
+    blocker=tmp_path/'cache'
+    blocker.write_text('a file where the cache directory should be')
+    _same(VOICache(str(blocker)).contours(voi),list(iter_voi_contours(voi)))
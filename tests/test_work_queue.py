@@ -0,0 +1,108 @@
+import os
+import time
+import multiprocessing
+from batch_runner import read_ledger
+from work_queue import WorkQueue
+
+
+def _append(log,name):
+    '''task that records every execution'''
+    with open(log,'a') as f:
+        f.write(name+'\n')
+    time.sleep(0.05)
+    return name
+
+
+def _hang(seconds,marker):
+    time.sleep(seconds)
+    open(marker,'w').close()
+
+
+def _worker(path,log):
+    WorkQueue(path,lease_seconds=30).work('s',_append)
+
+
+def test_claim_is_exclusive(tmp_path):
+    path=str(tmp_path/'q.sqlite')
+    WorkQueue(path).add('s',[('a',),('b',),('c',)])
+    claims=[WorkQueue(path,worker=str(i)).claim('s') for i in range(4)]
+    assert sorted(claim[0] for claim in claims[:3])==['a','b','c']
+    assert claims[3] is None
+
+
+def test_renew_and_complete_need_the_lease(tmp_path):
+    q=WorkQueue(str(tmp_path/'q.sqlite'))
+    q.add('s',[('a',1)])
+    key,task,lease=q.claim('s')
+    assert (key,task)==('a/1',('a',1))
+    assert q.renew('s',key,lease)
+    assert not q.complete('s',key,'another lease')
+    assert q.complete('s',key,lease)
+    assert not q.renew('s',key,lease)
+    assert q.counts('s')=={'done':1}
+
+
+def test_add_does_not_queue_finished_tasks_again(tmp_path):
+    q=WorkQueue(str(tmp_path/'q.sqlite'))
+    q.add('s',[('a',)])
+    key,task,lease=q.claim('s')
+    q.complete('s',key,lease)
+    assert q.add('s',[('a',),('b',)])==1
+    assert q.counts('s')=={'done':1,'pending':1}
+    q.forget('s','a')
+    assert q.add('s',[('a',)])==1
+
+
+def test_expired_lease_is_claimed_by_another_worker(tmp_path):
+    path=str(tmp_path/'q.sqlite')
+    dead=WorkQueue(path,lease_seconds=0.2,worker='dead')
+    live=WorkQueue(path,lease_seconds=0.2,worker='live')
+    dead.add('s',[('a',)])
+    key,task,old_lease=dead.claim('s')
+    assert live.claim('s') is None
+    time.sleep(0.3)
+    key,task,lease=live.claim('s')
+    assert key=='a'
+    assert not dead.renew('s',key,old_lease)
+    assert not dead.complete('s',key,old_lease)
+    assert live.complete('s',key,lease)
+
+
+def test_lease_expired_too_often_goes_to_the_ledger(tmp_path):
+    path=str(tmp_path/'q.sqlite'); ledger=str(tmp_path/'failures.jsonl')
+    q=WorkQueue(path,lease_seconds=0.1,max_attempts=2)
+    q.add('s',[('a',)])
+    for attempt in range(2):
+        assert q.claim('s')[0]=='a'
+        time.sleep(0.15)
+    assert q.claim('s') is None
+    done,failed=q.work('s',_append,ledger=ledger)
+    assert done==[] and q.counts('s')=={'failed':1}
+    entries=read_ledger(ledger)
+    assert [entry['task'] for entry in entries]==['a'] and 'lease expired' in entries[0]['error']
+
+
+def test_timeout_kills_the_task(tmp_path):
+    path=str(tmp_path/'q.sqlite'); marker=str(tmp_path/'finished')
+    q=WorkQueue(path,max_attempts=1)
+    q.add('s',[(5,marker)])
+    start=time.monotonic()
+    done,failed=q.work('s',_hang,timeout=1)
+    assert len(failed)==1 and 'timed out' in failed[0][1]
+    time.sleep(5-(time.monotonic()-start)+0.5)
+    assert not os.path.exists(marker)
+
+
+def test_workers_run_every_task_once(tmp_path):
+    path=str(tmp_path/'q.sqlite'); log=str(tmp_path/'log')
+    names=['p{}'.format(i) for i in range(30)]
+    WorkQueue(path).add('s',[(log,name) for name in names])
+    context=multiprocessing.get_context('spawn')
+    processes=[context.Process(target=_worker,args=(path,log)) for i in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(120)
+    with open(log) as f:
+        assert sorted(f.read().split())==sorted(names)
+    assert WorkQueue(path).counts('s')=={'done':30}
@@ -0,0 +1,302 @@
+#author @t_sanf
+
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+from batch_runner import log_failure, TRANSIENT_ERRORS, _call_task, _call_task_in_child
+from instrumentation import run_report
+
+
+def new_run_id():
+    '''name of a new run, unique per launch, e.g. 20240131-221500-3f9a1c'''
+    return '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'),uuid.uuid4().hex[:6])
+
+
+def task_key(task):
+    '''queue key of a task, e.g. ('prostateX', 'patient_1', ['t2']) -> 'prostateX/patient_1' '''
+    return '/'.join(str(t) for t in task if isinstance(t,(str,int)))
+
+
+class WorkQueue:
+    '''
+    work queue shared by worker processes on one or more nodes, stored in a small sqlite file
+    -- one row per (stage, key) with the task arguments, its state (pending, leased, done, failed) and its lease
+    -- there is no coordinator: every worker adds the same tasks (adding is idempotent, a task already in the queue is
+       never queued again, start a new run or forget() the stage to rebuild) and claims them one at a time, a claim is
+       a single conditional update (compare and swap on the state and lease), so two workers can never hold the same task
+    -- a lease has to be renewed while the task runs (work() does it from a heartbeat thread), the lease of a worker
+       that died expires after lease_seconds and the task is claimed again by another worker
+    -- with a timeout the task runs in a child process that is killed when the timeout passes (or when its worker dies),
+       so a hung task never keeps writing while another worker redoes it
+    -- the checkpoint (on_done) is written under a freshly renewed lease and only then is the task marked done, so every
+       task is completed and checkpointed once; lease_seconds has to be well above any pause of a live worker
+    -- sqlite needs working file locks, put the queue on a local disk of a shared node or a share that supports
+       them (not every NFS mount does)
+    '''
+
+    def __init__(self,path,lease_seconds=600,max_attempts=3,worker=None):
+        '''
+        :param path (str): path to the sqlite file, created if needed
+        :param lease_seconds (float): time a claim stays valid without being renewed
+        :param max_attempts (int): claims of a task before it is marked failed (dead workers and transient errors)
+        :param worker (str): name stored with every lease, defaults to host:pid
+        '''
+        self.path=path
+        self.lease_seconds=lease_seconds
+        self.max_attempts=max_attempts
+        self.worker=worker or '{}:{}'.format(socket.gethostname(),os.getpid())
+        self.poll=min(5.,lease_seconds/4.)  #seconds between claims while other workers hold the remaining tasks
+        directory=os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._execute('''create table if not exists tasks (
+                          stage text, key text, args text, state text, worker text, lease text, lease_until real,
+                          attempts integer, error text, updated real, primary key (stage, key))''')
+
+    def _execute(self,sql,args=()):
+        '''run one statement in its own transaction, return (rows, number of changed rows)'''
+        db=sqlite3.connect(self.path,timeout=60)
+        try:
+            with db:
+                cursor=db.execute(sql,args)
+                return cursor.fetchall(),cursor.rowcount
+        finally:
+            db.close()
+
+    def add(self,stage,tasks):
+        '''
+        add tasks to the queue, tasks that are already queued (in any state, also done or failed) are left alone
+        :param tasks (list): argument tuples, json serializable
+        :return: number of tasks queued
+        '''
+
+        now=time.time()
+        queued=0
+        for task in tasks:
+            rows,count=self._execute('''insert or ignore into tasks values (?,?,?,'pending',null,null,0,0,null,?)''',
+                                     (stage,task_key(task),json.dumps(list(task)),now))
+            queued+=count
+        return queued
+
+    def claim(self,stage):
+        '''
+        lease the next pending task (or a task whose lease expired)
+        :return: (key, args, lease) or None when nothing can be claimed right now
+        '''
+
+        now=time.time()
+        lease=uuid.uuid4().hex
+        claimable="(state='pending' or (state='leased' and lease_until<? and attempts<?))"
+        self._execute('''update tasks set state='leased', worker=?, lease=?, lease_until=?, attempts=attempts+1, updated=?
+                         where stage=? and key=(select key from tasks where stage=? and {0} order by rowid limit 1)
+                         and {0}'''.format(claimable),
+                      (self.worker,lease,now+self.lease_seconds,now,stage,stage,now,self.max_attempts,now,self.max_attempts))
+        rows,count=self._execute('select key, args from tasks where stage=? and lease=?',(stage,lease))
+        if not rows:
+            return None
+        return rows[0][0],tuple(json.loads(rows[0][1])),lease
+
+    def expire(self,stage):
+        '''
+        mark tasks failed whose lease expired max_attempts times, they keep killing or hanging their worker
+        :return: [(key, error)] of the tasks marked by this call (each one is marked by exactly one worker)
+        '''
+        now=time.time()
+        rows,count=self._execute('''select key, lease, worker from tasks where stage=? and state='leased' and lease_until<?
+                                    and attempts>=?''',(stage,now,self.max_attempts))
+        expired=[]
+        for key,lease,worker in rows:
+            error='lease expired {} times, last held by {}'.format(self.max_attempts,worker)
+            changed,count=self._execute('''update tasks set state='failed', error=?, updated=?
+                                           where stage=? and key=? and lease=? and state='leased' ''',(error,now,stage,key,lease))
+            if count:
+                expired+=[(key,error)]
+        return expired
+
+    def renew(self,stage,key,lease):
+        '''extend a lease, False if it was lost (expired and claimed by another worker)'''
+        rows,count=self._execute('''update tasks set lease_until=? where stage=? and key=? and lease=? and state='leased' ''',
+                                 (time.time()+self.lease_seconds,stage,key,lease))
+        return count==1
+
+    def complete(self,stage,key,lease):
+        '''mark a task done, False if the lease was lost and the task belongs to another worker now'''
+        rows,count=self._execute('''update tasks set state='done', error=null, updated=?
+                                    where stage=? and key=? and lease=? and state='leased' ''',(time.time(),stage,key,lease))
+        return count==1
+
+    def fail(self,stage,key,lease,error,retry=False):
+        '''
+        give a task back after an error
+        :param retry (bool): queue it again (while it has attempts left) instead of marking it failed
+        :return: the new state, 'pending' or 'failed', None if the lease was lost
+        '''
+        rows,count=self._execute('''update tasks set state=case when ? and attempts<? then 'pending' else 'failed' end,
+                                    error=?, lease=null, updated=? where stage=? and key=? and lease=? and state='leased' ''',
+                                 (retry,self.max_attempts,error,time.time(),stage,key,lease))
+        if not count:
+            return None
+        return self._execute('select state from tasks where stage=? and key=?',(stage,key))[0][0][0]
+
+    def counts(self,stage):
+        '''{state: number of tasks} of a stage'''
+        rows,count=self._execute('select state, count(*) from tasks where stage=? group by state',(stage,))
+        return dict(rows)
+
+    def failures(self,stage):
+        '''[(key, error)] of the failed tasks of a stage'''
+        rows,count=self._execute('''select key, error from tasks where stage=? and state='failed' order by rowid''',(stage,))
+        return rows
+
+    def forget(self,stage,key=None):
+        '''drop one task, or a whole stage if key is None'''
+        if key is None:
+            self._execute('delete from tasks where stage=?',(stage,))
+        else:
+            self._execute('delete from tasks where stage=? and key=?',(stage,key))
+
+    def work(self,stage,func,name='task',on_done=None,ledger=None,retries=0,retry_on=TRANSIENT_ERRORS,retry_delay=1.,
+             timeout=None):
+        '''
+        claim and run tasks of a stage until every task is done or failed, start it on every worker
+        -- while other workers hold the remaining tasks this worker waits, to take over leases of workers that die
+        -- the lease is renewed from a heartbeat thread while the task runs
+        :param func: picklable callable run as func(*args) for every task
+        :param on_done: callable(task, result) called before a task is marked done, the checkpoint
+        :param ledger (str): json lines file failures are appended to, with their tracebacks
+        :param retries (int): extra attempts (in this worker) for a task failing with one of retry_on
+        :param retry_on (tuple): exception types retried, see batch_runner.is_transient
+        :param retry_delay (float): seconds before the first retry, doubled for every further retry
+        :param timeout (float): seconds a task may run, the task then runs in a child process that is killed after
+                                timeout seconds and the task is queued again while it has attempts left
+        :return: (list of (task, result) finished by this worker, list of (task, traceback) failed in this worker)
+        '''
+
+        done=[]; failed=[]
+        while True:
+            for key,error in self.expire(stage):
+                print('{} {} {} failed: {}'.format(self.worker,name,key,error))
+                if ledger is not None:
+                    log_failure(ledger,name,key,error)
+            claimed=self.claim(stage)
+            if claimed is None:
+                if not self.counts(stage).get('leased'):
+                    break
+                time.sleep(self.poll)
+                continue
+            key,task,lease=claimed
+
+            job=(func,task,retries,retry_on,retry_delay)
+            stop=threading.Event()
+            heartbeat=threading.Thread(target=self._heartbeat,args=(stage,key,lease,stop),daemon=True)
+            heartbeat.start()
+            timed_out=False
+            try:
+                if timeout is None:
+                    task,result,error=_call_task(job)
+                else:
+                    (task,result,error,records),timed_out=_run_in_child(job,timeout)
+                    run_report.extend(records)
+            finally:
+                stop.set()
+                heartbeat.join()
+
+            if error is None:
+                # checkpoint under a lease that was just extended, then mark the task done
+                if self.renew(stage,key,lease):
+                    if on_done is not None:
+                        on_done(task,result)
+                    self.complete(stage,key,lease)
+                    done+=[(task,result)]
+                    print('{} {} {} done ({})'.format(self.worker,name,key,self.progress(stage)))
+                else:
+                    print('{} {} {} finished after its lease was lost, left to the new holder'.format(self.worker,name,key))
+            else:
+                if self.fail(stage,key,lease,error,retry=timed_out)=='failed':
+                    failed+=[(task,error)]
+                    if ledger is not None:
+                        log_failure(ledger,name,key,error)
+                print('{} {} {} failed ({})'.format(self.worker,name,key,self.progress(stage)))
+        return done,failed
+
+    def _heartbeat(self,stage,key,lease,stop):
+        '''renew a lease every third of lease_seconds until stop is set or the lease is lost'''
+        while not stop.wait(self.lease_seconds/3.):
+            if not self.renew(stage,key,lease):
+                return
+
+    def progress(self,stage):
+        '''counts of a stage as a short progress string'''
+        counts=self.counts(stage)
+        return ', '.join('{} {}'.format(counts[state],state) for state in ('done','leased','pending','failed') if state in counts)
+
+
+def _run_in_child(job,timeout):
+    '''
+    run one batch_runner job in a spawned process, killed when it is still running after timeout seconds
+    :return: (_call_task_reported output, True if the task timed out)
+    '''
+
+    context=multiprocessing.get_context('spawn')
+    conn,child_conn=context.Pipe(duplex=False)
+    process=context.Process(target=_call_task_in_child,args=(child_conn,job),daemon=True)
+    process.start()
+    child_conn.close()
+    try:
+        if not conn.poll(timeout):
+            process.terminate()
+            return (job[1],None,'timed out after {} s'.format(timeout),[]),True
+        try:
+            return conn.recv(),False
+        except EOFError:
+            process.join()
+            return (job[1],None,'worker process exited with code {}'.format(process.exitcode),[]),False
+    finally:
+        process.join()
+        conn.close()
+
+
+########## local test runs: several workers on one machine ##########
+
+def _run_local_worker(kind,base,databases,queue_path,lease_seconds,run):
+    '''entry point of one local worker process'''
+    if kind=='nifti':
+        from dicom2nifti_withAlign_withResample import Dicom2Nifti
+        c=Dicom2Nifti(); c.basePATH=base
+    else:
+        from nifti_mask_withResample import VOI_to_nifti_mask
+        c=VOI_to_nifti_mask(); c.anonymize_database=base
+    c.databases=databases; c.queue_path=queue_path; c.lease_seconds=lease_seconds
+    c.run_worker(run=run)
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='run sharded workers of the nifti conversion or the masking on this machine, '
+                                               'start the same command on other nodes to add workers')
+    parser.add_argument('kind',choices=['nifti','mask'])
+    parser.add_argument('base',help='basePATH / anonymize_database')
+    parser.add_argument('--databases',nargs='+',required=True)
+    parser.add_argument('--processes',type=int,default=2,help='workers started on this machine')
+    parser.add_argument('--queue',default=None,help='work queue file, defaults to <base>/work_queue.sqlite')
+    parser.add_argument('--lease',type=float,default=600.,help='lease seconds')
+    parser.add_argument('--run',default=None,help='run to join, printed when a run starts, only needed to add workers of '
+                                                  'another node to a running run, without it a new run is started')
+    args=parser.parse_args()
+    if args.run is None:
+        args.run=new_run_id()
+        print('run {}, add workers on other nodes with --run {}'.format(args.run,args.run))
+    context=multiprocessing.get_context('spawn')
+    processes=[context.Process(target=_run_local_worker,args=(args.kind,args.base,args.databases,args.queue,args.lease,args.run))
+               for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    sys.exit(max(process.exitcode for process in processes))